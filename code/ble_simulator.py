@@ -0,0 +1,473 @@
+'''
+Protocol level simulator of the BLE DO sensor, used to run TruckSensor without
+a radio or I2C hardware. Plugs in where adafruit_ble does:
+
+    sensor = SimulatedSensor(sample_hz=2, dive_duration=20)
+    truck = TruckSensor(calibration, settings, database_mutex, ble_mutex,
+                        ble_radio=SimulatedBLERadio(sensor),
+                        sensors=SimulatedI2CReader(sensor),
+                        data_folder=tempfile.mkdtemp(), upload=False)
+
+Running this file starts a headless end-to-end run (dive, transfer, fit, persist)
+and reports how long each pond took from surfacing to result. The results are
+persisted to a temporary folder and not uploaded.
+'''
+import argparse
+import math
+import random
+import threading
+import time
+import sys
+import tempfile
+import logging
+from queue import Queue
+
+from PyQt5.QtCore import QThread, QCoreApplication, QMutex, pyqtSignal
+from adafruit_ble.services.nordic import UARTService
+
+from converter import convert_raw_to_mgl
+from priority import Priority
+from scheduler import DeadlineScheduler
+
+#init logger
+logger = logging.getLogger(__name__)
+
+class SimulatedFirmware:
+    '''
+    Stand-in for the DO sensor firmware. Takes command lines as written by
+    BluetoothReader and returns the response lines the sensor would send.
+    Implements the commands in BluetoothReader.commands plus thresholds, lights
+    and the ranged "sample print <start> <count>" used by the chunked transfer.
+    '''
+
+    def __init__(self, samples=None, sample_hz=1, battv=3.9, init_do=1.0, init_p=1013.0):
+        # list of (do, temperature, pressure) tuples
+        self.samples = list(samples) if samples else []
+        self.sample_hz = sample_hz
+        self.battv = battv
+        self.init_do = init_do
+        self.init_p = init_p
+        self.threshold = 0
+        self.light = "off"
+
+    def format_sample(self, index):
+        do, temp, pressure = self.samples[index]
+        return f"ts,{index},do,{do:.4f},t,{temp:.2f},p,{pressure:.2f}"
+
+    def handle(self, line):
+        '''
+        line: command string without newline
+        return: list of response lines without newlines
+        '''
+        args = line.strip().lower().split()
+        if args[:2] == ['sample', 'size']:
+            return [f"dsize,{len(self.samples)}"]
+
+        elif args[:2] == ['sample', 'reset']:
+            self.samples = []
+            return []
+
+        elif args[:2] == ['sample', 'print']:
+            start, count = 0, len(self.samples)
+            if len(args) == 4:
+                try:
+                    start, count = int(args[2]), int(args[3])
+                except ValueError:
+                    return []
+            stop = min(start + count, len(self.samples))
+            lines = [f"dstart,{start},{max(stop - start, 0)}"]
+            lines += [self.format_sample(i) for i in range(start, stop)]
+            lines.append("dfinish")
+            return lines
+
+        elif args == ['batt']:
+            status = "charging" if self.battv > 4.1 else "not charging"
+            percent = round(100 * (self.battv - 3.2) / (4.2 - 3.2))
+            return [f"v,{self.battv:.2f},{percent},{status}"]
+
+        elif args == ['get', 'init_do']:
+            return [f"init_do,{self.init_do:.4f}"]
+
+        elif args == ['get', 'init_p']:
+            return [f"init_p,{self.init_p:.2f}"]
+
+        elif args == ['get', 'sample_hz']:
+            return [f"sample_hz,{self.sample_hz}"]
+
+        elif args == ['cal', 'do']:
+            return [f"init do,{self.init_do:.4f}"]
+
+        elif args == ['cal', 'ps']:
+            return [f"init p,{self.init_p:.2f}"]
+
+        elif args[:2] == ['set', 'threshold'] and len(args) == 3:
+            try:
+                self.threshold = int(args[2])
+            except ValueError:
+                return []
+            return [f"threshold,{self.threshold}"]
+
+        elif args[:2] == ['set', 'light'] and len(args) == 3:
+            self.light = args[2]
+            return []
+
+        logger.debug(f"simulated firmware ignored {line}")
+        return []
+
+
+class SimulatedSensor:
+    '''
+    DO sensor with a dive timeline. The sensor sits at the surface for
+    surface_duration seconds, dives for dive_duration seconds, and repeats.
+    While underwater it records samples at sample_hz and (by default) drops the
+    BLE connection. DO approaches do_pond from do_air with time constant tau.
+    '''
+
+    name = "HAUCS_DO_sim01"
+    address = "sim:00:00:00:00:01"
+
+    def __init__(self, sample_hz=1, dive_duration=30, surface_duration=15, dives=None,
+                 do_air=1.0, do_pond=0.6, tau=6.0, water_temp=28.0, depth_hpa=25.0,
+                 noise=0.005, disconnect_underwater=True, seed=None):
+        self.firmware = SimulatedFirmware(sample_hz=sample_hz)
+        self.dive_duration = dive_duration
+        self.surface_duration = surface_duration
+        self.dives = dives
+        self.do_air = do_air
+        self.do_pond = do_pond
+        self.tau = tau
+        self.water_temp = water_temp
+        self.depth_hpa = depth_hpa
+        self.noise = noise
+        self.disconnect_underwater = disconnect_underwater
+        self.rssi = -60
+        self.random = random.Random(seed)
+        self.lock = threading.RLock()
+        self.start_time = time.monotonic()
+        self.dive_count = 0
+        self.surface_times = [] # monotonic time of each completed dive
+        self._dive_start = None
+        self._dive_base = 0
+
+    @property
+    def sample_hz(self):
+        return self.firmware.sample_hz
+
+    def dive_window(self, now):
+        '''
+        return: (dive index, seconds since dive start) or None at the surface
+        '''
+        period = self.surface_duration + self.dive_duration
+        elapsed = now - self.start_time
+        index = int(elapsed // period)
+        if self.dives is not None and index >= self.dives:
+            return None
+        offset = elapsed - index * period - self.surface_duration
+        if offset < 0:
+            return None
+        return index, offset
+
+    def do_at(self, t):
+        '''
+        return: DO (ratio of saturation) t seconds into the dive
+        '''
+        do = self.do_pond + (self.do_air - self.do_pond) * math.exp(-t / self.tau)
+        return do + self.random.gauss(0, self.noise)
+
+    def update(self):
+        '''
+        Advances the sensor to the current time, recording samples while underwater
+        '''
+        with self.lock:
+            window = self.dive_window(time.monotonic())
+            if window is None:
+                if self._dive_start is not None:
+                    self._dive_start = None
+                    self.dive_count += 1
+                    self.surface_times.append(time.monotonic())
+                    logger.debug(f"simulated sensor surfaced after dive {self.dive_count}")
+                return
+            index, offset = window
+            samples = self.firmware.samples
+            if self._dive_start != index:
+                self._dive_start = index
+                self._dive_base = len(samples)
+            expected = self._dive_base + int(offset * self.sample_hz) + 1
+            while len(samples) < expected:
+                t = (len(samples) - self._dive_base) / self.sample_hz
+                pressure = self.firmware.init_p + self.depth_hpa + self.random.gauss(0, 0.2)
+                temp = self.water_temp + self.random.gauss(0, 0.05)
+                samples.append((self.do_at(t), temp, pressure))
+
+    def underwater(self):
+        self.update()
+        return self._dive_start is not None
+
+    def finished(self):
+        return self.dives is not None and self.dive_count >= self.dives
+
+    def ysi_do_mgl(self):
+        '''
+        return: reading of the YSI probe mounted next to the sensor, mg/l
+        '''
+        with self.lock:
+            window = self.dive_window(time.monotonic())
+        if window is None:
+            do = self.do_air + self.random.gauss(0, self.noise)
+        else:
+            do = self.do_at(window[1])
+        return convert_raw_to_mgl(do, self.water_temp, self.firmware.init_p)
+
+    def handle(self, line):
+        with self.lock:
+            self.update()
+            return self.firmware.handle(line)
+
+
+class SimulatedUARTService:
+    '''
+    Byte level replacement for adafruit_ble's UARTService. Writes are handed to
+    the firmware (or sensor), responses are queued as bytes after latency seconds.
+    corruption is the probability that a response line is damaged (truncated or
+    with a flipped character).
+    '''
+
+    def __init__(self, firmware, corruption=0.0, latency=0.0, timeout=1.0):
+        self.firmware = firmware
+        self.corruption = corruption
+        self.latency = latency
+        self.timeout = timeout
+        self._rx = bytearray()
+        self._ready = threading.Condition()
+        self._outbox = Queue()
+        self._courier = threading.Thread(target=self.deliver, daemon=True)
+        self._courier.start()
+
+    @property
+    def in_waiting(self):
+        with self._ready:
+            return len(self._rx)
+
+    def read(self, nbytes=None):
+        with self._ready:
+            self._ready.wait_for(lambda: len(self._rx) > 0, timeout=self.timeout)
+            if not self._rx:
+                return None
+            nbytes = len(self._rx) if nbytes is None else nbytes
+            data = bytes(self._rx[:nbytes])
+            del self._rx[:nbytes]
+            return data
+
+    def write(self, data):
+        for line in data.decode().split("\n"):
+            if line:
+                self._outbox.put((time.monotonic() + self.latency, self.firmware.handle(line)))
+
+    def deliver(self):
+        # single courier keeps responses in the order the commands were written
+        while True:
+            due, lines = self._outbox.get()
+            delay = due - time.monotonic()
+            if delay > 0:
+                time.sleep(delay)
+            self.send_lines(lines)
+
+    def send_lines(self, lines):
+        out = bytearray()
+        for line in lines:
+            out += self.corrupt(line.encode()) + b"\n"
+        with self._ready:
+            self._rx += out
+            self._ready.notify_all()
+
+    def corrupt(self, line):
+        if not line or random.random() >= self.corruption:
+            return line
+        pos = random.randrange(len(line))
+        if random.random() < 0.5:
+            return line[:pos]
+        return line[:pos] + b"#" + line[pos + 1:]
+
+
+class SimulatedUARTConnection:
+    '''
+    Replacement for a BLEConnection holding a SimulatedUARTService.
+    Indexing with any service class returns the uart service. If a sensor is
+    given, the connection drops for good once the sensor goes underwater.
+    '''
+
+    def __init__(self, uart_service, sensor=None):
+        self.uart_service = uart_service
+        self.sensor = sensor
+        self._connected = True
+
+    @property
+    def connected(self):
+        if self._connected and self.sensor is not None:
+            if self.sensor.disconnect_underwater and self.sensor.underwater():
+                logger.debug("simulated connection lost underwater")
+                self._connected = False
+        return self._connected
+
+    def __getitem__(self, service):
+        return self.uart_service
+
+    def disconnect(self):
+        self._connected = False
+
+
+class SimulatedAdvertisement:
+    def __init__(self, sensor):
+        self.complete_name = sensor.name
+        self.address = sensor.address
+        self.rssi = sensor.rssi
+        self.services = [UARTService]
+
+
+class SimulatedBLERadio:
+    '''
+    Replacement for adafruit_ble's BLERadio. The sensor advertises (and accepts
+    connections) only while it is at the surface.
+    '''
+
+    def __init__(self, sensor, corruption=0.0, latency=0.0, connect_time=0.3):
+        self.sensor = sensor
+        self.corruption = corruption
+        self.latency = latency
+        self.connect_time = connect_time
+        self._scanning = False
+
+    def visible(self):
+        return not (self.sensor.disconnect_underwater and self.sensor.underwater())
+
+    def start_scan(self, *advertisement_types, timeout=None, minimum_rssi=-80, **kwargs):
+        self._scanning = True
+        start = time.monotonic()
+        while self._scanning:
+            if timeout is not None and time.monotonic() - start > timeout:
+                break
+            if self.visible() and self.sensor.rssi >= minimum_rssi:
+                yield SimulatedAdvertisement(self.sensor)
+            time.sleep(0.1)
+
+    def stop_scan(self):
+        self._scanning = False
+
+    def connect(self, peer, *, timeout=4):
+        # peer is an advertisement or an address
+        address = getattr(peer, "address", peer)
+        # like a real direct connection, wait up to timeout for the peer to advertise
+        start = time.monotonic()
+        while not self.visible() and time.monotonic() - start < timeout:
+            time.sleep(0.1)
+        time.sleep(self.connect_time)
+        if address != self.sensor.address or not self.visible():
+            raise ConnectionError(f"simulated sensor {address} not reachable")
+        uart = SimulatedUARTService(self.sensor, self.corruption, self.latency)
+        return SimulatedUARTConnection(uart, self.sensor)
+
+
+class SimulatedI2CReader(QThread):
+    '''
+    Replacement for sensor.I2CReader. Publishes YSI readings taken from the
+    simulated sensor and a fixed GPS position.
+    '''
+    ysi_publisher = pyqtSignal(float, float, float)
+    gps_publisher = pyqtSignal(dict)
+    calibration_publisher = pyqtSignal(dict)
+
+    message_priority = None
+    ysi_sampling_period = 1
+    gps_period = 2
+
+    def __init__(self, sensor, pond_id="sim1"):
+        super().__init__()
+        self._abort = False
+        self.sensor = sensor
+        self.pond_id = pond_id
+        self.scheduler = DeadlineScheduler()
+        self.scheduler.add("gps", self.publish_gps, self.gps_period, Priority.high)
+        self.scheduler.add("ysi", self.publish_ysi, self.ysi_sampling_period, Priority.high)
+
+    def set_ysi_sample_rate(self, sample_hz):
+        self.ysi_sampling_period = float(1 / sample_hz)
+        self.scheduler.set_period("ysi", self.ysi_sampling_period)
+
+    def publish_ysi(self):
+        self.ysi_publisher.emit(self.sensor.ysi_do_mgl(), 0, time.monotonic())
+
+    def publish_gps(self):
+        self.gps_publisher.emit({"lat": 27.535, "lng": -80.357, "pid": self.pond_id,
+                                 "nsat": 9, "spd": 0, "hdg": 0, "hdg_type": "none"})
+
+    def set_ysi_calibration(self, zero, full_scale):
+        pass
+
+    def run(self):
+        self._abort = False
+        while not self._abort:
+            self.scheduler.run_pending()
+            self.scheduler.wait()
+
+    def abort(self):
+        self._abort = True
+        self.scheduler.wake()
+
+
+def run_headless(args):
+    '''
+    Runs TruckSensor against the simulator and reports the time from surfacing
+    to pond data for every dive.
+    '''
+    from truck_sensor import TruckSensor
+
+    app = QCoreApplication(sys.argv)
+    sensor = SimulatedSensor(sample_hz=args.sample_hz, dive_duration=args.dive_duration,
+                             surface_duration=args.surface_duration, dives=args.dives, seed=args.seed)
+    radio = SimulatedBLERadio(sensor, corruption=args.corruption, latency=args.latency)
+    settings = {'depth_threshold': 6.0, 'autoclose_sec': 10.0}
+    # simulated dives never reach the truck's data or firebase
+    data_folder = tempfile.mkdtemp(prefix="haucs_simulate_")
+    truck = TruckSensor({}, settings, QMutex(), QMutex(), ble_radio=radio, sensors=SimulatedI2CReader(sensor),
+                        data_folder=data_folder, upload=False)
+    results = []
+
+    def on_pond_data(data):
+        surfaced = sensor.surface_times[-1] if sensor.surface_times else time.monotonic()
+        latency = time.monotonic() - surfaced
+        results.append(latency)
+        logger.info(f"pond {len(results)}: {len(data['do_vals'])} samples, do {data['do']:.3f}, "
+                    f"ysi {data['ysi_do']:.3f}, surfacing to result {latency:.2f} s")
+        truck.update_database(data)
+        if len(results) >= args.dives:
+            app.quit()
+
+    truck.update_pond_data.connect(on_pond_data)
+    truck.dwell_ready.connect(lambda seconds, do_mgl: logger.info(
+        f"dive {len(results) + 1}: ready to pick up after {seconds:.1f} s, predicted ysi {do_mgl:.2f} mg/l"))
+    truck.start()
+    app.exec_()
+
+    truck.abort()
+    truck.sensors.abort()
+    truck.firebase_worker.abort()
+    truck.wait()
+    if results:
+        logger.info(f"{len(results)} dives, surfacing to result mean {sum(results) / len(results):.2f} s, "
+                    f"max {max(results):.2f} s")
+    logger.info(f"simulated sessions in {data_folder}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(prog="ble_simulator")
+    parser.add_argument("--dives", type=int, default=3)
+    parser.add_argument("--sample-hz", type=float, default=1)
+    parser.add_argument("--dive-duration", type=float, default=30)
+    parser.add_argument("--surface-duration", type=float, default=15)
+    parser.add_argument("--corruption", type=float, default=0.0)
+    parser.add_argument("--latency", type=float, default=0.02)
+    parser.add_argument("--seed", type=int, default=None)
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s %(name)s %(levelname)s: %(message)s")
+    run_headless(args)
@@ -6,19 +6,150 @@ import random
 import numpy as np
 from scipy.optimize import curve_fit
 import pandas as pd
-import json, logging, time, os, sys
+import io, json, logging, time, os, sys, threading, warnings
+from queue import Queue, Empty
 from time import sleep
 from subprocess import call
 
 from PyQt5.QtCore import QObject, QThread, pyqtSignal, QMutex, QMutexLocker
+from session import Session
 
 #init logger
 logger = logging.getLogger(__name__)
 
+# layout of a sample line: ts,<index>,do,<do>,t,<temp>,p,<pressure>
+SAMPLE_FIELDS = 8
+SAMPLE_COLUMNS = [1, 3, 5, 7] # index, do, temperature, pressure
+
+CORRUPTED_ROW = [np.nan] * len(SAMPLE_COLUMNS)
+
+def parse_sample_line(line):
+    '''
+    line: one lowercase ts line
+    return: index, do, temp, pressure, NaN for every value if the line is corrupted
+    '''
+    fields = line.split(",")
+    if len(fields) == SAMPLE_FIELDS:
+        try:
+            return [float(fields[column]) for column in SAMPLE_COLUMNS]
+        except ValueError:
+            pass
+    return CORRUPTED_ROW
+
+def parse_sample_lines(text, rows):
+    '''
+    Parses ts lines with numpy's C text parser
+    text: lowercase lines, only ts lines are expected
+    rows: number of ts lines in text
+    return: (rows, 4) float array, None if a line is corrupted or not a ts line
+    '''
+    try:
+        with warnings.catch_warnings():
+            # empty input
+            warnings.simplefilter("ignore")
+            values = np.loadtxt(io.StringIO(text), delimiter=",", usecols=SAMPLE_COLUMNS, ndmin=2, comments=None)
+    except ValueError:
+        return None
+    return values if len(values) == rows else None
+
+def decode_sample_block(buf, block_lines=128):
+    '''
+    Decodes a sample print dump with numpy's C text parser. If the dump has a
+    corrupted line (wrong field count or a value float() rejects, e.g. "--0.8"),
+    it is parsed again in blocks of block_lines and only the blocks with a
+    corrupted line are parsed line by line. Corrupted rows become NaN.
+    buf: raw bytes received between the dstart and dfinish lines
+
+    return: index, do, temp, pressure, valid
+    index, do, temp, pressure: float arrays with one entry per ts line, NaN if corrupted
+    valid: bool array, False for rows where any value could not be parsed
+    '''
+    text = bytes(buf).decode(errors="replace").lower()
+    values = parse_sample_lines(text, text.count("ts,"))
+    if values is None:
+        lines = [line for line in text.split("\n") if line.startswith("ts,")]
+        blocks = [np.empty((0, len(SAMPLE_COLUMNS)))]
+        for start in range(0, len(lines), block_lines):
+            block = lines[start:start + block_lines]
+            parsed = parse_sample_lines("\n".join(block), len(block))
+            if parsed is None:
+                parsed = np.array([parse_sample_line(line) for line in block], dtype=float)
+            blocks.append(parsed)
+        values = np.concatenate(blocks)
+    # nan and inf parse but are not sensor values
+    valid = np.isfinite(values).all(axis=1)
+    values[~valid] = np.nan
+    return values[:, 0], values[:, 1], values[:, 2], values[:, 3], valid
+
+def missing_ranges(received, chunk_size):
+    '''
+    received: bool array, True for sample indices already transferred intact
+    chunk_size: maximum number of samples per request
+
+    return: list of (start, count) ranges covering every missing index
+    '''
+    edges = np.diff(np.concatenate(([0], (~received).astype(np.int8), [0])))
+    starts = np.flatnonzero(edges == 1)
+    stops = np.flatnonzero(edges == -1)
+    ranges = []
+    for start, stop in zip(starts, stops):
+        for chunk_start in range(start, stop, chunk_size):
+            ranges.append((int(chunk_start), int(min(chunk_size, stop - chunk_start))))
+    return ranges
+
+class UARTLineReader(threading.Thread):
+    '''
+    Background reader for the UART service. Blocks on the service until bytes
+    arrive (or the service timeout expires) and splits the stream into lines.
+    Raw lines (without the trailing newline) are queued so send_receive_command
+    can wait on them with a deadline instead of polling in_waiting.
+    '''
+
+    def __init__(self, uart_connection, uart_service):
+        super().__init__(daemon=True)
+        self.uart_connection = uart_connection
+        self.uart_service = uart_service
+        self.lines = Queue()
+        self._buffer = bytearray()
+        self._abort = False
+
+    def run(self):
+        while not self._abort:
+            try:
+                if not self.uart_connection.connected:
+                    break
+                # blocks until a byte arrives or the uart timeout expires
+                chunk = self.uart_service.read(1)
+                if not chunk:
+                    continue
+                waiting = self.uart_service.in_waiting
+                if waiting:
+                    chunk += self.uart_service.read(waiting)
+            except Exception as e:
+                logger.debug("uart reader stopped %s", e)
+                break
+            self._buffer += chunk
+            *lines, self._buffer = self._buffer.split(b"\n")
+            for line in lines:
+                self.lines.put(bytes(line))
+        logger.debug("uart reader exited")
+
+    def get_line(self, timeout):
+        '''
+        Returns the next raw line, or None if nothing arrived before timeout
+        '''
+        try:
+            return self.lines.get(timeout=max(timeout, 0))
+        except Empty:
+            return None
+
+    def abort(self):
+        self._abort = True
+
+
 class BluetoothReader(QObject):
     data_updated = pyqtSignal(dict)
     uart_connection = None
-    sdata = {'connection':False, 'name':'', 'sample_hz':1, 'battv':0, 'batt_status':"not charging", 'init_p':0, 'init_do':0}
     current_sample_size = 0
     prev_sample_size = 0
 
@@ -37,37 +168,144 @@ class BluetoothReader(QObject):
         's_rate' : {'tx':'get sample_hz', 'rx':'sample_hz', 'size':2},
     }
 
-    def __init__(self, ble_mutex):
+    # reconnect settings
+    direct_timeout = 2      # seconds to wait for a direct connection to the known sensor
+    scan_timeout = 5        # maximum duration of a scan
+    candidate_window = 0.5  # seconds to keep collecting candidates after the first one
+    minimum_rssi = -90
+    forget_after = 5        # failed connects to the known sensor before scanning for any sensor again,
+    forget_timeout = 120    # and seconds since it was last connected (longer than a dive, it is unreachable underwater)
+    end_grace = 0.3         # seconds to wait for the end line once a block has all expected lines
+
+    def __init__(self, ble_mutex, radio=None):
+        '''
+        radio: object with the BLERadio interface, defaults to adafruit_ble's BLERadio
+        '''
         super().__init__()
         self.transmission_timeouts = 0
         self.ble_mutex = ble_mutex
-        self.ble = BLERadio()
+        self.sdata = Session(connection=False, name='', sample_hz=1, battv=0, batt_status="not charging", init_do=0)
+        self.sample_rows = []
+        self.ble = radio if radio is not None else BLERadio()
+        self.uart_reader = None
+        self.known_address = None
+        self.known_name = None
+        self.known_failures = 0     # failed connects since the known sensor was last connected
+        self.last_connected = None  # monotonic time of the last connection
+        self.transfer = None # partial chunked transfer, kept across reconnects
         self._abort = False
 
     def connect(self):
-        logger.debug('starting ble scan')
+        '''
+        Connects to the last known sensor directly if there is one, otherwise
+        (or if that fails) falls back to a bounded scan. A known sensor that has
+        not been reachable for forget_after attempts and forget_timeout seconds
+        (swapped or renamed probe) is forgotten and any UART sensor is accepted.
+        '''
         connection_success = False
+        if self.known_address is not None:
+            connection_success = self.connect_known()
+        if not connection_success:
+            connection_success = self.scan_connect()
+        if not connection_success and self.known_name is not None:
+            self.known_failures += 1
+            if (self.known_failures >= self.forget_after
+                    and time.monotonic() - self.last_connected >= self.forget_timeout):
+                logger.info(f"{self.known_name} not found in {self.known_failures} attempts, scanning for any sensor")
+                self.forget_sensor()
+                connection_success = self.scan_connect()
+        self.sdata['connection'] = connection_success
+        return connection_success
+
+    def connect_known(self):
+        '''
+        Connects to the cached sensor address without scanning
+        '''
+        logger.debug(f'connecting directly to {self.known_name}')
         try:
-            for adv in self.ble.start_scan(ProvideServicesAdvertisement):
-                if UARTService in adv.services:
-                    logger.debug(f"found sensor with UART service {adv.complete_name}")
-                    self.uart_connection = self.ble.connect(adv)
-                    if self.uart_connection.connected:
-                        self.sensor_name = adv.complete_name
-                        self.sdata['name'] = adv.complete_name[9:]
-                        self.sdata['connection'] = True
-                        logger.debug(f"successfully connected to {adv}")
-                        connection_success = True
-                        break
+            self.uart_connection = self.ble.connect(self.known_address, timeout=self.direct_timeout)
+            if self.uart_connection.connected:
+                self.on_connected(self.known_address, self.known_name)
+                return True
+        except Exception as e:
+            logger.debug('direct connection to %s failed %s', self.known_name, e)
+        return False
+
+    def scan_connect(self):
+        '''
+        Scans for at most scan_timeout seconds. If a sensor is known, only
+        advertisements with its name are accepted and the scan stops at the
+        first match. Otherwise candidates are collected for candidate_window
+        seconds after the first one is seen. Candidates are tried strongest
+        rssi first.
+        '''
+        logger.debug('starting ble scan')
+        candidates = {}
+        first_seen = None
+        try:
+            for adv in self.ble.start_scan(ProvideServicesAdvertisement, timeout=self.scan_timeout,
+                                           minimum_rssi=self.minimum_rssi):
+                if UARTService not in adv.services:
+                    continue
+                if self.known_name is not None and adv.complete_name != self.known_name:
+                    continue
+                logger.debug(f"found sensor with UART service {adv.complete_name} rssi {adv.rssi}")
+                previous = candidates.get(adv.address)
+                if previous is None or adv.rssi > previous.rssi:
+                    candidates[adv.address] = adv
+                if self.known_name is not None:
+                    break
+                if first_seen is None:
+                    first_seen = time.monotonic()
+                elif time.monotonic() - first_seen > self.candidate_window:
+                    break
         except Exception as e:
             logger.error('failed BLE scan %s', e)
-            connection_success = False
-        self.sdata['connection'] = connection_success
         try:
             self.ble.stop_scan()
         except Exception as e:
             logger.error('failed to stop BLE scan %s', e)
-        return connection_success
+
+        for adv in sorted(candidates.values(), key=lambda adv: adv.rssi, reverse=True):
+            try:
+                self.uart_connection = self.ble.connect(adv)
+                if self.uart_connection.connected:
+                    self.on_connected(adv.address, adv.complete_name)
+                    logger.debug(f"successfully connected to {adv}")
+                    return True
+            except Exception as e:
+                logger.error('failed to connect to %s %s', adv.complete_name, e)
+        return False
+
+    def on_connected(self, address, name):
+        self.start_uart_reader()
+        # cache the sensor for the next reconnect
+        self.known_address = address
+        self.known_name = name
+        self.known_failures = 0
+        self.last_connected = time.monotonic()
+        self.sensor_name = name
+        self.sdata['name'] = name[9:]
+        self.sdata['connection'] = True
+        # timeouts of the previous link do not apply to the new one
+        self.transmission_timeouts = 0
+
+    def forget_sensor(self):
+        '''
+        Clears the cached sensor, the next connect accepts any UART sensor
+        '''
+        self.known_address = None
+        self.known_name = None
+        self.known_failures = 0
+
+    def start_uart_reader(self):
+        '''
+        (Re)starts the background line reader for the current connection
+        '''
+        if self.uart_reader is not None:
+            self.uart_reader.abort()
+        self.uart_reader = UARTLineReader(self.uart_connection, self.uart_connection[UARTService])
+        self.uart_reader.start()
 
     def check_connection_status(self):
         connected = False
@@ -122,13 +360,113 @@ class BluetoothReader(QObject):
         self.send_receive_command(self.commands['s_reset'])
         self.prev_sample_size = 0
         self.current_sample_size = 0
+        self.transfer = None
 
 
 
-    def get_sample_data(self):
-        msg = self.send_receive_command(self.commands['s_print'], timeout=5)
-        return msg == 'dfinish'
+    def get_sample_data(self, bulk=True):
+        '''
+        Retrieves the sample dump from the sensor.
+        bulk: gather the raw dump and decode it in one pass (see decode_sample_block),
+              otherwise every line is parsed by extract_message
+        '''
+        if not bulk:
+            msg = self.send_receive_command(self.commands['s_print'], timeout=5)
+            return len(msg) > 0 and msg[0] == self.commands['s_print']['end']
+
+        buf = self.send_receive_block(self.commands['s_print'], timeout=5)
+        if buf is None:
+            return False
+        _, do, temp, pressure, valid = decode_sample_block(buf)
+        self.sdata['do_vals'] = do
+        self.sdata['temp_vals'] = temp
+        self.sdata['pressure_vals'] = pressure
+        self.sdata['sample_valid'] = valid
+        if not valid.all():
+            logger.warning(f'{np.count_nonzero(~valid)} of {len(valid)} samples corrupted in ble transfer')
+        if len(valid) != self.current_sample_size:
+            logger.warning(f"size mismatch between data collected on sensor and data received: {self.current_sample_size} vs. {len(valid)}")
+        return True
     
+    def get_sample_range(self, start, count, timeout=1):
+        '''
+        Requests samples [start, start + count) from the sensor.
+        Returns the decode_sample_block output or None on timeout
+        '''
+        command = {'tx':f"sample print {start} {count}", 'rx':'dstart', 'end':'dfinish'}
+        buf = self.send_receive_block(command, timeout, max_lines=count)
+        if buf is None:
+            return None
+        return decode_sample_block(buf)
+
+    def get_sample_data_chunked(self, chunk_size=64, max_rounds=4):
+        '''
+        Resumable sample transfer. Samples are requested by index range and only
+        the missing or corrupted indices are requested again. Progress is kept in
+        self.transfer, so a transfer interrupted by a disconnect resumes after the
+        reconnect as long as the sensor still reports the same sample size.
+        Falls back to the full sample print if the sensor never answers a range
+        request (firmware without "sample print <start> <count>").
+
+        return: True if every sample arrived intact
+        '''
+        size = self.current_sample_size
+        if size <= 0:
+            return False
+        if self.transfer is None or self.transfer['size'] != size:
+            self.transfer = {
+                'size': size,
+                'do': np.full(size, np.nan),
+                'temp': np.full(size, np.nan),
+                'pressure': np.full(size, np.nan),
+                'received': np.zeros(size, dtype=bool),
+                'answered': False,
+            }
+        transfer = self.transfer
+        received = transfer['received']
+
+        for _ in range(max_rounds):
+            ranges = missing_ranges(received, chunk_size)
+            if not ranges:
+                break
+            for start, count in ranges:
+                result = self.get_sample_range(start, count)
+                if result is None:
+                    if not transfer['answered']:
+                        logger.info("sensor did not answer range request, using full sample print")
+                        self.transfer = None
+                        return self.get_sample_data()
+                    if not self.uart_connection.connected:
+                        logger.warning(f"transfer interrupted with {np.count_nonzero(received)} of {size} samples")
+                        return False
+                    continue
+                index, do, temp, pressure, valid = result
+                outside = valid & ((index < start) | (index >= start + count))
+                if len(index) > count or outside.any():
+                    # firmware that ignores the range arguments sends its whole log
+                    # (a corrupted first line only shifts the first intact index inside the range)
+                    logger.warning(f"sensor answered range {start}+{count} with {len(index)} samples, "
+                                   f"{np.count_nonzero(outside)} outside the range, using full sample print")
+                    self.transfer = None
+                    return self.get_sample_data()
+                transfer['answered'] = True
+                # only accept intact rows inside the requested window
+                accept = valid & (index >= start) & (index < start + count)
+                idx = index[accept].astype(int)
+                transfer['do'][idx] = do[accept]
+                transfer['temp'][idx] = temp[accept]
+                transfer['pressure'][idx] = pressure[accept]
+                received[idx] = True
+
+        self.sdata['do_vals'] = transfer['do'].copy()
+        self.sdata['temp_vals'] = transfer['temp'].copy()
+        self.sdata['pressure_vals'] = transfer['pressure'].copy()
+        self.sdata['sample_valid'] = received.copy()
+        if not received.all():
+            logger.warning(f'{np.count_nonzero(~received)} of {size} samples missing after {max_rounds} transfer rounds')
+            return False
+        return True
+
     def set_calibration_pressure(self):
         return self.send_receive_command(self.commands['cal_ps']) 
 
@@ -139,9 +477,13 @@ class BluetoothReader(QObject):
                 return True
         return False
     
-    def set_threshold(self, hpa):
-        command = {'tx':f"set threshold {int(hpa)}", 'rx':'threshold', 'size':2}
-        msg = self.send_receive_command(command)
+    def threshold_command(self, hpa):
+        return {'tx':f"set threshold {int(hpa)}", 'rx':'threshold', 'size':2}
+
+    def check_threshold(self, msg, hpa):
+        '''
+        Returns True if msg acknowledges the threshold hpa
+        '''
         # failed if no response
         if len(msg) < 2:
             return False
@@ -149,10 +491,14 @@ class BluetoothReader(QObject):
             received_p = float(msg[1])
         except:
             return False
-        if msg[0] == command['rx'] and received_p == int(hpa):
+        if msg[0] == 'threshold' and received_p == int(hpa):
             return True
         return False
 
+    def set_threshold(self, hpa):
+        msg = self.send_receive_command(self.threshold_command(hpa))
+        return self.check_threshold(msg, hpa)
+
     def set_lights(self, pattern):
         command = {'tx':f"set light {pattern}", 'rx':''}
         self.send_receive_command(command)
@@ -181,27 +527,30 @@ class BluetoothReader(QObject):
 
             elif key == "dstart":
                 self.data_counter = 0
-                self.sdata["do_vals"] = []
-                self.sdata["temp_vals"] = []
-                self.sdata["pressure_vals"] = []
+                self.sample_rows = []
 
             elif key == "ts":
+                valid = True
                 try:
                     do = float(value[2])
                     temp_val = float(value[4])
                     pressure_val = float(value[6])
                 except:
                     logger.warning(f'data corrupted in ble transfer {key, value}')
-                    do = 0
-                    temp_val = 0
-                    pressure_val = 0
+                    do = np.nan
+                    temp_val = np.nan
+                    pressure_val = np.nan
+                    valid = False
 
-                self.sdata['do_vals'].append(do)
-                self.sdata["temp_vals"].append(temp_val)
-                self.sdata["pressure_vals"].append(pressure_val)
+                self.sample_rows.append((do, temp_val, pressure_val, valid))
                 self.data_counter = self.data_counter + 1  
 
             elif "dfinish" in key:
+                rows = np.array(self.sample_rows, dtype=float).reshape(-1, 4)
+                self.sdata['do_vals'] = rows[:, 0]
+                self.sdata['temp_vals'] = rows[:, 1]
+                self.sdata['pressure_vals'] = rows[:, 2]
+                self.sdata['sample_valid'] = rows[:, 3].astype(bool)
                 # compare data counter to current sample size
                 if self.data_counter != self.current_sample_size:
                     logger.warning(f"size mismatch between data collected on sensor and data received: {self.current_sample_size} vs. {self.data_counter}")
@@ -222,20 +571,20 @@ class BluetoothReader(QObject):
         multiple_outputs = "end" in command
         receiving_array = False
         with QMutexLocker(self.ble_mutex):
+            if self.uart_reader is None or not self.uart_reader.is_alive():
+                self.start_uart_reader()
             uart_service = self.uart_connection[UARTService]
             msg = "" # return nothing if tx only
             uart_service.write((command['tx'] + "\n").encode())
-            start_time = time.time()
+            deadline = time.time() + timeout
             while len(command['rx']) > 0:
-                # check timeout
-                if (time.time() - start_time > timeout):
+                # block until a line arrives or the deadline passes
+                line = self.uart_reader.get_line(deadline - time.time())
+                if line is None:
                     logger.debug('timeout triggered')
                     self.transmission_timeouts += 1
                     return ""
-                # wait till buffer has something
-                if not uart_service.in_waiting:
-                    continue
-                msg = uart_service.readline().decode()
+                msg = line.decode(errors="replace")
                 msg = msg.replace("\n","")
                 msg = msg.lower()
                 msg = msg.split(",")
@@ -260,4 +609,109 @@ class BluetoothReader(QObject):
             # reset transmission timeouts on successfull transmission 
             self.transmission_timeouts = 0
             logger.debug(f"sent {command}, received {msg}")
-            return msg
\ No newline at end of file
+            return msg
+
+    def send_receive_commands(self, commands, timeout=2):
+        '''
+        Pipelined send_receive_command for commands with a single line reply.
+        All commands are written back to back, replies are matched to their
+        command by rx key and passed to extract_message. One deadline covers
+        the whole batch.
+        commands: dict of name -> command (see self.commands)
+        return: dict of name -> received message ("" if no reply)
+        '''
+        replies = {name: "" for name in commands}
+        if not self.uart_connection:
+            return replies
+        if not self.uart_connection.connected:
+            return replies
+
+        # rx key -> names waiting for that reply, in the order they were sent
+        pending = {}
+        for name, command in commands.items():
+            if len(command['rx']) > 0:
+                pending.setdefault(command['rx'], []).append(name)
+
+        with QMutexLocker(self.ble_mutex):
+            if self.uart_reader is None or not self.uart_reader.is_alive():
+                self.start_uart_reader()
+            uart_service = self.uart_connection[UARTService]
+            for command in commands.values():
+                uart_service.write((command['tx'] + "\n").encode())
+            deadline = time.time() + timeout
+            while pending:
+                line = self.uart_reader.get_line(deadline - time.time())
+                if line is None:
+                    logger.debug(f'batch timeout triggered, no reply for {list(pending)}')
+                    self.transmission_timeouts += 1
+                    return replies
+                msg = line.decode(errors="replace")
+                msg = msg.replace("\n","")
+                msg = msg.lower()
+                msg = msg.split(",")
+                if msg[0] not in pending:
+                    continue
+                name = pending[msg[0]].pop(0)
+                if not pending[msg[0]]:
+                    del pending[msg[0]]
+                # check message length if defined
+                if commands[name].get('size'):
+                    if commands[name].get('size') != len(msg):
+                        logger.info("ble message corrupted %s", msg)
+                logger.debug("message received %s", msg)
+                self.extract_message(msg)
+                replies[name] = msg
+            self.transmission_timeouts = 0
+            logger.debug(f"sent {list(commands)}, received {replies}")
+            return replies
+
+    def send_receive_block(self, command, timeout=5, max_lines=None):
+        '''
+        Sends a command with a multi-line response (rx ... end) and returns the raw
+        bytes received between the rx and end lines, without decoding them.
+        max_lines: expected number of lines. The block is always read through the
+                   end line, past max_lines it only waits end_grace for each further
+                   line, so a lost or corrupted end line does not wait for the timeout
+        Returns None if not connected or on timeout
+        '''
+        if not self.uart_connection:
+            return None
+        if not self.uart_connection.connected:
+            return None
+
+        rx = command['rx'].encode()
+        end = command['end'].encode()
+        receiving_array = False
+        lines_received = 0
+        buf = bytearray()
+        with QMutexLocker(self.ble_mutex):
+            if self.uart_reader is None or not self.uart_reader.is_alive():
+                self.start_uart_reader()
+            uart_service = self.uart_connection[UARTService]
+            uart_service.write((command['tx'] + "\n").encode())
+            deadline = time.time() + timeout
+            grace_deadline = deadline
+            while True:
+                line = self.uart_reader.get_line(min(deadline, grace_deadline) - time.time())
+                if line is None:
+                    if receiving_array and max_lines is not None and lines_received >= max_lines:
+                        logger.debug('end line missing, block complete')
+                        break
+                    logger.debug('timeout triggered')
+                    self.transmission_timeouts += 1
+                    return None
+                key = line.lower().split(b",", 1)[0]
+                if key == rx:
+                    receiving_array = True
+                    lines_received = 0
+                    buf.clear()
+                elif receiving_array:
+                    if key == end:
+                        break
+                    buf += line + b"\n"
+                    lines_received += 1
+                    if max_lines is not None and lines_received >= max_lines:
+                        grace_deadline = time.time() + self.end_grace
+            self.transmission_timeouts = 0
+            logger.debug(f"sent {command}, received {len(buf)} bytes")
+            return buf
\ No newline at end of file
@@ -1,140 +1,323 @@
-import math
+import functools
+import hashlib
+import threading
+from collections import OrderedDict, namedtuple
 import numpy as np
-from scipy.optimize import curve_fit
+from scipy.optimize import leastsq, minimize_scalar
+from time import perf_counter
 import logging
 logger = logging.getLogger(__name__)
 
+# resolution the sensors report conditions at, keys of the saturation cache
+TEMP_RESOLUTION = 0.01      # celcius
+PRESSURE_RESOLUTION = 0.01  # hPa
+SALINITY_RESOLUTION = 0.1   # parts per thousand
+SATURATION_CACHE_SIZE = 1024
+FIT_CACHE_SIZE = 64          # dives, a fit is a few hundred bytes
+
 def to_fahrenheit(temp):
     return (temp / 5) * 9 + 32
 
 def to_celcius(temp):
     return ((temp - 32) / 9) * 5
 
-def convert_raw_to_mgl(do, t, p=977, s=0):
+def _scalar_or_array(values):
+    # 0-d results go back to python floats, arrays stay arrays
+    return values.item() if values.ndim == 0 else values
+
+def _clamp_out_of_range(values, name, lower=0, upper=100, **inputs):
     '''
-    do: dissolved oxygen as ratio (1 = 100% saturation)
+    Sets values outside [lower, upper] to 0, logs one summary per call.
+    NaN (missing samples) is left as is.
+    inputs: arrays the values were computed from, the first failing set is logged
+    '''
+    bad = (values > upper) | (values < lower)
+    if bad.any():
+        first = np.flatnonzero(bad)[0]
+        example = " ".join(f"{key} {np.broadcast_to(val, values.shape).flat[first]}" for key, val in inputs.items())
+        logger.error("do conversion failed for %s of %s values, first: %s %s %s",
+                     np.count_nonzero(bad), values.size, example, name, values.flat[first])
+        values[bad] = 0
+    return values
+
+def do_saturation_mgl(t, p=977, s=0):
+    '''
+    Oxygen solubility in mg/l (100% saturation), broadcasts over arrays
     t: temperature in celcius
     p: pressure in hPa, default is pressure at 400ft
     s: salinity in parts per thousand
     '''
+    t = np.asarray(t, dtype=float)
+    s = np.asarray(s, dtype=float)
     T = t + 273.15 #temperature in kelvin
-    P = p * 9.869233e-4 #pressure in atm
-
-    #Handle Arrays
-    is_array = False
-    if isinstance(do, list):
-        do = np.array(do)
-        is_array = True
+    P = np.asarray(p, dtype=float) * 9.869233e-4 #pressure in atm
 
-
-    DO_baseline = math.exp(-139.34411 + 1.575701e5/T - 6.642308e7/math.pow(T, 2) + 1.2438e10/math.pow(T, 3) - 8.621949e11/math.pow(T, 4))
+    DO_baseline = np.exp(-139.34411 + 1.575701e5/T - 6.642308e7/T**2 + 1.2438e10/T**3 - 8.621949e11/T**4)
     # SALINITY CORRECTION
-    Fs = math.exp(-s * (0.017674 - 10.754/T + 2140.7/math.pow(T, 2)))
+    Fs = np.exp(-s * (0.017674 - 10.754/T + 2140.7/T**2))
     # PRESSURE CORRECTION
-    theta = 0.000975 - 1.426e-5 * t + 6.436e-8 * math.pow(t, 2)
-    u = math.exp(11.8571 - 3840.7/T - 216961/math.pow(T, 2))
+    theta = 0.000975 - 1.426e-5 * t + 6.436e-8 * t**2
+    u = np.exp(11.8571 - 3840.7/T - 216961/T**2)
     Fp = (P - u) * (1 - theta * P) / (1 - u) / (1 - theta)
 
-    DO_corrected = DO_baseline * Fs * Fp
+    return DO_baseline * Fs * Fp
 
-    DO_mgl = do * DO_corrected
+@functools.lru_cache(maxsize=SATURATION_CACHE_SIZE)
+def _saturation_at(t_key, p_key, s_key):
+    return float(do_saturation_mgl(t_key * TEMP_RESOLUTION, p_key * PRESSURE_RESOLUTION, s_key * SALINITY_RESOLUTION))
 
-    # handle check for array
-    if is_array:
-        for i, val in enumerate(DO_mgl):
-            if (val > 100) or (val < 0):
-                logger.error("do conversion failed: do %s t %s p %s s %s do_mgl %s", do[i], t, p, s, val)
-                DO_mgl[i] = 0
-    # handle check for singular value
-    else:
-        if (DO_mgl > 100) or (DO_mgl < 0):
-            logger.error("do conversion failed: do %s t %s p %s s %s do_mgl %s", do, t, p, s, DO_mgl)
-            return 0
-    
-    return DO_mgl
+def cached_do_saturation_mgl(t, p=977, s=0):
+    '''
+    do_saturation_mgl for scalar conditions, looked up in an LRU cache keyed by the
+    conditions quantized to the sensor resolution (TEMP_RESOLUTION etc.).
+    Hit/miss statistics from saturation_cache_info().
+    '''
+    return _saturation_at(round(t / TEMP_RESOLUTION), round(p / PRESSURE_RESOLUTION), round(s / SALINITY_RESOLUTION))
+
+def saturation_cache_info():
+    '''
+    return: functools cache info (hits, misses, maxsize, currsize)
+    '''
+    return _saturation_at.cache_info()
+
+def _cached_scalar(do, t, p, s, convert, name):
+    # lookup path for plain float arguments, skips numpy
+    if not all(isinstance(value, (int, float)) for value in (do, t, p, s)):
+        return None
+    value = convert(do, cached_do_saturation_mgl(t, p, s))
+    if (value > 100) or (value < 0):
+        logger.error("do conversion failed: do %s t %s p %s s %s %s %s", do, t, p, s, name, value)
+        return 0.0
+    return value
 
-def convert_mgl_to_raw(do, t, p=977, s=0):
+def convert_raw_to_mgl(do, t, p=977, s=0, cached=False):
     '''
     do: dissolved oxygen as ratio (1 = 100% saturation)
     t: temperature in celcius
     p: pressure in hPa, default is pressure at 400ft
     s: salinity in parts per thousand
+    cached: for scalar arguments, look the solubility up in the saturation
+            cache (conditions rounded to the sensor resolution)
+
+    Any argument may be an array (e.g. per sample temperature), arguments
+    broadcast against each other. Results outside 0-100 mg/l are set to 0.
+    return: float for scalar arguments, otherwise an array
     '''
-    T = t + 273.15 #temperature in kelvin
-    P = p * 9.869233e-4 #pressure in atm
+    if cached:
+        DO_mgl = _cached_scalar(do, t, p, s, lambda do, sat: do * sat, "do_mgl")
+        if DO_mgl is not None:
+            return DO_mgl
+    do = np.asarray(do, dtype=float)
+    DO_mgl = np.array(do * do_saturation_mgl(t, p, s), dtype=float, ndmin=1)
+    _clamp_out_of_range(DO_mgl, "do_mgl", do=do, t=t, p=p, s=s)
+    return _scalar_or_array(DO_mgl.reshape(np.broadcast(do, t, p, s).shape))
 
-    #Handle Arrays
-    is_array = False
-    if isinstance(do, list):
-        do = np.array(do)
-        is_array = True
+def convert_mgl_to_raw(do, t, p=977, s=0, cached=False):
+    '''
+    do: dissolved oxygen in mg/l
+    t: temperature in celcius
+    p: pressure in hPa, default is pressure at 400ft
+    s: salinity in parts per thousand
+    cached: see convert_raw_to_mgl
 
-    DO_baseline = math.exp(-139.34411 + 1.575701e5/T - 6.642308e7/math.pow(T, 2) + 1.2438e10/math.pow(T, 3) - 8.621949e11/math.pow(T, 4))
-    # SALINITY CORRECTION
-    Fs = math.exp(-s * (0.017674 - 10.754/T + 2140.7/math.pow(T, 2)))
-    # PRESSURE CORRECTION
-    theta = 0.000975 - 1.426e-5 * t + 6.436e-8 * math.pow(t, 2)
-    u = math.exp(11.8571 - 3840.7/T - 216961/math.pow(T, 2))
-    Fp = (P - u) * (1 - theta * P) / (1 - u) / (1 - theta)
+    Any argument may be an array, arguments broadcast against each other.
+    Results outside 0-100 (ratio) are set to 0.
+    return: float for scalar arguments, otherwise an array
+    '''
+    if cached:
+        DO_percent = _cached_scalar(do, t, p, s, lambda do, sat: do / sat, "do_ps")
+        if DO_percent is not None:
+            return DO_percent
+    do = np.asarray(do, dtype=float)
+    DO_percent = np.array(do / do_saturation_mgl(t, p, s), dtype=float, ndmin=1)
+    _clamp_out_of_range(DO_percent, "do_ps", do=do, t=t, p=p, s=s)
+    return _scalar_or_array(DO_percent.reshape(np.broadcast(do, t, p, s).shape))
 
-    DO_corrected = DO_baseline * Fs * Fp
+def exp_func(x, a, b, c):
+    return a * np.exp(-b * x) + c
 
-    DO_percent = do / DO_corrected
+def exp_jacobian(x, a, b, c):
+    '''
+    return: derivatives of exp_func by a, b and c, shape (len(x), 3)
+    '''
+    e = np.exp(-b * x)
+    return np.column_stack((e, -a * x * e, np.ones_like(x)))
 
-    # handle check for array
-    if is_array:
-        for i, val in enumerate(DO_percent):
-            if (val > 100) or (val < 0):
-                logger.error("do conversion failed: do %s t %s p %s s %s do_ps %s", do[i], t, p, s, val)
-                DO_percent[i] = 0
-    # handle check for singular value
-    else:
-        if (DO_percent > 100) or (DO_percent < 0):
-            logger.error("do conversion failed: do %s t %s p %s s %s do_ps %s", do, t, p, s, DO_percent)
-            return 0
+def exp_initial_guess(time, do_vals):
+    '''
+    Closed form estimate of exp_func parameters. b comes from the three point
+    method: the series is split into three equal time windows, for an
+    exponential the window means m0, m1, m2 give exp(-b * h) = (m2 - m1) / (m1 - m0).
+    With b fixed, a and c are a linear least squares fit.
+    Uses a time constant of a third of the span if the data is not monotonic
+    enough to solve for b.
 
-    return DO_percent
+    return: (a, b, c)
+    '''
+    span = time[-1] - time[0]
+    h = span / 3
+    b = 3 / span if span > 0 else 1
+    if h > 0:
+        edges = time[0] + h * np.arange(1, 3)
+        window = np.searchsorted(edges, time, side="right")
+        counts = np.bincount(window, minlength=3)
+        if np.all(counts > 0):
+            m0, m1, m2 = np.bincount(window, do_vals, minlength=3) / counts
+            if (m1 - m0) != 0:
+                r = (m2 - m1) / (m1 - m0)
+                if 0 < r < 1:
+                    b = -np.log(r) / h
+    (a, c), _ = exp_linear_fit(time, do_vals, b)
+    return a, b, c
 
-def exp_func(x, a, b, c):
-    return a * np.exp(-b * x) + c
+def exp_linear_fit(time, do_vals, b):
+    '''
+    Least squares a and c of exp_func for a fixed b
+    return: (a, c), sum of squared residuals
+    '''
+    X = np.column_stack((np.exp(-b * time), np.ones_like(time)))
+    params, *_ = np.linalg.lstsq(X, do_vals, rcond=None)
+    residual = X @ params - do_vals
+    return tuple(params), residual @ residual
 
-def calculate_do_fit(do_vals, max_time=30, sample_hz=1):
+def fit_do(do_vals, max_time=30, sample_hz=1, time=None, p0=None):
     '''
-    do_vals:   array of DO values (either mgl or percent sat)
-    max_time:  max time where DO values are still valid
-    sample_hz: samle frequency used to collect do_vals
+    Fits exp_func to a dive, see calculate_do_fit for the arguments.
+    Starts from exp_initial_guess, or from p0 (e.g. the previous pond's
+    parameters) if that fits the data better. Levenberg-Marquardt with the
+    analytic Jacobian converges in a few steps from there; if it fails or the
+    time constant leaves the bounds (1/b between 0.1 samples and 20 times the
+    dive, beyond that the curve is a line) the fit is repeated inside the
+    bounds. Falls back to a line of best fit if the curve fit fails.
 
-    return:
-    popt: optimization parameters for either curve fit or linear fit
-    fit_type: "curve" for curve fit or "linear" for linear fit
+    return: dict with popt, fit_type, nfev (function evaluations of the
+            curve fit), start ("guess" or "warm"), bounded (refit inside
+            the bounds) and elapsed (seconds)
     '''
+    start_time = perf_counter()
+    do_vals = np.array(do_vals, dtype=float)
 
-    do_vals = np.array(do_vals)
-    
-    time = np.arange(len(do_vals)) / sample_hz
+    if time is None:
+        time = np.arange(len(do_vals)) / sample_hz
+    time = np.asarray(time, dtype=float)
 
     #trim time and do vals to be less than max time
-    time = time[time <= max_time]
-    do_vals = do_vals[: len(time)]
+    keep = time <= max_time
+    time = time[keep]
+    do_vals = do_vals[keep]
 
-    x_plot = np.linspace(0, max_time, max_time * 10)
-    y_fit = np.zeros_like(x_plot)
+    # drop samples flagged as corrupted (NaN)
+    keep = np.isfinite(do_vals)
+    time = time[keep]
+    do_vals = do_vals[keep]
 
+    fit = {'popt': 0, 'fit_type': "none", 'nfev': 0, 'start': "guess", 'bounded': False}
     try:
-        popt, _ = curve_fit(exp_func, time, do_vals)
-        fit_type = "curve"
+        if len(time) < 4 or time[-1] <= time[0]:
+            raise ValueError(f"{len(time)} samples are not enough for a curve fit")
+        lower = [-np.inf, 0.05 / (time[-1] - time[0]), -np.inf]
+        upper = [np.inf, 10 * sample_hz, np.inf]
+        residual = lambda p: exp_func(time, *p) - do_vals
+        jacobian = lambda p: exp_jacobian(time, *p)
+
+        guess = np.clip(exp_initial_guess(time, do_vals), lower, upper)
+        if p0 is not None:
+            p0 = np.clip(np.asarray(p0, dtype=float), lower, upper)
+            if np.all(np.isfinite(p0)) and np.sum(residual(p0) ** 2) < np.sum(residual(guess) ** 2):
+                guess = p0
+                fit['start'] = "warm"
+
+        popt, _, info, message, status = leastsq(residual, guess, Dfun=jacobian, full_output=True, maxfev=50)
+        fit['nfev'] = info['nfev']
+        if status not in (1, 2, 3, 4) or not np.all(np.isfinite(popt)) or not (lower[1] <= popt[1] <= upper[1]):
+            # usually drifting towards a line (b -> 0), refit inside the bounds.
+            # a and c are linear for a fixed b, only b needs a bounded search
+            result = minimize_scalar(lambda b: exp_linear_fit(time, do_vals, b)[1], bounds=(lower[1], upper[1]),
+                                     method="bounded")
+            fit['nfev'] += result.nfev
+            fit['bounded'] = True
+            if not result.success:
+                raise RuntimeError(result.message)
+            (a, c), _ = exp_linear_fit(time, do_vals, result.x)
+            popt = np.array([a, result.x, c])
+        fit['popt'] = popt
+        fit['fit_type'] = "curve"
 
     except Exception as e:
         logger.info("curve fit failed, defaulting to line of best fit")
         try:
-            popt = np.polyfit(time, do_vals, 1)
-            fit_type = "linear"
+            fit['popt'] = np.polyfit(time, do_vals, 1)
+            fit['fit_type'] = "linear"
         except Exception as e:
             logger.info("line of best fit failed, what did you do to the data?!\n %s", e)
-            fit_type = "none"
-            popt = 0
 
-    return popt, fit_type
+    fit['elapsed'] = perf_counter() - start_time
+    logger.debug(f"{fit['fit_type']} fit from {fit['start']}{' (bounded)' if fit['bounded'] else ''}, "
+                 f"{fit['nfev']} evaluations, {1000 * fit['elapsed']:.1f} ms")
+    return fit
+
+def calculate_do_fit(do_vals, max_time=30, sample_hz=1, time=None, p0=None):
+    '''
+    do_vals:   array of DO values (either mgl or percent sat)
+    max_time:  max time where DO values are still valid
+    sample_hz: samle frequency used to collect do_vals
+    time:      optional sample times in seconds, replaces index / sample_hz
+    p0:        optional curve parameters to start from (warm start)
+
+    return:
+    popt: optimization parameters for either curve fit or linear fit
+    fit_type: "curve" for curve fit or "linear" for linear fit
+    '''
+    fit = cached_fit_do(do_vals, max_time, sample_hz, time, p0)
+    return fit['popt'], fit['fit_type']
+
+
+FitCacheInfo = namedtuple("FitCacheInfo", ["hits", "misses", "maxsize", "currsize"])
+_fit_cache = OrderedDict()
+_fit_cache_lock = threading.Lock()
+_fit_cache_stats = [0, 0]
+
+def fit_key(do_vals, max_time=30, sample_hz=1, time=None):
+    '''
+    return: hash of the fit inputs, equal data gives the same key
+    '''
+    h = hashlib.blake2b(digest_size=16)
+    h.update(np.ascontiguousarray(do_vals, dtype=float).tobytes())
+    if time is not None:
+        h.update(b"time")
+        h.update(np.ascontiguousarray(time, dtype=float).tobytes())
+    h.update(repr((float(max_time), float(sample_hz))).encode())
+    return h.hexdigest()
+
+def cached_fit_do(do_vals, max_time=30, sample_hz=1, time=None, p0=None):
+    '''
+    fit_do looked up in an LRU cache keyed by fit_key, so the same dive is
+    only fitted once (pond processing, result screen, history). p0 is not
+    part of the key, it only changes where the fit starts.
+    Safe to call from the fit pool threads.
+    return: copy of the fit dict (see fit_do)
+    '''
+    key = fit_key(do_vals, max_time, sample_hz, time)
+    with _fit_cache_lock:
+        fit = _fit_cache.get(key)
+        if fit is not None:
+            _fit_cache.move_to_end(key)
+            _fit_cache_stats[0] += 1
+            return dict(fit)
+    fit = fit_do(do_vals, max_time, sample_hz, time, p0)
+    with _fit_cache_lock:
+        _fit_cache_stats[1] += 1
+        _fit_cache[key] = fit
+        while len(_fit_cache) > FIT_CACHE_SIZE:
+            _fit_cache.popitem(last=False)
+    return dict(fit)
+
+def fit_cache_info():
+    '''
+    return: FitCacheInfo (hits, misses, maxsize, currsize)
+    '''
+    with _fit_cache_lock:
+        return FitCacheInfo(_fit_cache_stats[0], _fit_cache_stats[1], FIT_CACHE_SIZE, len(_fit_cache))
 
 
 def generate_do(x, popt, fit_type):
@@ -156,14 +339,18 @@ def generate_do(x, popt, fit_type):
 
 def pressure_to_depth(p, init_p):
     '''
-    p: pressure at depth measurment
+    p: pressure at depth measurment (hPa, scalar or array)
     init_p: ambient air pressure
+    return: depth in inches, rounded to 0.1, float for scalar arguments
     '''
-    return round(10.197 / 25.4 * (p - init_p), 1)
+    depth = np.round(10.197 / 25.4 * (np.asarray(p, dtype=float) - init_p), 1)
+    return _scalar_or_array(depth)
 
 def depth_to_pressure(d, init_p=0):
     '''
-    d: depth in inches
+    d: depth in inches (scalar or array)
     init_p: ambient air pressure
+    return: pressure in hPa, rounded to 0.1, float for scalar arguments
     '''
-    return round(init_p + d * 25.4 / 10.197, 1)
\ No newline at end of file
+    pressure = np.round(init_p + np.asarray(d, dtype=float) * 25.4 / 10.197, 1)
+    return _scalar_or_array(pressure)
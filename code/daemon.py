@@ -0,0 +1,230 @@
+'''
+Headless acquisition daemon. Runs the same backend as the GUI (TruckSensor:
+BLE acquisition, dive processing, local persistence and firebase upload) on a
+Qt core event loop, without widgets or a display. Every pond result is
+accepted as measured, there is no result window to correct it.
+
+A small JSON status interface is served on localhost:
+
+    > python3 daemon.py --port 8765
+    > curl http://127.0.0.1:8765/status
+
+Use --simulate to run against ble_simulator.py instead of the radio and I2C bus.
+Simulated runs keep their results in a temporary folder and never upload them.
+'''
+import argparse
+import json
+import os
+import resource
+import signal
+import sys
+import tempfile
+import threading
+import time
+from datetime import datetime
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import logging
+from logging.handlers import RotatingFileHandler
+
+from PyQt5.QtCore import QCoreApplication, QObject, QTimer, QMutex
+
+from truck_sensor import TruckSensor
+from local_csv import load_local_csv, save_local_csv
+from log_filter import localOnlyFilter
+
+#init logger
+logger = logging.getLogger("daemon")
+
+
+class StatusHandler(BaseHTTPRequestHandler):
+    '''
+    GET /status returns the daemon status as JSON
+    '''
+    def do_GET(self):
+        if self.path.rstrip("/") not in ("", "/status"):
+            self.send_error(404)
+            return
+        body = json.dumps(self.server.daemon.status(), default=to_json).encode()
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        logger.debug("status request %s", format % args)
+
+
+def to_json(obj):
+    # numpy scalars and anything else json does not know
+    if hasattr(obj, "item"):
+        return obj.item()
+    return str(obj)
+
+
+class AcquisitionDaemon(QObject):
+    '''
+    Owns the TruckSensor and keeps a status snapshot for the status server.
+    The snapshot is written from the Qt thread and read from the server threads.
+    '''
+
+    def __init__(self, settings, calibration, ble_radio=None, sensors=None, parent=None, data_folder="", upload=True):
+        super().__init__(parent)
+        self.settings = settings
+        self.calibration = calibration
+        self.started = time.time()
+        self._lock = threading.Lock()
+        self._status = {
+            "state": "disconnected",
+            "state_time": self.started,
+            "underwater": False,
+            "ready": False,
+            "sensor": {},
+            "last_result": None,
+            "results": 0,
+        }
+
+        self.database_mutex = QMutex()
+        self.ble_mutex = QMutex()
+        self.thread = TruckSensor(
+            self.calibration, self.settings, self.database_mutex, self.ble_mutex,
+            ble_radio=ble_radio, sensors=sensors, data_folder=data_folder, upload=upload
+        )
+        self.thread.unit = self.settings.get("unit", "mgl")
+        self.thread.update_data.connect(self.on_data_update)
+        self.thread.state_changed.connect(self.on_state_changed)
+        self.thread.sensor_underwater.connect(self.on_underwater_signal)
+        self.thread.update_pond_data.connect(self.on_update_pond_data)
+        self.thread.calibration_data.connect(self.on_calibration_available)
+        self.thread.dwell_ready.connect(self.on_dwell_ready)
+        self.server = None
+
+    def start(self, port):
+        self.thread.start()
+        if port:
+            self.server = ThreadingHTTPServer(("127.0.0.1", port), StatusHandler)
+            self.server.daemon = self
+            self.server.daemon_threads = True
+            threading.Thread(target=self.server.serve_forever, name="status", daemon=True).start()
+            logger.info(f"status on http://127.0.0.1:{port}/status")
+
+    def stop(self):
+        if self.server is not None:
+            self.server.shutdown()
+            self.server.server_close()
+        self.thread.abort()
+        self.thread.sensors.abort()
+        self.thread.firebase_worker.abort()
+        self.thread.wait()
+        self.thread.sensors.wait()
+        self.thread.firebase_worker.wait()
+        logger.info("daemon stopped")
+
+    def on_data_update(self, data_dict):
+        with self._lock:
+            self._status["sensor"].update(data_dict)
+
+    def on_state_changed(self, previous, state, state_time):
+        with self._lock:
+            self._status["state"] = state
+            self._status["state_time"] = state_time
+
+    def on_underwater_signal(self, value):
+        with self._lock:
+            self._status["underwater"] = value
+            self._status["ready"] = False
+        logger.info("collecting data" if value else "collection stopped")
+
+    def on_dwell_ready(self, seconds, do_mgl):
+        with self._lock:
+            self._status["ready"] = True
+        logger.info(f"ready to pick up after {seconds:.0f} s")
+
+    def on_update_pond_data(self, sdata):
+        # no operator to confirm the pond id, store the result as measured
+        self.thread.update_database(sdata)
+        with self._lock:
+            self._status["last_result"] = sdata.scalars()
+            self._status["results"] += 1
+        logger.info(f"pond {sdata['pid']} do {sdata['do_mgl']:.2f} mg/l ysi {sdata['ysi_do_mgl']:.2f} mg/l saved")
+
+    def on_calibration_available(self, data):
+        for key in data:
+            self.calibration[key] = data[key]
+        save_local_csv(self.calibration, "calibration.csv")
+
+    def status(self):
+        '''
+        return: JSON ready status snapshot, safe to call from any thread
+        '''
+        with self._lock:
+            status = dict(self._status)
+            status["sensor"] = dict(self._status["sensor"])
+        status["uptime"] = time.time() - self.started
+        status.update(self.thread.firebase_worker.upload_status())
+        # kilobytes on linux
+        status["max_rss_kb"] = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        status["time"] = datetime.now().isoformat(timespec="seconds")
+        return status
+
+
+def init_logging(debug):
+    level = logging.DEBUG if debug else logging.INFO
+    formatter = logging.Formatter("%(asctime)s %(name)s %(levelname)s: %(message)s")
+    # same rotating log file as the gui
+    fileHandler = RotatingFileHandler("log.log", mode="a", maxBytes=5 * 1024 * 1024, backupCount=3)
+    consoleHandler = logging.StreamHandler()
+    localFilter = localOnlyFilter()
+    for handler in (fileHandler, consoleHandler):
+        handler.setFormatter(formatter)
+        handler.setLevel(level)
+        handler.addFilter(localFilter)
+        logging.getLogger().addHandler(handler)
+    logging.getLogger().setLevel(level)
+
+
+def main():
+    parser = argparse.ArgumentParser(prog="daemon", description="headless DO acquisition")
+    parser.add_argument("--port", type=int, default=8765, help="localhost status port, 0 disables it")
+    parser.add_argument("-debug", "-d", "-D", "--debug", dest="debug", action="store_true")
+    parser.add_argument("--simulate", action="store_true", help="use the BLE simulator instead of the hardware")
+    parser.add_argument("--dives", type=int, default=None, help="simulated dives (default: endless)")
+    args = parser.parse_args()
+
+    init_logging(args.debug)
+    logger.info("\nSTARTING DAEMON")
+    app = QCoreApplication(sys.argv)
+
+    settings = load_local_csv("settings.csv")
+    calibration = load_local_csv("calibration.csv")
+    settings.setdefault("depth_threshold", 6.0)
+
+    ble_radio = sensors = None
+    data_folder, upload = "", True
+    if args.simulate:
+        from ble_simulator import SimulatedSensor, SimulatedBLERadio, SimulatedI2CReader
+        sensor = SimulatedSensor(dives=args.dives)
+        ble_radio = SimulatedBLERadio(sensor)
+        sensors = SimulatedI2CReader(sensor)
+        # simulated dives never reach the truck's data or firebase
+        data_folder, upload = tempfile.mkdtemp(prefix="haucs_simulate_"), False
+    else:
+        os.popen("sudo hciconfig hci0 reset")
+
+    daemon = AcquisitionDaemon(settings, calibration, ble_radio, sensors, data_folder=data_folder, upload=upload)
+    daemon.start(args.port)
+
+    # python signal handlers only run between bytecodes, keep the interpreter ticking
+    signal.signal(signal.SIGINT, lambda *_: app.quit())
+    signal.signal(signal.SIGTERM, lambda *_: app.quit())
+    tick = QTimer()
+    tick.timeout.connect(lambda: None)
+    tick.start(500)
+
+    app.exec_()
+    daemon.stop()
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
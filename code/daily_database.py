@@ -0,0 +1,110 @@
+import os
+import csv
+import time
+import logging
+
+#init logger
+logger = logging.getLogger(__name__)
+
+
+class DailyDatabase:
+    '''
+    Append-only writer for the daily database csv (<folder>/<prefix>_<date>.csv).
+    The header is written once when a day's file is created, every row after
+    that is a single append to the open file, so a write costs the same at row
+    500 as at row 1. Upload status changes are not written into the csv, they
+    go to a status journal next to it (<prefix>_<date>.uploads, one
+    "message_time,upload time" line per uploaded session). Recovery reads the
+    journal to skip sessions whose upload the session store did not record.
+
+    Not thread safe, callers hold the database mutex (shared with the history window).
+    '''
+    fsync_rows = 1      # fsync after this many rows (1: every row, 0: leave it to the OS)
+
+    def __init__(self, folder, prefix="iamtruck"):
+        self.folder = folder
+        self.prefix = prefix
+        self.date = None
+        self.file = None
+        self.writer = None
+        self.unsynced = 0
+
+    def path(self, date_str, extension="csv"):
+        '''
+        date_str: %Y-%m-%d
+        '''
+        return os.path.join(self.folder, f"{self.prefix}_{date_str}.{extension}")
+
+    def _open(self, date_str, fieldnames):
+        self.close()
+        os.makedirs(self.folder, exist_ok=True)
+        file_path = self.path(date_str)
+        header = None
+        if os.path.exists(file_path) and os.path.getsize(file_path) > 0:
+            with open(file_path, newline="") as file:
+                header = next(csv.reader(file), None)
+            with open(file_path, "rb") as file:
+                file.seek(-1, os.SEEK_END)
+                complete = file.read(1) == b"\n"
+        self.file = open(file_path, "a", newline="")
+        if header:
+            if not complete:
+                # last row cut off (power loss), start on a new line
+                self.file.write("\n")
+            # keep the columns of the existing file (older files have an "upload status" column)
+            self.writer = csv.DictWriter(self.file, fieldnames=header, restval="", extrasaction="ignore")
+        else:
+            self.writer = csv.DictWriter(self.file, fieldnames=list(fieldnames))
+            self.writer.writeheader()
+        self.date = date_str
+        logger.info(f"appending to {file_path}")
+
+    def _sync(self, file):
+        file.flush()
+        self.unsynced += 1
+        if self.fsync_rows and self.unsynced >= self.fsync_rows:
+            os.fsync(file.fileno())
+            self.unsynced = 0
+
+    def append(self, row, date_str):
+        '''
+        Appends one row to the day's csv, opens (and creates) the file on a new day
+        row:      dict, see session.database_row
+        date_str: %Y-%m-%d
+        '''
+        if self.file is None or date_str != self.date:
+            self._open(date_str, row.keys())
+        self.writer.writerow(row)
+        self._sync(self.file)
+
+    def mark_uploaded(self, message_times, date_str):
+        '''
+        Records completed uploads in the day's status journal
+        message_times: session message_time of each upload, the row key
+        date_str:      %Y-%m-%d of the rows
+        '''
+        os.makedirs(self.folder, exist_ok=True)
+        now = time.time()
+        with open(self.path(date_str, "uploads"), "a") as journal:
+            journal.writelines(f"{message_time},{now:.0f}\n" for message_time in message_times)
+            self._sync(journal)
+
+    def uploaded(self, date_str):
+        '''
+        return: message_times of the day's rows that have been uploaded
+        '''
+        file_path = self.path(date_str, "uploads")
+        if not os.path.exists(file_path):
+            return set()
+        with open(file_path) as journal:
+            return {line.split(",", 1)[0] for line in journal if line.strip()}
+
+    def close(self):
+        if self.file is not None:
+            self.file.flush()
+            os.fsync(self.file.fileno())
+            self.file.close()
+        self.file = None
+        self.writer = None
+        self.date = None
+        self.unsynced = 0
@@ -0,0 +1,73 @@
+import threading
+import numpy as np
+from PyQt5.QtCore import QObject, QTimer, pyqtSignal
+import logging
+
+#init logger
+logger = logging.getLogger(__name__)
+
+class DisplayChannel(QObject):
+    '''
+    Coalesced, diff-only display updates from worker threads.
+    publish() is thread safe and only queues values. A timer on the thread that
+    created the channel (the GUI thread) delivers everything published since
+    the last tick as one dict, keeping only fields whose value changed since
+    they were last delivered. Arrays are never sent to the display.
+    '''
+    updated = pyqtSignal(dict)
+
+    # fields the display reads together, a change to one delivers the whole group
+    groups = (
+        ('do', 'do_mgl'),
+        ('ysi_do', 'ysi_do_mgl'),
+        ('battv', 'batt_status'),
+        ('hdg', 'hdg_type', 'nsat', 'lat', 'lng'),
+    )
+
+    def __init__(self, rate_hz=5, parent=None):
+        '''
+        rate_hz: maximum number of deliveries per second
+        '''
+        super().__init__(parent)
+        self._lock = threading.Lock()
+        self._pending = {}
+        self._forced = set()
+        self._delivered = {}
+        self.deliveries = 0
+        self.timer = QTimer(self)
+        self.timer.setInterval(int(1000 / rate_hz))
+        self.timer.timeout.connect(self.flush)
+        self.timer.start()
+
+    def publish(self, data, force=False):
+        '''
+        Queues data for the next delivery, later values replace earlier ones.
+        force: deliver these fields even if unchanged (e.g. to redraw in a new unit)
+        '''
+        with self._lock:
+            for key, value in data.items():
+                if isinstance(value, np.ndarray):
+                    continue
+                self._pending[key] = value
+                if force:
+                    self._forced.add(key)
+
+    def flush(self):
+        with self._lock:
+            pending, self._pending = self._pending, {}
+            forced, self._forced = self._forced, set()
+        if not pending:
+            return
+        changes = {key: value for key, value in pending.items()
+                   if key in forced or key not in self._delivered or self._delivered[key] != value}
+        if not changes:
+            return
+        self._delivered.update(changes)
+        # complete groups from the last delivered values
+        for group in self.groups:
+            if any(key in changes for key in group):
+                for key in group:
+                    if key not in changes and key in self._delivered:
+                        changes[key] = self._delivered[key]
+        self.deliveries += 1
+        self.updated.emit(changes)
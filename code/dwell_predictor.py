@@ -0,0 +1,92 @@
+import numpy as np
+from converter import fit_do, generate_do
+import logging
+
+#init logger
+logger = logging.getLogger(__name__)
+
+class DwellPredictor:
+    '''
+    Streaming estimate of when a dive has collected enough data.
+    Fed with the live YSI samples of a dive, refits the exponential approach
+    after every sample (warm started from the previous fit) and predicts the
+    DO at record_time, the value the result screen will report. The dive is
+    ready once the last predictions agree within tolerance and the fit has
+    seen enough of the curve to trust them.
+    '''
+    tolerance = 0.1     # mg/l, spread of the predictions in the stability window
+    stable_time = 3.0   # seconds the predictions must stay within tolerance
+    min_time = 8.0      # seconds underwater before ready can be signalled
+    time_constants = 2  # the dive must have lasted this many fitted time constants
+
+    def __init__(self, record_time=30, sample_hz=1):
+        '''
+        record_time: seconds the result is extrapolated to, ready at the latest then
+        sample_hz:   expected YSI sample rate, bounds the fitted time constant
+        '''
+        self.record_time = record_time
+        self.sample_hz = sample_hz
+        self.reset()
+
+    def reset(self):
+        '''
+        Starts a new dive
+        '''
+        self.times = []
+        self.values = []
+        self.predictions = []   # (time, predicted DO at record_time)
+        self.popt = None
+        self.ready_time = None
+
+    @property
+    def ready(self):
+        return self.ready_time is not None
+
+    def add(self, t, do_mgl):
+        '''
+        t:      seconds since the dive started
+        do_mgl: YSI sample
+        return: True for the sample that makes the dive ready, otherwise False
+        '''
+        return self.extend([(t, do_mgl)])
+
+    def extend(self, samples):
+        '''
+        Adds the samples that arrived since the last call and refits once.
+        samples: (t, do_mgl) pairs in time order, see add
+        return: True for the call that makes the dive ready, otherwise False
+        '''
+        if self.ready:
+            return False
+        count = len(self.times)
+        for t, do_mgl in samples:
+            if np.isfinite(do_mgl):
+                self.times.append(t)
+                self.values.append(do_mgl)
+        if len(self.times) == count or len(self.times) < 4:
+            return False
+        t = self.times[-1]
+
+        fit = fit_do(self.values, self.record_time, self.sample_hz, self.times, self.popt)
+        if fit['fit_type'] != "curve":
+            return False
+        self.popt = fit['popt']
+        prediction = float(generate_do(self.record_time, fit['popt'], fit['fit_type']))
+        self.predictions.append((t, prediction))
+
+        if t < self.min_time or t < self.time_constants / self.popt[1]:
+            return False
+        recent = [p for pt, p in self.predictions if pt >= t - self.stable_time]
+        # the window has to be covered, not just the latest prediction
+        if self.predictions[0][0] > t - self.stable_time or max(recent) - min(recent) > self.tolerance:
+            return False
+        self.ready_time = t
+        logger.info(f"ready after {t:.1f} s, predicted {prediction:.2f} mg/l")
+        return True
+
+    @property
+    def prediction(self):
+        '''
+        return: latest predicted DO at record_time, None before the first fit
+        '''
+        return self.predictions[-1][1] if self.predictions else None
@@ -1,19 +1,28 @@
 from queue import Queue, Empty
 import os
+import json
+import random
+import socket
+import time
+from urllib.parse import urlparse
 import firebase_admin
 from firebase_admin import credentials, db
 import concurrent.futures
-from PyQt5.QtCore import QThread, pyqtSignal, QObject, QMutex, QMutexLocker
-import pandas as pd
+from PyQt5.QtCore import QThread, pyqtSignal, QObject, QMutex, QMutexLocker, QWaitCondition
 from datetime import datetime
 import numpy as np
 import shutil
-import pickle
 import logging
+from session import Session
+from daily_database import DailyDatabase
+from session_store import SessionStore
 
 #init logger
 logger = logging.getLogger(__name__)
 
+# uploaded in place of corrupted samples, outside the range of DO, temperature and pressure
+MISSING_SAMPLE = -1.0
+
 def convert_numpy(obj):
     if isinstance(obj, np.generic):
         return obj.item()
@@ -24,6 +33,14 @@ def convert_numpy(obj):
     else:
         return obj
 
+def upload_date(message_time):
+    '''
+    message_time: GMT %Y%m%d_%H:%M:%S
+    return: %Y-%m-%d, the date the upload journal files the session under
+    '''
+    return datetime.strptime(message_time.split("_")[0], "%Y%m%d").strftime("%Y-%m-%d")
+
+
 class FirebaseWorker(QThread):
 
     app = None
@@ -31,24 +48,50 @@ class FirebaseWorker(QThread):
     fail_counter = 0
 
     max_fail = 30
+    max_batch_bytes = 1000000   # json size of one multi-path update
+    max_batch_sessions = 100
+    retry_min = 2       # seconds, first retry after a failed upload
+    retry_max = 300     # seconds, backoff limit
+    probe_timeout = 3   # seconds, reachability check
+    database_url = 'https://haucs-monitoring-default-rtdb.firebaseio.com'
     fb_key="fb_key.json"
     database_folder = "database_truck"
+    store_file = "sessions.db"
     unsaved_folder = "unsaved"
     completed_folder = "completed"
-    sdatas = []
 
-    def __init__(self, database_mutex):
+    def __init__(self, database_mutex, data_folder="", upload=True):
+        '''
+        data_folder: folder of the daily database, session store and pickles (default: working directory)
+        upload:      False keeps every session local, firebase is not initialized
+        '''
         super().__init__()
         self._abort = False
+        self.sdatas = []
+        # upload scheduling, woken by add_sdata and abort
+        self.wake_mutex = QMutex()
+        self.wake_condition = QWaitCondition()
+        self.wake_pending = False
+        self.failures = 0
+        self.last_success = None
+        self.next_attempt = None
         logger.info("starting firebase worker")
         self.database_mutex = database_mutex
-        self.init_firebase() #TODO unecessary function
+        self.upload = upload
+        self.unsaved_folder = os.path.join(data_folder, self.unsaved_folder)
+        self.completed_folder = os.path.join(data_folder, self.completed_folder)
+        self.database = DailyDatabase(os.path.join(data_folder, self.database_folder))
+        self.store = SessionStore(os.path.join(data_folder, self.store_file))
+        if upload:
+            self.init_firebase() #TODO unecessary function
+        else:
+            logger.info(f"uploads disabled, sessions stay in {os.path.abspath(data_folder)}")
 
     def init_firebase(self):
         try:
             if os.path.exists(self.fb_key):
                 self.cred = credentials.Certificate(self.fb_key)
-                self.app = firebase_admin.initialize_app(self.cred, {'databaseURL': 'https://haucs-monitoring-default-rtdb.firebaseio.com'})
+                self.app = firebase_admin.initialize_app(self.cred, {'databaseURL': self.database_url})
             else:
                 logger.error('firebase initialization failed bc no fb_key found')
         except Exception as error:
@@ -62,8 +105,7 @@ class FirebaseWorker(QThread):
         if os.path.exists(self.fb_key) and self.cred is None:
             self.cred = credentials.Certificate(self.fb_key)
         if self.cred is not None:
-            new_app = firebase_admin.initialize_app(self.cred,
-                                                {'databaseURL': 'https://haucs-monitoring-default-rtdb.firebaseio.com'})
+            new_app = firebase_admin.initialize_app(self.cred, {'databaseURL': self.database_url})
             return new_app
         return None
 
@@ -71,23 +113,20 @@ class FirebaseWorker(QThread):
 
     def add_sdata(self, sdata, row):
         today_str = datetime.now().strftime("%Y-%m-%d")
-        folder = self.database_folder
-        os.makedirs(folder, exist_ok=True)
-        file_path = os.path.join(folder, f"iamtruck_{today_str}.csv")
-        # lock access to database folder
+        try:
+            self.store.add(sdata, today_str, row['time'])
+        except Exception as e:
+            # the pickle is imported into the store on the next start
+            logger.error("could not store session %s", e)
+        # daily csv export, lock access to database folder
         with QMutexLocker(self.database_mutex):
             try:
-                # random csv stuff
-                if os.path.exists(file_path):
-                    df = pd.read_csv(file_path)
-                    df = pd.concat([df, pd.DataFrame([row])], ignore_index=True)
-                else:
-                    df = pd.DataFrame([row]) 
-                df.to_csv(file_path, index=False)
+                self.database.append(row, today_str)
             except Exception as e:
                 logger.info("could not append to local database file %s", e)
 
         self.save_data_pickle(sdata)
+        self.wakeup()
 
     def save_data_pickle(self, sdata):
 
@@ -98,7 +137,7 @@ class FirebaseWorker(QThread):
 
         os.makedirs(self.unsaved_folder, exist_ok=True)
         with open(file_path, 'wb') as file:
-            pickle.dump(sdata, file)
+            sdata.save(file)
         
         logger.info(f"saved pickle: {file_path}")
 
@@ -117,65 +156,192 @@ class FirebaseWorker(QThread):
             logger.error(f"Failed to move pickle: {src_path} → {dst_path} — {e}")
     
 
-    def run(self):
-        folder = self.unsaved_folder
-        if not os.path.exists(folder):
+    def recover(self):
+        '''
+        Queues the sessions that were not uploaded before the last shutdown.
+        Pickles missing from the store (saved before the store existed) are imported first.
+        Sessions in the upload journal of the daily database were uploaded although
+        the store missed it (e.g. power loss between the two updates), they are
+        marked uploaded instead of being sent again.
+        '''
+        try:
+            self.store.import_pickles(self.unsaved_folder, uploaded=False)
+            self.store.import_pickles(self.completed_folder, uploaded=True)
+            queued = {sdata['message_time'] for sdata in self.sdatas}
+            pending = [sdata for sdata in self.store.pending() if sdata['message_time'] not in queued]
+            journal = {}
+            with QMutexLocker(self.database_mutex):
+                for date_str in {upload_date(sdata['message_time']) for sdata in pending}:
+                    journal[date_str] = self.database.uploaded(date_str)
+            uploaded = [sdata for sdata in pending if sdata['message_time'] in journal[upload_date(sdata['message_time'])]]
+            if uploaded:
+                self.store.mark_uploaded([sdata['message_time'] for sdata in uploaded])
+                for sdata in uploaded:
+                    self.move_pickle_to_completed(sdata)
+                logger.info(f"{len(uploaded)} sessions were uploaded before the last shutdown")
+                done = {sdata['message_time'] for sdata in uploaded}
+                pending = [sdata for sdata in pending if sdata['message_time'] not in done]
+        except Exception as e:
+            logger.error(f"session store recovery failed: {e}")
             return
+        self.sdatas[:0] = pending
+        logger.info(f"{len(pending)} sessions waiting for upload")
 
-        files = [f for f in os.listdir(folder) if f.endswith(".pickle")]
-        for filename in files:
-
-            file_path = os.path.join(folder, filename)
-            with open(file_path, 'rb') as file:
-                sdata = pickle.load(file)
-
-            self.sdatas.append(sdata)
+    def run(self):
+        self.recover()
 
         while not self._abort:
-            self.update_firebase_when_internet()
+            delay = self.upload_pending()
             if self._abort:
                 break
-            self.msleep(2000)
+            self.wait_for_work(delay)
+
+        with QMutexLocker(self.database_mutex):
+            self.database.close()
+        self.store.close()
 
     def abort(self):
         self._abort = True
+        self.wakeup()
+
+    def wakeup(self):
+        '''
+        Starts an upload attempt now, also ends a backoff wait
+        '''
+        with QMutexLocker(self.wake_mutex):
+            self.wake_pending = True
+            self.wake_condition.wakeAll()
+
+    def wait_for_work(self, delay):
+        '''
+        delay: seconds until the next attempt, None to wait for new sessions
+        '''
+        self.next_attempt = None if delay is None else time.time() + delay
+        with QMutexLocker(self.wake_mutex):
+            if not self.wake_pending:
+                if delay is None:
+                    self.wake_condition.wait(self.wake_mutex)
+                else:
+                    self.wake_condition.wait(self.wake_mutex, int(1000 * delay))
+            self.wake_pending = False
+        self.next_attempt = None
+
+    def upload_pending(self):
+        '''
+        One upload attempt of the queued sessions
+        return: seconds until the next attempt (backoff), None if there is nothing left to retry
+        '''
+        if not self.sdatas or not self.upload:
+            return None
+        if not self.reachable():
+            logger.debug("firebase unreachable, %d sessions waiting", len(self.sdatas))
+            return self.backoff()
+        if not self.update_firebase_when_internet():
+            return self.backoff()
+        self.failures = 0
+        self.last_success = time.time()
+        return None
+
+    def reachable(self):
+        '''
+        return: True if a tcp connection to the database host opens (no TLS handshake)
+        '''
+        try:
+            socket.create_connection((urlparse(self.database_url).hostname, 443), timeout=self.probe_timeout).close()
+            return True
+        except OSError:
+            return False
+
+    def backoff(self):
+        '''
+        return: exponential retry delay with jitter (seconds)
+        '''
+        self.failures += 1
+        delay = min(self.retry_max, self.retry_min * 2 ** (self.failures - 1))
+        return random.uniform(delay / 2, delay)
+
+    def upload_status(self):
+        '''
+        return: queue depth, time of the last successful upload (None before the
+                first), consecutive failed attempts and time of the next retry
+                (None if waiting for new sessions)
+        '''
+        return {
+            "upload_queue": len(self.sdatas),
+            "last_upload": self.last_success,
+            "upload_failures": self.failures,
+            "next_upload": self.next_attempt,
+        }
 
     def update_firebase_when_internet(self):
-        for i in reversed(range(len(self.sdatas))):
-            sdata = self.sdatas[i]
-
-            upload_status = self.update_firebase(sdata)
-            if upload_status:
-  
-                self.move_pickle_to_completed(sdata)
-
-                logger.info('data upload to firebase complete')
-                del self.sdatas[i]
-
-                # lock access to database folder
-                with QMutexLocker(self.database_mutex):
-                    try:
-                        msg_time_str = sdata['message_time']
-                        msg_date = datetime.strptime(msg_time_str.split("_")[0], "%Y%m%d").strftime("%Y-%m-%d")
-                        file_path = os.path.join(self.database_folder, f"iamtruck_{msg_date}.csv")
-                        if os.path.exists(file_path):
-                            df = pd.read_csv(file_path)
-
-                            match_index = df[df["message_time"] == msg_time_str].index
-
-                            if not match_index.empty:
-                                df.loc[match_index, "upload status"] = True
-                                df.to_csv(file_path, index=False)
-                        
-                    except Exception as e:
-                        logger.warning('failed to update csv')
-
-    def update_firebase(self, sdata):
-        
+        '''
+        return: True if every batch was uploaded
+        '''
+        # newest sessions first
+        pending = list(reversed(self.sdatas))
+        for batch in self.upload_batches(pending):
+            if not self.update_firebase({path: data for _, path, data in batch}):
+                # the rest is retried after the backoff
+                return False
+            self.complete_uploads([sdata for sdata, _, _ in batch])
+        return True
+
+    def upload_batches(self, sdatas):
+        '''
+        Groups sessions into multi-path updates of at most max_batch_sessions
+        sessions and max_batch_bytes of json (a larger session goes alone)
+        return: generator of lists of (sdata, path, upload data)
+        '''
+        batch, size = [], 0
+        for sdata in sdatas:
+            try:
+                path, data = self.firebase_payload(sdata)
+            except Exception as e:
+                logger.warning(f"session {sdata.get('message_time')} cannot be uploaded: {e}")
+                continue
+            data_size = len(json.dumps(data))
+            if batch and (len(batch) >= self.max_batch_sessions or size + data_size > self.max_batch_bytes):
+                yield batch
+                batch, size = [], 0
+            batch.append((sdata, path, data))
+            size += data_size
+        if batch:
+            yield batch
+
+    def complete_uploads(self, sdatas):
+        '''
+        Marks a batch of uploaded sessions complete and drops them from the queue
+        '''
+        message_times = [sdata['message_time'] for sdata in sdatas]
+        try:
+            self.store.mark_uploaded(message_times)
+        except Exception as e:
+            logger.error(f"could not mark {len(message_times)} sessions uploaded: {e}")
+        for sdata in sdatas:
+            self.move_pickle_to_completed(sdata)
+            self.sdatas.remove(sdata)
+        logger.info(f'data upload to firebase complete, {len(sdatas)} sessions')
+
+        by_date = {}
+        for msg_time_str in message_times:
+            by_date.setdefault(upload_date(msg_time_str), []).append(msg_time_str)
+        # lock access to database folder
+        with QMutexLocker(self.database_mutex):
+            try:
+                for msg_date, times in by_date.items():
+                    self.database.mark_uploaded(times, msg_date)
+            except Exception as e:
+                logger.warning('failed to update upload status %s', e)
+
+    def firebase_payload(self, sdata):
+        '''
+        return: database path (below LH_Farm) and upload data of a session
+        '''
         # copy relevant information to firebase
         upload_data = {}
         upload_data['do'] = sdata['do_vals']
-        upload_data['ysi_do_mgl'] = sdata['ysi_do_mgl_arr']
+        # the YSI capture as received, what the website has always been sent under this key
+        upload_data['ysi_do_mgl'] = sdata['ysi_raw_mgl_arr']
         upload_data['heading'] = sdata['hdg']
         upload_data['init_do'] = 1 #hardcoded to handle legacy website
         upload_data['init_pressure'] = sdata['init_pressure']
@@ -188,11 +354,17 @@ class FirebaseWorker(QThread):
         upload_data['type'] = 'rpi_truck' #hardcoded truck type
         upload_data['sample_hz'] = sdata['sample_hz']
         upload_data['sensor_battv'] = sdata['battv']
-        upload_data = clean_for_firebase(upload_data)
-
+        return 'pond_' + sdata['pid'] + '/' + sdata['message_time'], clean_for_firebase(upload_data)
+
+    def update_firebase(self, payload):
+        '''
+        Writes a batch in one multi-path update, all sessions are written or none
+        payload: {path below LH_Farm: upload data}
+        return:  True if the batch is uploaded
+        '''
         try:
             if self.app is not None:
-                db.reference('LH_Farm/pond_' + sdata['pid'] + '/' + sdata['message_time'] + '/').set(upload_data)
+                db.reference('LH_Farm').update(payload)
             else:
                 return False
         except Exception as error:
@@ -203,11 +375,21 @@ class FirebaseWorker(QThread):
                 self.fail_counter = 0
             return False
         return True
-    
+
 
 def clean_for_firebase(data):
+    '''
+    Converts numpy values to json types. Corrupted samples (NaN) are uploaded as
+    MISSING_SAMPLE: json has no NaN, and a null inside a list makes the Realtime
+    Database store the list as an object with the null indices missing. The
+    samples are not dropped, the arrays keep their length and index / sample_hz
+    time base.
+    '''
     for key in data:
-        val = data[key]
-        if isinstance(val, np.ndarray):
-            val = val.tolist()
+        val = convert_numpy(data[key])
+        if isinstance(val, list):
+            val = [MISSING_SAMPLE if isinstance(v, float) and not np.isfinite(v) else v for v in val]
+        elif isinstance(val, float) and not np.isfinite(val):
+            val = MISSING_SAMPLE
+        data[key] = val
     return data
\ No newline at end of file
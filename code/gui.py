@@ -17,7 +17,6 @@ import sys
 from result_window import ResultWindow
 import os
 import time
-import csv
 from truck_sensor import TruckSensor, Mode
 from datetime import datetime
 from custom_widgets.battery_widget import BatteryWidget
@@ -30,7 +29,9 @@ from history_window import HistoryLogWindow
 from setting_dialog import SettingDialog
 
 from ysi_calibration import YsiCalibrationWindow
-import pickle
+from session import Session
+from local_csv import load_local_csv, save_local_csv
+from log_filter import localOnlyFilter
 import logging
 from logging.handlers import RotatingFileHandler
 import queue
@@ -121,6 +122,12 @@ class DOApp(QWidget):
         self.label_font_xlarge = int(screen_size.height() * 0.14)
         self.status_font = int(screen_size.height() * 0.08)
         self.unit_font = int(screen_size.height() * 0.05)
+        # DO label styles, built once and applied only when the color changes
+        self.do_styles = {
+            color: f"font-size: {self.label_font_xlarge}px; font-weight: bold; color: {color};"
+            for color in ("red", "yellow", "limegreen")
+        }
+        self.label_colors = {}
 
         # retrieve and apply settings
         self.settings = self.load_local_csv("settings.csv")
@@ -138,6 +145,7 @@ class DOApp(QWidget):
 
         # setup timer for timer Qlabel
         self.counter_time = 0
+        self.dwell_ready = False
         self.timer = QTimer()
         self.timer.setInterval(1000)
         self.timer.timeout.connect(self.on_counter)
@@ -153,6 +161,7 @@ class DOApp(QWidget):
         self.thread.sensor_underwater.connect(self.on_underwater_signal)
         self.thread.ysi_data.connect(self.on_ysi_update)
         self.thread.calibration_data.connect(self.on_calibration_available)
+        self.thread.dwell_ready.connect(self.on_dwell_ready)
         self.thread.start()
 
     def setup_ui(self):
@@ -410,6 +419,10 @@ class DOApp(QWidget):
         self.save_local_csv(self.calibration, "calibration.csv")
 
     def on_data_update(self, data_dict):
+        """
+        data_dict only holds fields that changed, grouped fields (see
+        DisplayChannel.groups) always arrive together.
+        """
         if "battv" in data_dict:
             batt_percent = int(
                 (data_dict["battv"] - self.settings["min_battv"])
@@ -443,19 +456,7 @@ class DOApp(QWidget):
                 self.hboi_val.setText(f"{display_val:4.1f}")
                 self.hboi_unit.setText("mg/l")
             # update label color based on mgl value in setting.setting
-            do_val = data_dict["do_mgl"]
-            if do_val < self.min_do:
-                self.hboi_val.setStyleSheet(
-                    f"font-size: {self.label_font_xlarge}px; font-weight: bold; color: red;"
-                )
-            elif self.min_do <= do_val < self.good_do:
-                self.hboi_val.setStyleSheet(
-                    f"font-size: {self.label_font_xlarge}px; font-weight: bold; color: yellow;"
-                )
-            else:
-                self.hboi_val.setStyleSheet(
-                    f"font-size: {self.label_font_xlarge}px; font-weight: bold; color: limegreen;"
-                )
+            self.set_do_color(self.hboi_val, data_dict["do_mgl"])
         if "ysi_do" in data_dict:
             self.on_ysi_update(
                 do_ps=data_dict["ysi_do"], do_mgl=data_dict["ysi_do_mgl"], smooth=False
@@ -474,8 +475,9 @@ class DOApp(QWidget):
 
     def on_underwater_signal(self, value):
         # true if underwater, otherwise false
-        if value == "True":
+        if value:
             self.counter_time = 0
+            self.dwell_ready = False
             self.timer.start()
             self.timer_val.setText(f"{self.counter_time}")
             self.send_status("collecting data")
@@ -520,18 +522,22 @@ class DOApp(QWidget):
                 self.ysi_unit.setText("mg/l")
 
         # update ysi color
+        self.set_do_color(self.ysi_val, do_mgl)
+
+    def set_do_color(self, label, do_mgl):
+        """
+        Colors a DO label by the thresholds in settings, the stylesheet is
+        only replaced when the color changes (restyling forces a relayout).
+        """
         if do_mgl < self.min_do:
-            self.ysi_val.setStyleSheet(
-                f"font-size: {self.label_font_xlarge}px; font-weight: bold; color: red;"
-            )
+            color = "red"
         elif self.min_do <= do_mgl < self.good_do:
-            self.ysi_val.setStyleSheet(
-                f"font-size: {self.label_font_xlarge}px; font-weight: bold; color: yellow;"
-            )
+            color = "yellow"
         else:
-            self.ysi_val.setStyleSheet(
-                f"font-size: {self.label_font_xlarge}px; font-weight: bold; color: limegreen;"
-            )
+            color = "limegreen"
+        if self.label_colors.get(label) != color:
+            self.label_colors[label] = color
+            label.setStyleSheet(self.do_styles[color])
 
     def on_status_timer(self):
         msg = ""
@@ -594,11 +600,20 @@ class DOApp(QWidget):
                 except Exception as e2:
                     logger.info("failed to delete attribute result window %s", e2)
                     
-        if self.counter_time == 30:  # TODO: this should be exposed in settings.csv
+        # fallback if the dwell predictor did not call it earlier
+        if self.counter_time == 30 and not self.dwell_ready:  # TODO: this should be exposed in settings.csv
             self.send_status("ready to pick up")
 
         self.timer_val.setText(f"{self.counter_time}")
 
+    def on_dwell_ready(self, seconds, do_mgl):
+        """
+        The live YSI fit is stable, the sensor can come up before the 30 s counter.
+        """
+        if self.timer.isActive() and not self.dwell_ready:
+            self.dwell_ready = True
+            self.send_status("ready to pick up", "limegreen")
+
     def on_update_pond_data(self, data_dict):
         self.result_window = ResultWindow(
             data_dict,
@@ -653,7 +668,7 @@ class DOApp(QWidget):
 
     def on_history_log_click(self):
         self.history_window = HistoryLogWindow(
-            self.unit, self.min_do, self.good_do, self.database_mutex
+            self.unit, self.min_do, self.good_do, self.thread.firebase_worker.store
         )
 
     def on_calibrate_ysi_click(self):
@@ -702,64 +717,10 @@ class DOApp(QWidget):
             self.send_status("settings not saved")
 
     def save_local_csv(self, data_dict, filename):
-        with QMutexLocker(self.csv_mutex):
-            with open(filename, "w", newline="") as csvfile:
-                try:
-                    writer = csv.DictWriter(csvfile, fieldnames=["param", "value"])
-                    writer.writeheader()
-                    for key, value in data_dict.items():
-                        if isinstance(value, list):
-                            output = "$".join([str(i) for i in value])
-                        else:
-                            output = str(value)
-                        writer.writerow({"param": key, "value": output})
-                    logger.info(f"saved to {filename}")
-                except Exception as e:
-                    logger.warning("failed to save: %s", e)
-                    logger.debug("tried to save: %s", data_dict)
+        save_local_csv(data_dict, filename, self.csv_mutex)
 
     def load_local_csv(self, filename):
-        """
-        Loads data from local csv files containing setting and calibration info. Files
-        nested in folders not supported.
-
-        setting.csv:      settings for gui
-        calibration.csv:  calibration information
-        """
-        data_dict = {}
-        if os.path.exists(filename):
-            with QMutexLocker(self.csv_mutex):
-                with open(filename, newline="") as csvfile:
-                    reader = csv.DictReader(csvfile)
-                    for row in reader:
-                        key = row["param"]
-                        # split into mutliple values
-                        value = row["value"]
-                        value = value.split("$")
-                        # process single values
-                        if len(value) == 1:
-                            try:
-                                value = float(value[0])
-                            except:
-                                data_dict[key] = value[0]
-                        # process multiple values
-                        elif len(value) > 1:
-                            value_arr = []
-                            for val in value:
-                                try:
-                                    value_arr.append(float(val))
-                                except:
-                                    value_arr.append(val)
-                            data_dict[key] = value_arr
-                        try:
-                            value = float(row["value"])
-                        except:
-                            value = row["value"]
-                        data_dict[key] = value
-        else:
-            logger.warning("could not load %s", filename)
-
-        return data_dict
+        return load_local_csv(filename, self.csv_mutex)
 
     def closeEvent(self, event):
         dialog = ShutdownDialog(self)
@@ -781,7 +742,7 @@ class DOApp(QWidget):
             elif dialog.result == "test":
                 logger.info("sending test data to bring up results page")
                 with open("test.pickle", "rb") as file:
-                    fake_data = pickle.load(file)
+                    fake_data = Session.load(file)
 
                 fake_data["sample_duration"] = (
                     len(fake_data["do_vals"]) / fake_data["sample_hz"]
@@ -838,25 +799,6 @@ class DOApp(QWidget):
         self.debug_timer.start()
 
 
-class localOnlyFilter(logging.Filter):
-    names = [
-        "__main__",
-        "bt_sensor",
-        "converter",
-        "firebase_worker",
-        "gps_sensor",
-        "history_window",
-        "sensor",
-        "truck_sensor",
-        "result_window",
-        "bno055",
-        "ysi_calibration",
-    ]
-
-    def filter(self, record):
-        return record.name in self.names
-
-
 class customLogHandler(logging.Handler, QObject):
     log_message = pyqtSignal(str, str)
 
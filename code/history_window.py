@@ -1,4 +1,4 @@
-from PyQt5.QtCore import Qt, QMutex, QMutexLocker
+from PyQt5.QtCore import Qt
 from PyQt5.QtGui import QColor, QCursor
 from PyQt5.QtWidgets import (
     QWidget,
@@ -13,22 +13,23 @@ from PyQt5.QtWidgets import (
     QTableWidgetItem,
     QTableWidget,
 )
-import os, csv, re
 from datetime import datetime, timedelta
 from converter import *
 
 
 class HistoryLogWindow(QWidget):
 
-    def __init__(self, unit, min_do, good_do, database_mutex):
+    def __init__(self, unit, min_do, good_do, store):
+        '''
+        store: SessionStore, read without locking (WAL)
+        '''
         super().__init__()
         self.setWindowTitle("History Log")
         self.setAttribute(Qt.WA_DeleteOnClose)
-        self.database_mutex = database_mutex
+        self.store = store
         self.unit = unit
         self.min_do = min_do
         self.good_do = good_do
-        self.foldername = "database_truck"
 
         self.table = QTableWidget()
         self.table.setColumnCount(7)
@@ -81,7 +82,7 @@ class HistoryLogWindow(QWidget):
         layout.addLayout(button_layout)
         self.setLayout(layout)
 
-        self._load_data(self.foldername)
+        self._load_data()
         self.table.resizeColumnsToContents()
         for col in range(self.table.columnCount()):
             current_width = self.table.columnWidth(col)
@@ -90,68 +91,49 @@ class HistoryLogWindow(QWidget):
         self.setCursor(QCursor(Qt.BlankCursor))
         self.showFullScreen()
 
-    def get_target_files(self, foldername):
+    def get_target_dates(self):
         today = datetime.now().date()
         yesterday = today - timedelta(days=1)
-        target_dates = {today.isoformat(), yesterday.isoformat()}
-        filenames = []
+        return [today.isoformat(), yesterday.isoformat()]
 
-        pattern = re.compile(r".+_(\d{4}-\d{2}-\d{2})\.csv$")
-
-        if not os.path.exists(foldername):
-            os.makedirs(foldername)
-
-        for fname in os.listdir(foldername):
-            match = pattern.match(fname)
-            if match:
-                date_str = match.group(1)
-                if date_str in target_dates:
-                    filenames.append(os.path.join(foldername, fname))
-        return filenames
-
-    def _load_data(self, foldername):
+    def _load_data(self):
         rows = []
-        for fpath in self.get_target_files(foldername):
-            basename = os.path.basename(fpath)
-            date_str = basename.split("_")[-1].split(".")[0]
-            # lock access to database folder
-            with QMutexLocker(self.database_mutex):
-                with open(fpath, newline="") as csvfile:
-                    reader = csv.DictReader(csvfile)
-                    for row in reader:
-                        try:
-                            time_str = row["time"]
-                            pond_id = row["pond_id"]
-                            hboi = round(100 * float(row["hboi_do"]))
-                            hboi_mgl = float(row["hboi_do_mgl"])
-                            ysi = round(100 * float(row["ysi_do"]))
-                            ysi_mgl = float(row["ysi_do_mgl"])
-                            temp_c = float(row["temperature"])
-                            temp_f = round(to_fahrenheit(temp_c))
-                            depth = row["depth"]
-
-                            if self.unit == "percent":
-                                hboi_display = hboi
-                                ysi_display = ysi
-                            else:
-                                hboi_display = hboi_mgl
-                                ysi_display = ysi_mgl
-
-                            rows.append(
-                                (
-                                    date_str,
-                                    time_str,
-                                    pond_id,
-                                    hboi_display,
-                                    ysi_display,
-                                    hboi_mgl,
-                                    ysi_mgl,
-                                    temp_f,
-                                    depth,
-                                )
-                            )
-                        except:
-                            logger.warning("couldn't append history rows")
+        try:
+            records = self.store.history(self.get_target_dates())
+        except Exception as e:
+            logger.warning("couldn't read history %s", e)
+            records = []
+        for record in records:
+            try:
+                hboi = round(100 * record["hboi_do"])
+                hboi_mgl = round(record["hboi_do_mgl"], 2)
+                ysi = round(100 * record["ysi_do"])
+                ysi_mgl = round(record["ysi_do_mgl"], 2)
+                temp_f = round(to_fahrenheit(record["temperature"]))
+                depth = round(record["depth"], 2)
+
+                if self.unit == "percent":
+                    hboi_display = hboi
+                    ysi_display = ysi
+                else:
+                    hboi_display = hboi_mgl
+                    ysi_display = ysi_mgl
+
+                rows.append(
+                    (
+                        record["date"],
+                        record["time"],
+                        record["pond_id"],
+                        hboi_display,
+                        ysi_display,
+                        hboi_mgl,
+                        ysi_mgl,
+                        temp_f,
+                        depth,
+                    )
+                )
+            except:
+                logger.warning("couldn't append history rows")
 
         rows.sort(key=lambda x: (x[0], x[1]), reverse=True)
         self.table.setRowCount(len(rows))
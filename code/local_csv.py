@@ -0,0 +1,78 @@
+import os
+import csv
+import contextlib
+from PyQt5.QtCore import QMutexLocker
+import logging
+
+#init logger
+logger = logging.getLogger(__name__)
+
+
+def _locked(mutex):
+    return QMutexLocker(mutex) if mutex is not None else contextlib.nullcontext()
+
+
+def save_local_csv(data_dict, filename, mutex=None):
+    '''
+    Saves a param/value csv, list values are joined with $
+    mutex: QMutex guarding the file (shared by everything writing settings/calibration)
+    '''
+    with _locked(mutex):
+        with open(filename, "w", newline="") as csvfile:
+            try:
+                writer = csv.DictWriter(csvfile, fieldnames=["param", "value"])
+                writer.writeheader()
+                for key, value in data_dict.items():
+                    if isinstance(value, list):
+                        output = "$".join([str(i) for i in value])
+                    else:
+                        output = str(value)
+                    writer.writerow({"param": key, "value": output})
+                logger.info(f"saved to {filename}")
+            except Exception as e:
+                logger.warning("failed to save: %s", e)
+                logger.debug("tried to save: %s", data_dict)
+
+
+def load_local_csv(filename, mutex=None):
+    '''
+    Loads data from local csv files containing setting and calibration info. Files
+    nested in folders not supported.
+
+    setting.csv:      settings for gui
+    calibration.csv:  calibration information
+    '''
+    data_dict = {}
+    if os.path.exists(filename):
+        with _locked(mutex):
+            with open(filename, newline="") as csvfile:
+                reader = csv.DictReader(csvfile)
+                for row in reader:
+                    key = row["param"]
+                    # split into mutliple values
+                    value = row["value"]
+                    value = value.split("$")
+                    # process single values
+                    if len(value) == 1:
+                        try:
+                            value = float(value[0])
+                        except:
+                            data_dict[key] = value[0]
+                    # process multiple values
+                    elif len(value) > 1:
+                        value_arr = []
+                        for val in value:
+                            try:
+                                value_arr.append(float(val))
+                            except:
+                                value_arr.append(val)
+                        data_dict[key] = value_arr
+                    try:
+                        value = float(row["value"])
+                    except:
+                        value = row["value"]
+                    data_dict[key] = value
+    else:
+        logger.warning("could not load %s", filename)
+
+    return data_dict
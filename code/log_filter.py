@@ -0,0 +1,33 @@
+import logging
+
+
+class localOnlyFilter(logging.Filter):
+    '''
+    Passes records from this project's modules, drops low level library messages
+    '''
+    names = [
+        "__main__",
+        "ble_simulator",
+        "bt_sensor",
+        "converter",
+        "daily_database",
+        "daemon",
+        "display_channel",
+        "dwell_predictor",
+        "firebase_worker",
+        "gps_sensor",
+        "history_window",
+        "local_csv",
+        "pond_data",
+        "scheduler",
+        "sensor",
+        "session",
+        "session_store",
+        "truck_sensor",
+        "result_window",
+        "bno055",
+        "ysi_calibration",
+    ]
+
+    def filter(self, record):
+        return record.name in self.names
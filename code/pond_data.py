@@ -0,0 +1,143 @@
+import numpy as np
+from converter import *
+import logging
+
+#init logger
+logger = logging.getLogger(__name__)
+
+# IDEAL RECORD TIME FOR DATA
+RECORD_TIME = 30 #TODO: this should be in setting.setting
+# bump when the fit or extrapolation changes, tags reprocessed results (tools/refit.py)
+ANALYSIS_VERSION = 2
+# points per second of the fitted curves stored for the result screen
+FIT_CURVE_HZ = 5
+
+def extrapolate_do(do_arr, record_time, sample_hz, time=None, p0=None):
+    '''
+    do_arr:      DO samples (NaN for corrupted or missing samples)
+    record_time: time in seconds to extrapolate the fit to
+    sample_hz:   sample frequency used to collect do_arr
+    time:        optional sample times in seconds (see calculate_do_fit)
+    p0:          optional curve parameters to start the fit from
+
+    return: fitted DO at record_time, or the last valid sample if the fit
+            is outside a reasonable range, and the fit (see fit_do, fits
+            of the same data are served from the fit cache)
+    '''
+    do_arr = np.asarray(do_arr, dtype=float)
+    fit = cached_fit_do(do_arr, record_time, sample_hz, time, p0)
+    do_guess = generate_do(record_time, fit['popt'], fit['fit_type'])
+    valid = do_arr[np.isfinite(do_arr)]
+    # only accept values from curve fit if in reasonable range
+    return (do_guess if (5 * np.max(valid) > do_guess > 0) else valid[-1]), fit
+
+def resample(times, values, grid):
+    '''
+    Linear interpolation of a timestamped series onto grid.
+    times:  sample times in seconds, increasing
+    values: samples at times
+    grid:   target times in seconds
+
+    return: values on grid, NaN more than one sample interval outside the
+            span of times (edges are held for up to one interval)
+    '''
+    times = np.asarray(times, dtype=float)
+    values = np.asarray(values, dtype=float)
+    grid = np.asarray(grid, dtype=float)
+    if len(times) == 0:
+        return np.full(len(grid), np.nan)
+    out = np.interp(grid, times, values)
+    interval = np.median(np.diff(times)) if len(times) > 1 else 0
+    out[(grid < times[0] - interval) | (grid > times[-1] + interval)] = np.nan
+    return out
+
+def process_pond_data(sdata, fit_pool=None, warm_start=None, record_time=RECORD_TIME):
+    '''
+    Converts and fits one dive. Does not modify sdata.
+    sdata:    session data with do_vals, temp_vals, pressure_vals, sample_valid,
+              sample_hz, init_pressure and the YSI capture (ysi_raw_mgl_arr at
+              ysi_time_arr, seconds since the sensor's first sample)
+    fit_pool: optional concurrent.futures executor, runs the HBOI and YSI fits in parallel
+    warm_start: optional dict of curve parameters of the previous dive ('do', 'ysi'),
+              the fits start from them if they match the data better than the
+              closed form guess. Updated with this dive's curve fits.
+    record_time: time in seconds the DO is extrapolated to
+
+    Both series are fitted on one time base, the BLE sample times index / sample_hz
+    counted from the sensor's first sample. The YSI capture is resampled onto it.
+
+    The fits are returned with the results (parameters, type and the curve
+    sampled on fit_time_arr in both units), the result screen only plots them.
+
+    return: dict of computed fields, None if there are no valid samples
+    '''
+    result = {}
+    sample_hz = sdata['sample_hz']
+    result['sample_duration'] = len(sdata['do_vals']) / sample_hz
+    sample_time = np.arange(len(sdata['do_vals'])) / sample_hz
+    result['sample_time_arr'] = sample_time
+
+    # rows corrupted in the ble transfer are masked out, not averaged in
+    valid = np.asarray(sdata.get('sample_valid', np.ones(len(sdata['do_vals']))), dtype=bool)
+    if not valid.any():
+        logger.error("no valid samples received from sensor")
+        return None
+    temp_vals = np.asarray(sdata['temp_vals'], dtype=float)[valid]
+    pressure_vals = np.asarray(sdata['pressure_vals'], dtype=float)[valid]
+
+    # water temperature
+    water_temp = float(np.mean(temp_vals))
+    result['water_temp'] = water_temp
+    # Pressure
+    air_pressure = sdata['init_pressure']
+    result['sample_pressure'] = float(np.mean(pressure_vals))
+    result['sample_depth'] = pressure_to_depth(result['sample_pressure'], air_pressure)
+
+    do_arr = np.array(sdata['do_vals'], dtype=float)
+    do_arr[~valid] = np.nan
+
+    # YSI on the BLE time base
+    ysi_raw = np.asarray(sdata.get('ysi_raw_mgl_arr', []), dtype=float)
+    ysi_time = np.asarray(sdata.get('ysi_time_arr', np.arange(len(ysi_raw)) / sample_hz), dtype=float)
+    ysi_do_mgl_arr = resample(ysi_time, ysi_raw, sample_time)
+    # ensure ysi data is available (lost in field)
+    # reference branch "sensor_reconnect_bug"
+    if not np.isfinite(ysi_do_mgl_arr).any():
+        ysi_do_mgl_arr = np.zeros(len(sample_time))
+        logger.error("ysi_do_mgl_arr cleared prematurely, ysi data lost")
+
+    # HBOI and YSI fits are independent
+    warm_start = {} if warm_start is None else warm_start
+    if fit_pool is not None:
+        hboi_fit = fit_pool.submit(extrapolate_do, do_arr, record_time, sample_hz, sample_time, warm_start.get('do'))
+        ysi_fit = fit_pool.submit(extrapolate_do, ysi_do_mgl_arr, record_time, sample_hz, sample_time, warm_start.get('ysi'))
+        (do, hboi_fit), (ysi_do_mgl, ysi_fit) = hboi_fit.result(), ysi_fit.result()
+    else:
+        do, hboi_fit = extrapolate_do(do_arr, record_time, sample_hz, sample_time, warm_start.get('do'))
+        ysi_do_mgl, ysi_fit = extrapolate_do(ysi_do_mgl_arr, record_time, sample_hz, sample_time, warm_start.get('ysi'))
+    for key, fit in (('do', hboi_fit), ('ysi', ysi_fit)):
+        if fit['fit_type'] == "curve":
+            warm_start[key] = fit['popt']
+
+    # HBOI DO
+    result['do'] = do
+    result['do_mgl'] = convert_raw_to_mgl(do, water_temp, air_pressure)
+    result['do_mgl_arr'] = convert_raw_to_mgl(do_arr, water_temp, air_pressure)
+    # YSI DO, index aligned with the HBOI arrays
+    result['ysi_do_mgl'] = ysi_do_mgl
+    result['ysi_do'] = convert_mgl_to_raw(ysi_do_mgl, water_temp, air_pressure)
+    result['ysi_do_mgl_arr'] = ysi_do_mgl_arr
+    result['ysi_do_arr'] = convert_mgl_to_raw(ysi_do_mgl_arr, water_temp, air_pressure)
+
+    # fitted curves for the result screen
+    fit_time = np.linspace(0, record_time, int(FIT_CURVE_HZ * record_time))
+    result['fit_time_arr'] = fit_time
+    result['do_fit_type'] = hboi_fit['fit_type']
+    result['do_fit_params'] = np.atleast_1d(hboi_fit['popt'])
+    result['do_fit_arr'] = generate_do(fit_time, hboi_fit['popt'], hboi_fit['fit_type'])
+    result['do_mgl_fit_arr'] = convert_raw_to_mgl(result['do_fit_arr'], water_temp, air_pressure)
+    result['ysi_fit_type'] = ysi_fit['fit_type']
+    result['ysi_fit_params'] = np.atleast_1d(ysi_fit['popt'])
+    result['ysi_do_mgl_fit_arr'] = generate_do(fit_time, ysi_fit['popt'], ysi_fit['fit_type'])
+    result['ysi_do_fit_arr'] = convert_mgl_to_raw(result['ysi_do_mgl_fit_arr'], water_temp, air_pressure)
+    return result
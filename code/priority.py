@@ -0,0 +1,14 @@
+from enum import Enum
+from functools import total_ordering
+
+
+@total_ordering
+class Priority(Enum):
+    low = 0
+    medium = 1
+    high = 2
+
+    def __lt__(self, other):
+        if self.__class__ is other.__class__:
+            return self.value < other.value
+        return NotImplemented
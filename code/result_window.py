@@ -23,7 +23,7 @@ logger = logging.getLogger(__name__)
 
 
 class ResultWindow(QWidget):
-    closed_data = pyqtSignal(dict)
+    closed_data = pyqtSignal(object)
     image_path=None
     measure_datetime = None
     pond_id = "unk"
@@ -348,37 +348,47 @@ class ResultWindow(QWidget):
             if self.unit == "percent":
                 do_arr = self.data['do_vals']
                 ysi_do_arr = self.data['ysi_do_arr']
+                do_fit_key, ysi_fit_key = 'do_fit_arr', 'ysi_do_fit_arr'
                 scale = 100
             else:
                 do_arr = self.data['do_mgl_arr']
                 ysi_do_arr = self.data['ysi_do_mgl_arr']
+                do_fit_key, ysi_fit_key = 'do_mgl_fit_arr', 'ysi_do_mgl_fit_arr'
                 scale = 1
 
             # IDEAL RECORD TIME FOR DATA
             record_time = 30 #TODO: this should be in setting.setting
-            x_plot = np.linspace(0, sample_stop_time, 5 * sample_stop_time)
 
-            # generate time array for hboi
-            time_hboi = np.arange(len(self.data['do_vals'])) / self.data['sample_hz']
-            time_hboi = time_hboi[time_hboi <= sample_stop_time]
+            # common time base of the HBOI and (resampled) YSI arrays
+            sample_time = self.data.get('sample_time_arr', np.arange(len(self.data['do_vals'])) / self.data['sample_hz'])
+            time_hboi = sample_time[sample_time <= sample_stop_time]
 
-            # generate time array for ysi sensor
-            time_ysi = np.arange(len(self.data['ysi_do_arr'])) / self.data['sample_hz']
-            time_ysi = time_ysi[time_ysi <= sample_stop_time]
-            
-            # fit for HBOI SENSOR
-            p, f = calculate_do_fit(do_arr, record_time, self.data['sample_hz'])
-            y_fit = generate_do(x_plot, p, f)
-            y_fit = [scale * i for i in y_fit]
-            y_scatter = do_arr[:len(time_hboi)]
-            y_scatter = [scale * i for i in y_scatter]
-            
-            # fit for YSI SENSOR
-            p, f = calculate_do_fit(ysi_do_arr, record_time, self.data['sample_hz'])
-            y_fit_ysi = generate_do(x_plot, p, f)
-            y_fit_ysi = [scale * i for i in y_fit_ysi]
-            y_scatter_ysi = ysi_do_arr[:len(time_ysi)]
-            y_scatter_ysi = [scale * i for i in y_scatter_ysi]
+            # generate time array for ysi sensor (sessions before the common time base
+            # may hold a YSI array of different length)
+            if len(ysi_do_arr) == len(sample_time):
+                time_ysi = time_hboi
+            else:
+                time_ysi = np.arange(len(ysi_do_arr)) / self.data['sample_hz']
+                time_ysi = time_ysi[time_ysi <= sample_stop_time]
+
+            if 'fit_time_arr' in self.data:
+                # fitted by process_pond_data, only plotted here
+                x_plot = self.data['fit_time_arr']
+                y_fit = self.data[do_fit_key]
+                y_fit_ysi = self.data[ysi_fit_key]
+            else:
+                # sessions recorded before the fits were stored, fits are cached by data
+                x_plot = np.linspace(0, sample_stop_time, 5 * sample_stop_time)
+                p, f = calculate_do_fit(do_arr, record_time, self.data['sample_hz'], sample_time)
+                y_fit = generate_do(x_plot, p, f)
+                p, f = calculate_do_fit(ysi_do_arr, record_time, self.data['sample_hz'],
+                                        sample_time if len(ysi_do_arr) == len(sample_time) else None)
+                y_fit_ysi = generate_do(x_plot, p, f)
+
+            y_fit = scale * np.asarray(y_fit, dtype=float)
+            y_fit_ysi = scale * np.asarray(y_fit_ysi, dtype=float)
+            y_scatter = scale * np.asarray(do_arr[:len(time_hboi)], dtype=float)
+            y_scatter_ysi = scale * np.asarray(ysi_do_arr[:len(time_ysi)], dtype=float)
 
             fig = Figure(figsize=(((self.img_label2.width())/ 100.0), self.img_label2.height() / 100.0), dpi=100)
             ax = fig.add_subplot(111)
@@ -0,0 +1,210 @@
+import heapq
+import itertools
+import random
+import threading
+import time
+import logging
+from priority import Priority
+
+#init logger
+logger = logging.getLogger(__name__)
+
+class ScheduledTask:
+    '''
+    Periodic callback tracked by DeadlineScheduler, with timing statistics.
+    last_run: monotonic time the callback last started, None before the first run
+    lateness: seconds between the deadline and the moment the callback started
+    overruns: runs that started more than the scheduler's overrun_tolerance late
+    '''
+    __slots__ = ('name', 'callback', 'period', 'priority', 'jitter', 'deadline', 'token', 'last_run',
+                 'runs', 'skipped', 'overruns', 'total_lateness', 'max_lateness',
+                 'total_duration', 'max_duration')
+
+    def __init__(self, name, callback, period, priority, jitter):
+        self.name = name
+        self.callback = callback
+        self.period = period
+        self.priority = priority
+        self.jitter = jitter
+        self.deadline = 0
+        self.token = 0
+        self.last_run = None
+        self.runs = 0
+        self.skipped = 0
+        self.overruns = 0
+        self.total_lateness = 0
+        self.max_lateness = 0
+        self.total_duration = 0
+        self.max_duration = 0
+
+    def stats(self):
+        runs = max(self.runs, 1)
+        return {
+            'period': self.period,
+            'priority': self.priority.name,
+            'runs': self.runs,
+            'skipped': self.skipped,
+            'overruns': self.overruns,
+            'mean_lateness': self.total_lateness / runs,
+            'max_lateness': self.max_lateness,
+            'mean_duration': self.total_duration / runs,
+            'max_duration': self.max_duration,
+        }
+
+
+class DeadlineScheduler:
+    '''
+    Runs periodic callbacks from a priority queue keyed by next fire time.
+    The owning thread calls run_pending() and then sleeps until the next
+    deadline with wait() (or its own sleep using next_deadline()).
+
+    Tasks below the minimum priority passed to run_pending are skipped for
+    that period. When several tasks are due, higher priority runs first.
+    jitter (seconds) spreads a task's deadlines randomly to keep tasks with
+    equal periods from bunching up.
+    '''
+
+    def __init__(self, overrun_tolerance=0.05):
+        self.overrun_tolerance = overrun_tolerance
+        self.tasks = {}
+        self._heap = []  # (deadline, sequence, name, token)
+        self._sequence = itertools.count()
+        self._lock = threading.Lock()
+        self._wakeup = threading.Event()
+
+    def add(self, name, callback, period, priority=Priority.low, delay=0, jitter=0):
+        '''
+        name: unique task name (needed to change or remove the task)
+        period: seconds between runs
+        delay: seconds until the first run
+        '''
+        with self._lock:
+            self.tasks[name] = ScheduledTask(name, callback, period, priority, jitter)
+            self._push(self.tasks[name], time.monotonic() + delay)
+        self._wakeup.set()
+
+    def remove(self, name):
+        with self._lock:
+            if self.tasks.pop(name, None) is None:
+                logger.warning(f"could not find {name} in message schedule")
+
+    def set_period(self, name, period):
+        '''
+        Changes the period, the next run moves to one new period after the last run
+        (a task that has not run yet keeps its first deadline)
+        '''
+        with self._lock:
+            task = self.tasks[name]
+            task.period = period
+            if task.last_run is not None:
+                self._push(task, task.last_run + period)
+        self._wakeup.set()
+
+    def reschedule(self, name, delay=0):
+        '''
+        Moves the next run of a task to delay seconds from now
+        '''
+        with self._lock:
+            self._push(self.tasks[name], time.monotonic() + delay)
+        self._wakeup.set()
+
+    def _push(self, task, deadline):
+        if task.jitter:
+            deadline += random.uniform(0, task.jitter)
+        # older heap entries of this task become stale
+        task.token += 1
+        task.deadline = deadline
+        heapq.heappush(self._heap, (deadline, next(self._sequence), task.name, task.token))
+
+    def _peek(self):
+        # drop entries of removed or rescheduled tasks
+        while self._heap:
+            deadline, _, name, token = self._heap[0]
+            task = self.tasks.get(name)
+            if task is not None and task.token == token:
+                return task
+            heapq.heappop(self._heap)
+        return None
+
+    def run_pending(self, min_priority=Priority.low):
+        '''
+        Runs every due task with priority >= min_priority
+        return: number of callbacks run
+        '''
+        now = time.monotonic()
+        due = []
+        with self._lock:
+            task = self._peek()
+            while task is not None and task.deadline <= now:
+                heapq.heappop(self._heap)
+                due.append((task, task.deadline))
+                # fixed delay, the next run is one period after this one
+                self._push(task, now + task.period)
+                task = self._peek()
+
+        ran = 0
+        for task, deadline in sorted(due, key=lambda item: (-item[0].priority.value, item[1])):
+            if task.priority < min_priority:
+                task.skipped += 1
+                continue
+            start = time.monotonic()
+            lateness = start - deadline
+            task.last_run = start
+            try:
+                task.callback()
+            except Exception as e:
+                logger.error(f"scheduled task {task.name} failed: {e}")
+            duration = time.monotonic() - start
+            task.runs += 1
+            task.total_lateness += lateness
+            task.max_lateness = max(task.max_lateness, lateness)
+            task.total_duration += duration
+            task.max_duration = max(task.max_duration, duration)
+            if lateness > self.overrun_tolerance:
+                task.overruns += 1
+            ran += 1
+        return ran
+
+    def next_deadline(self):
+        '''
+        return: monotonic time of the next deadline, None if nothing is scheduled
+        '''
+        with self._lock:
+            task = self._peek()
+            return task.deadline if task is not None else None
+
+    def wait(self, max_wait=None):
+        '''
+        Sleeps until the next deadline, max_wait seconds, or a call to wake()
+        (tasks being added or rescheduled also wake the sleeper)
+        '''
+        self._wakeup.clear()
+        deadline = self.next_deadline()
+        timeout = max_wait
+        if deadline is not None:
+            remaining = max(deadline - time.monotonic(), 0)
+            timeout = remaining if timeout is None else min(timeout, remaining)
+        if timeout is None or timeout > 0:
+            self._wakeup.wait(timeout)
+
+    def wake(self):
+        self._wakeup.set()
+
+    def stats(self):
+        with self._lock:
+            return {name: task.stats() for name, task in self.tasks.items()}
+
+    def log_stats(self):
+        '''
+        Logs per task timing, at info level if any task overran
+        '''
+        stats = self.stats()
+        overruns = sum(s['overruns'] for s in stats.values())
+        for name, s in stats.items():
+            msg = (f"schedule {name}: runs {s['runs']} skipped {s['skipped']} overruns {s['overruns']} "
+                   f"lateness mean {1000 * s['mean_lateness']:.0f} ms max {1000 * s['max_lateness']:.0f} ms "
+                   f"duration mean {1000 * s['mean_duration']:.0f} ms max {1000 * s['max_duration']:.0f} ms")
+            if overruns:
+                logger.info(msg)
+            else:
+                logger.debug(msg)
@@ -14,28 +14,16 @@ import adafruit_bno055
 import adafruit_ads1x15.ads1115 as ADS
 from adafruit_ads1x15.analog_in import AnalogIn
 import logging
-from enum import Enum
-from functools import total_ordering
 from bno055.bno055 import Compass
+from priority import Priority
+from scheduler import DeadlineScheduler
 
 # init logger
 logger = logging.getLogger(__name__)
 
 
-@total_ordering
-class Priority(Enum):
-    low = 0
-    medium = 1
-    high = 2
-
-    def __lt__(self, other):
-        if self.__class__ is other.__class__:
-            return self.value < other.value
-        return NotImplemented
-
-
 class I2CReader(QThread):
-    ysi_publisher = pyqtSignal(float, float)
+    ysi_publisher = pyqtSignal(float, float, float) # do mg/l, raw adc, capture time (time.monotonic)
     gps_publisher = pyqtSignal(dict)
     calibration_publisher = pyqtSignal(dict)
 
@@ -53,7 +41,6 @@ class I2CReader(QThread):
     reconnect_period = 5  # Time in seconds to retry reconnection
 
     ysi_connected = False  # True if ADC initialized
-    ysi_reconnect_timer = 0  # Stores the last time a reconnect attempt was made
     ysi_sampling_period = 1  # Modified to match BLE sensor
 
     def __init__(self, calibration):
@@ -77,66 +64,37 @@ class I2CReader(QThread):
         # initialize BNO055
         self.compass = Compass(self.i2c, calibration)
         # initialize message schedule
-        self.scheduled_msgs = {}
-        self.scheduled_msgs["gps"] = {
-            "callback": self.publish_gps,
-            "period": 2,
-            "timer": 0,
-            "priority": Priority.high,
-        }
-        self.scheduled_msgs["ysi"] = {
-            "callback": self.measure_ysi_adc,
-            "period": self.ysi_sampling_period,
-            "timer": 0,
-            "priority": Priority.high,
-        }
-        self.scheduled_msgs["hdg_offset"] = {
-            "callback": self.update_heading_offset,
-            "period": 10,
-            "timer": time.monotonic(),
-            "priority": Priority.low
-        }
-        self.scheduled_msgs["cal_save"] = {
-            "callback": self.save_imu_calibration,
-            "period": 120, #TODO: 2 minutes
-            "timer": time.monotonic(),
-            "priority": Priority.low
-        }
+        self.scheduler = DeadlineScheduler()
+        self.scheduler.add("gps", self.publish_gps, 2, Priority.high)
+        self.scheduler.add("ysi", self.measure_ysi_adc, self.ysi_sampling_period, Priority.high)
+        self.scheduler.add("hdg_offset", self.update_heading_offset, 10, Priority.low, delay=10)
+        self.scheduler.add("cal_save", self.save_imu_calibration, 120, Priority.low, delay=120) #TODO: 2 minutes
+        # always runs, retries the ysi adc while it is disconnected
+        self.scheduler.add("ysi_reconnect", self.reconnect_ysi_adc, self.reconnect_period, Priority.high,
+                           delay=self.reconnect_period)
+        self.scheduler.add("sched_stats", self.scheduler.log_stats, 600, Priority.low, delay=600)
 
     def send_scheduled_messages(self):
-        for message in self.scheduled_msgs.values():
-            if time.monotonic() - message["timer"] > message["period"]:
-                message["timer"] = time.monotonic()
-                # only trigger callback if above water or message has underwater priority
-                if message["priority"] >= self.message_priority:
-                    message["callback"]()
+        # only trigger callback if above water or message has underwater priority
+        self.scheduler.run_pending(self.message_priority)
 
     def set_schedule(self, name, callback, period, priority):
         """
         Add message callback to sensor message scheduler
         name: name of message (needs to be called to remove schedule)
-        underwaterFlag: runs when sensor is underwater (True/False)
+        priority: minimum message priority that still runs the callback (see message_priority)
         """
-        if not period.isnumeric():
+        if isinstance(period, bool) or not isinstance(period, (int, float)) or period <= 0:
             logger.error(f"sensor set schedule failed {name}")
         else:
-            msg = {
-                "callback": callback,
-                "period": period,
-                "timer": 0,
-                "priority": priority,
-            }
-            self.scheduled_msgs[name] = msg
+            self.scheduler.add(name, callback, period, priority)
 
     def remove_schedule(self, name):
-        if name in self.scheduled_msgs:
-            del self.scheduled_msgs[name]
-        else:
-            logger.warning(f"could not find {name} in message schedule")
+        self.scheduler.remove(name)
 
     def set_ysi_sample_rate(self, sample_hz):
         self.ysi_sampling_period = float(1 / sample_hz)
-        self.scheduled_msgs["ysi"]["period"] = self.ysi_sampling_period
+        self.scheduler.set_period("ysi", self.ysi_sampling_period)
 
     def set_ysi_calibration(self, zero, full_scale):
         self.zero_scale = zero
@@ -151,7 +109,12 @@ class I2CReader(QThread):
             self.ysi_connected = False
             logger.debug("could not intialize ADC: %s", e)
 
+    def reconnect_ysi_adc(self):
+        if not self.ysi_connected:
+            self.init_ysi_adc()
+
     def measure_ysi_adc(self):
+        capture_time = time.monotonic()
         try:
             val = self.ysi_chan.value
         except:
@@ -166,7 +129,7 @@ class I2CReader(QThread):
         )
         # set to zero if less than zero
         do_mgl = 0 if do_mgl < 0 else do_mgl
-        self.ysi_publisher.emit(do_mgl, val)
+        self.ysi_publisher.emit(do_mgl, val, capture_time)
         return do_mgl, val
     
     def publish_gps(self):
@@ -219,18 +182,14 @@ class I2CReader(QThread):
         self._abort = False
 
         while not self._abort:
-            self.msleep(50)
-            # reconnect ysi sensor
-            if not self.ysi_connected:
-                if time.monotonic() - self.ysi_reconnect_timer > self.reconnect_period:
-                    self.ysi_reconnect_timer = time.monotonic()
-                    self.init_ysi_adc()
-
             # perform sensor updates
             self.send_scheduled_messages()
+            # sleep until the next message is due
+            self.scheduler.wait()
 
     def abort(self):
         self._abort = True
+        self.scheduler.wake()
 
 
 if __name__ == "__main__":
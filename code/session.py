@@ -0,0 +1,202 @@
+import pickle
+import numpy as np
+import logging
+
+#init logger
+logger = logging.getLogger(__name__)
+
+# bump when fields are renamed or change meaning, from_dict upgrades older records
+SESSION_VERSION = 2
+
+# scalar fields, stored as given (None until set)
+SCALAR_FIELDS = (
+    # location, from the I2CReader
+    'pid', 'prev_pid', 'lat', 'lng', 'hdg', 'hdg_type', 'nsat', 'spd',
+    # sensor status, from the BluetoothReader
+    'name', 'connection', 'sample_hz', 'battv', 'batt_status', 'init_do', 'init_pressure',
+    # dive results, from process_pond_data
+    'message_time', 'sample_duration', 'water_temp', 'sample_pressure', 'sample_depth',
+    'do', 'do_mgl', 'ysi_do', 'ysi_do_mgl',
+    # seconds the sensor's first sample precedes the underwater transition (see TruckSensor.ble_time_offset)
+    'ysi_time_offset',
+    # fit types, "curve", "linear" or "none" (see converter.generate_do)
+    'do_fit_type', 'ysi_fit_type',
+)
+
+# array fields and their dtype
+ARRAY_FIELDS = {
+    'do_vals': np.float64,
+    'temp_vals': np.float64,
+    'pressure_vals': np.float64,
+    'sample_valid': np.bool_,
+    'do_mgl_arr': np.float64,
+    'sample_time_arr': np.float64,   # seconds since the sensor's first sample, time base of the arrays above
+    'ysi_raw_mgl_arr': np.float64,   # YSI capture as received
+    'ysi_time_arr': np.float64,      # capture times of ysi_raw_mgl_arr, same time base (ysi_time_offset applied)
+    'ysi_do_mgl_arr': np.float64,    # YSI resampled onto sample_time_arr
+    'ysi_do_arr': np.float64,
+    # fits of process_pond_data, the HBOI fit is on do_vals and the YSI fit on ysi_do_mgl_arr
+    'do_fit_params': np.float64,
+    'ysi_fit_params': np.float64,
+    'fit_time_arr': np.float64,       # seconds, time base of the fitted curves below
+    'do_fit_arr': np.float64,
+    'do_mgl_fit_arr': np.float64,
+    'ysi_do_fit_arr': np.float64,
+    'ysi_do_mgl_fit_arr': np.float64,
+}
+
+FIELDS = SCALAR_FIELDS + tuple(ARRAY_FIELDS)
+
+
+class Session:
+    '''
+    Sensor status and samples of one dive.
+    Supports the mapping access the sdata dict had (session['do'], 'do' in session,
+    get, update, keys, items), a key is only present once it has been set.
+    Array fields are converted to numpy arrays on assignment.
+    Use copy() before handing a session to another thread.
+    '''
+    __slots__ = FIELDS
+
+    def __init__(self, **fields):
+        for key in FIELDS:
+            object.__setattr__(self, key, None)
+        self.update(fields)
+
+    def __setattr__(self, key, value):
+        if key in ARRAY_FIELDS and value is not None:
+            value = np.asarray(value, dtype=ARRAY_FIELDS[key])
+        object.__setattr__(self, key, value)
+
+    # mapping access
+    def __getitem__(self, key):
+        if key not in FIELDS:
+            raise KeyError(key)
+        value = getattr(self, key)
+        if value is None:
+            raise KeyError(key)
+        return value
+
+    def __setitem__(self, key, value):
+        if key not in FIELDS:
+            raise KeyError(f"{key} is not a session field")
+        setattr(self, key, value)
+
+    def __contains__(self, key):
+        return key in FIELDS and getattr(self, key) is not None
+
+    def __iter__(self):
+        return iter(self.keys())
+
+    def __len__(self):
+        return len(self.keys())
+
+    def get(self, key, default=None):
+        value = getattr(self, key, None) if key in FIELDS else None
+        return default if value is None else value
+
+    def keys(self):
+        return [key for key in FIELDS if getattr(self, key) is not None]
+
+    def items(self):
+        return [(key, getattr(self, key)) for key in self.keys()]
+
+    def update(self, other):
+        '''
+        Copies the set fields of a Session or the items of a dict
+        '''
+        for key, value in other.items():
+            self[key] = value
+
+    def scalars(self):
+        '''
+        return: dict of the set scalar fields (status without the sample arrays)
+        '''
+        return {key: getattr(self, key) for key in SCALAR_FIELDS if getattr(self, key) is not None}
+
+    def copy(self):
+        '''
+        return: independent copy, arrays are copied
+        '''
+        session = Session()
+        for key in FIELDS:
+            value = getattr(self, key)
+            object.__setattr__(session, key, value.copy() if isinstance(value, np.ndarray) else value)
+        return session
+
+    # serialization
+    def to_dict(self):
+        '''
+        return: versioned dict of the set fields, arrays stay numpy arrays
+        '''
+        data = dict(self.items())
+        data['version'] = SESSION_VERSION
+        return data
+
+    @classmethod
+    def from_dict(cls, data):
+        '''
+        Builds a session from to_dict output or a legacy sdata dict (no version key).
+        Keys outside the schema are dropped.
+        '''
+        data = dict(data)
+        version = data.pop('version', 0)
+        if version > SESSION_VERSION:
+            logger.warning(f"session version {version} is newer than {SESSION_VERSION}")
+        if version < 2 and 'ysi_do_mgl_arr' in data and 'sample_hz' in data:
+            # before version 2 the YSI samples were stored as captured and
+            # assumed to be taken at sample_hz
+            ysi = np.asarray(data['ysi_do_mgl_arr'], dtype=float)
+            data.setdefault('ysi_raw_mgl_arr', ysi)
+            data.setdefault('ysi_time_arr', np.arange(len(ysi)) / data['sample_hz'])
+        unknown = [key for key in data if key not in FIELDS]
+        if unknown:
+            logger.debug(f"dropping fields outside the session schema {unknown}")
+        return cls(**{key: value for key, value in data.items() if key in FIELDS and value is not None})
+
+    def __getstate__(self):
+        return self.to_dict()
+
+    def __setstate__(self, state):
+        for key in FIELDS:
+            object.__setattr__(self, key, None)
+        self.update(Session.from_dict(state))
+
+    def save(self, file):
+        '''
+        Pickles the versioned dict, readable without this module
+        '''
+        pickle.dump(self.to_dict(), file, protocol=pickle.HIGHEST_PROTOCOL)
+
+    @classmethod
+    def load(cls, file):
+        '''
+        Loads a session pickle, including legacy sdata dict pickles
+        '''
+        data = pickle.load(file)
+        if isinstance(data, Session):
+            return data
+        return cls.from_dict(data)
+
+    def __repr__(self):
+        return f"Session(pid={self.pid!r}, message_time={self.message_time!r}, samples={0 if self.do_vals is None else len(self.do_vals)})"
+
+
+def database_row(sdata, time_str):
+    '''
+    Row of the daily database csv for a processed session
+    sdata:    Session (or dict) with the process_pond_data results
+    time_str: local time of the measurement, %H:%M:%S
+    '''
+    return {
+        "time": time_str,
+        "pond_id": sdata['pid'],
+        "hboi_do": round(sdata['do'],2),
+        "hboi_do_mgl":round(sdata['do_mgl'],2),
+        "ysi_do": round(sdata['ysi_do'],2),
+        "ysi_do_mgl": round(sdata['ysi_do_mgl'],2),
+        "temperature": round(sdata['water_temp'],2),
+        "depth": round(sdata['sample_depth'],2),
+        "upload_status": False,
+        "message_time": sdata['message_time'],
+    }
@@ -0,0 +1,203 @@
+import os
+import json
+import sqlite3
+import threading
+import time
+from datetime import datetime, timezone
+import numpy as np
+import logging
+from session import Session, SCALAR_FIELDS, ARRAY_FIELDS
+
+#init logger
+logger = logging.getLogger(__name__)
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS sessions (
+    message_time TEXT PRIMARY KEY,      -- GMT, %Y%m%d_%H:%M:%S
+    date TEXT NOT NULL,                 -- local date of the measurement, %Y-%m-%d
+    time TEXT NOT NULL,                 -- local time, %H:%M:%S
+    pond_id TEXT,
+    uploaded INTEGER NOT NULL DEFAULT 0,
+    upload_time REAL,
+    hboi_do REAL,
+    hboi_do_mgl REAL,
+    ysi_do REAL,
+    ysi_do_mgl REAL,
+    temperature REAL,
+    depth REAL,
+    scalars TEXT NOT NULL               -- json of the session scalar fields
+);
+CREATE INDEX IF NOT EXISTS sessions_date ON sessions(date, time);
+CREATE INDEX IF NOT EXISTS sessions_pond ON sessions(pond_id, date);
+CREATE INDEX IF NOT EXISTS sessions_uploaded ON sessions(uploaded, message_time);
+CREATE TABLE IF NOT EXISTS arrays (
+    message_time TEXT NOT NULL REFERENCES sessions(message_time) ON DELETE CASCADE,
+    name TEXT NOT NULL,
+    data BLOB NOT NULL,                 -- raw bytes, dtype from session.ARRAY_FIELDS
+    PRIMARY KEY (message_time, name)
+) WITHOUT ROWID;
+'''
+
+# summary columns and the session field they hold
+SUMMARY = {
+    'pond_id': 'pid',
+    'hboi_do': 'do',
+    'hboi_do_mgl': 'do_mgl',
+    'ysi_do': 'ysi_do',
+    'ysi_do_mgl': 'ysi_do_mgl',
+    'temperature': 'water_temp',
+    'depth': 'sample_depth',
+}
+
+
+def to_json(obj):
+    # numpy scalars
+    if hasattr(obj, "item"):
+        return obj.item()
+    return str(obj)
+
+
+def local_time(message_time):
+    '''
+    message_time: GMT %Y%m%d_%H:%M:%S
+    return: local date (%Y-%m-%d) and time (%H:%M:%S)
+    '''
+    gmt = datetime.strptime(message_time, "%Y%m%d_%H:%M:%S").replace(tzinfo=timezone.utc)
+    local = gmt.astimezone()
+    return local.strftime("%Y-%m-%d"), local.strftime("%H:%M:%S")
+
+
+class SessionStore:
+    '''
+    SQLite store of the measured sessions: a summary row per session (indexed
+    on message_time, date, pond id and upload status) and the sample arrays as
+    BLOBs. The database runs in WAL mode, readers (history window) do not wait
+    for the writer and need no mutex.
+    Connections are per thread, a store object can be shared between threads.
+    '''
+
+    def __init__(self, path="sessions.db"):
+        self.path = path
+        self._local = threading.local()
+
+    def connection(self):
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            folder = os.path.dirname(self.path)
+            if folder:
+                os.makedirs(folder, exist_ok=True)
+            conn = sqlite3.connect(self.path, timeout=10)
+            conn.row_factory = sqlite3.Row
+            conn.execute("PRAGMA journal_mode=WAL")
+            # WAL stays consistent on power loss, at worst the last commits are lost
+            conn.execute("PRAGMA synchronous=NORMAL")
+            conn.execute("PRAGMA foreign_keys=ON")
+            conn.executescript(SCHEMA)
+            self._local.conn = conn
+        return conn
+
+    def close(self):
+        '''
+        Closes the connection of the calling thread
+        '''
+        conn = getattr(self._local, "conn", None)
+        if conn is not None:
+            conn.close()
+            self._local.conn = None
+
+    def add(self, sdata, date_str, time_str, uploaded=False):
+        '''
+        Stores a session, replaces an earlier one with the same message_time
+        sdata:    Session with the process_pond_data results
+        date_str: local date of the measurement, %Y-%m-%d
+        time_str: local time of the measurement, %H:%M:%S
+        '''
+        scalars = {key: sdata[key] for key in SCALAR_FIELDS if key in sdata}
+        row = {column: sdata.get(field) for column, field in SUMMARY.items()}
+        row.update(message_time=sdata['message_time'], date=date_str, time=time_str, uploaded=int(uploaded),
+                   upload_time=time.time() if uploaded else None, scalars=json.dumps(scalars, default=to_json))
+        arrays = [(sdata['message_time'], key, sqlite3.Binary(np.ascontiguousarray(sdata[key]).tobytes()))
+                  for key in ARRAY_FIELDS if key in sdata]
+        conn = self.connection()
+        with conn:
+            conn.execute("DELETE FROM sessions WHERE message_time = ?", (row['message_time'],))
+            conn.execute(f"INSERT INTO sessions ({', '.join(row)}) VALUES ({', '.join('?' * len(row))})",
+                         list(row.values()))
+            conn.executemany("INSERT INTO arrays (message_time, name, data) VALUES (?, ?, ?)", arrays)
+
+    def mark_uploaded(self, message_times):
+        '''
+        Marks sessions uploaded in one transaction
+        message_times: message_time of each uploaded session
+        '''
+        now = time.time()
+        conn = self.connection()
+        with conn:
+            conn.executemany("UPDATE sessions SET uploaded = 1, upload_time = ? WHERE message_time = ?",
+                             [(now, message_time) for message_time in message_times])
+
+    def load(self, message_time):
+        '''
+        return: Session, None if message_time is not stored
+        '''
+        conn = self.connection()
+        row = conn.execute("SELECT scalars FROM sessions WHERE message_time = ?", (message_time,)).fetchone()
+        if row is None:
+            return None
+        fields = json.loads(row['scalars'])
+        for name, data in conn.execute("SELECT name, data FROM arrays WHERE message_time = ?", (message_time,)):
+            if name in ARRAY_FIELDS:
+                fields[name] = np.frombuffer(data, dtype=ARRAY_FIELDS[name]).copy()
+        return Session(**fields)
+
+    def pending(self):
+        '''
+        return: sessions not uploaded yet, oldest first
+        '''
+        rows = self.connection().execute(
+            "SELECT message_time FROM sessions WHERE uploaded = 0 ORDER BY message_time").fetchall()
+        return [self.load(row['message_time']) for row in rows]
+
+    def history(self, dates):
+        '''
+        dates:  local dates, %Y-%m-%d
+        return: summary rows (sqlite3.Row, columns as in SCHEMA) of the sessions
+                measured on dates, newest first
+        '''
+        dates = list(dates)
+        return self.connection().execute(
+            f"SELECT * FROM sessions WHERE date IN ({', '.join('?' * len(dates))}) ORDER BY date DESC, time DESC",
+            dates).fetchall()
+
+    def message_times(self):
+        return {row[0] for row in self.connection().execute("SELECT message_time FROM sessions")}
+
+    def import_pickles(self, folder, uploaded):
+        '''
+        Stores the session pickles of folder that are not in the store yet
+        (sessions recorded before the store, or saved while it was unavailable).
+        Pickles named by their message_time (as FirebaseWorker saves them) are
+        skipped without loading them, stored sessions are never overwritten.
+        uploaded: upload status of the sessions in folder
+        return:   number of imported sessions
+        '''
+        if not os.path.isdir(folder):
+            return 0
+        known = self.message_times()
+        known_files = {message_time.replace(":", "-") + ".pickle" for message_time in known}
+        imported = 0
+        for filename in sorted(os.listdir(folder)):
+            if not filename.endswith(".pickle") or filename in known_files:
+                continue
+            try:
+                with open(os.path.join(folder, filename), 'rb') as file:
+                    sdata = Session.load(file)
+                if sdata['message_time'] in known:
+                    continue
+                self.add(sdata, *local_time(sdata['message_time']), uploaded=uploaded)
+                imported += 1
+            except Exception as e:
+                logger.warning(f"could not import {filename}: {e}")
+        if imported:
+            logger.info(f"imported {imported} sessions from {folder}")
+        return imported
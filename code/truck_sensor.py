@@ -2,17 +2,23 @@ from PyQt5.QtCore import QThread, pyqtSignal, QMutex, QMutexLocker
 from bt_sensor import BluetoothReader
 import json, logging
 from datetime import datetime
+from collections import deque
+import threading
 import time
 import pandas as pd
 import os
 import firebase_admin
 from firebase_admin import credentials,db
 import concurrent.futures
-from sensor import I2CReader
 from converter import *
+from pond_data import process_pond_data, RECORD_TIME
 import numpy as np
 from enum import Enum
-import sensor
+from priority import Priority
+from session import Session, database_row
+from scheduler import DeadlineScheduler
+from display_channel import DisplayChannel
+from dwell_predictor import DwellPredictor
 
 from firebase_worker import FirebaseWorker
 
@@ -23,24 +29,101 @@ class Mode(Enum):
     normal = 0
     ysi_cal = 1
 
+class State(Enum):
+    disconnected = 0  # no sensor connection (startup or link lost outside a dive)
+    idle = 1          # connected, no data on the sensor
+    underwater = 2    # sensor is collecting data (connected or not)
+    transferring = 3  # pulling the sample dump from the sensor
+    processing = 4    # converting and fitting the dive
+
+class SurfacingPolicy:
+    '''
+    Adaptive timing for surfacing detection.
+    sample size polling: polls right after a reconnect and again one sample
+        period later, backing off while the sample size keeps growing
+    reconnect holdoff: a fraction of the shortest recently observed dive,
+        instead of a fixed wait after the sensor goes underwater
+    '''
+    min_poll = 0.3          # seconds
+    max_poll = 3.0          # seconds
+    poll_backoff = 1.5      # poll period multiplier while the sample size grows
+    holdoff_fraction = 0.5  # fraction of the shortest recent dive
+    default_holdoff = 5.0   # seconds, used until a dive has been observed
+    min_holdoff = 1.0
+    max_holdoff = 15.0
+
+    def __init__(self, sample_hz=1, history=10):
+        self.sample_hz = sample_hz
+        self.dive_durations = deque(maxlen=history)
+        self.disconnect_time = None
+        self.diving = False
+        self.poll_period = self.fast_poll()
+
+    def fast_poll(self):
+        # polling faster than one sample period cannot see the sample size grow
+        return max(self.min_poll, 1.1 / self.sample_hz)
+
+    def on_disconnect(self, dive=True):
+        '''
+        dive: False for a link lost at the surface, its duration is not a dive
+        '''
+        self.disconnect_time = time.monotonic()
+        self.diving = dive
+
+    def on_reconnect(self):
+        if self.disconnect_time is not None and self.diving:
+            self.dive_durations.append(time.monotonic() - self.disconnect_time)
+        self.disconnect_time = None
+        self.poll_period = self.fast_poll()
+
+    def on_sample_size(self, growing):
+        if growing:
+            self.poll_period = min(self.max_poll, self.poll_period * self.poll_backoff)
+        else:
+            self.poll_period = self.fast_poll()
+
+    def reconnect_holdoff(self):
+        if not self.dive_durations:
+            return self.default_holdoff
+        holdoff = self.holdoff_fraction * min(self.dive_durations)
+        return min(self.max_holdoff, max(self.min_holdoff, holdoff))
+
+    def can_reconnect(self):
+        if self.disconnect_time is None:
+            return True
+        return time.monotonic() - self.disconnect_time > self.reconnect_holdoff()
+
+
 class TruckSensor(QThread):
-    update_data = pyqtSignal(dict) 
-    sensor_underwater = pyqtSignal(str)
-    update_pond_data = pyqtSignal(dict)
+    update_data = pyqtSignal(dict) # changed display fields, delivered by DisplayChannel
+    sensor_underwater = pyqtSignal(bool)
+    state_changed = pyqtSignal(str, str, float) # previous state, new state, time of transition
+    fit_complete = pyqtSignal(object) # internal, processed Session from the fit pool
+    update_pond_data = pyqtSignal(object) # Session
     ysi_data = pyqtSignal(float, float)
     calibration_data = pyqtSignal(dict)
+    dwell_ready = pyqtSignal(float, float) # seconds underwater, predicted DO mg/l
 
     _abort = False
-    sdata = {'pid':'unk25', 'prev_pid':'unk25', 'do':0, 'do_mgl':0, 'ysi_do':0, 'ysi_do_mgl':0, 'sample_hz':1}
-    #TODO: sample hz should be pulled from settings
 
     ble = None
     app = None
     cred = None
 
     mode = Mode.normal #handles special operating modes
+    state = State.disconnected
     underwater = False
 
+    # state machine timing
+    connect_retry = 1.0            # seconds between attempts to find the sensor
+    reconnect_retry = 0.2          # minimum seconds between reconnect attempts
+    connection_check_period = 0.5  # longest sleep while connected, bounds disconnect detection
+    display_hz = 5                 # maximum rate of update_data deliveries
+    # the underwater transition is the detected link drop, it trails the sensor's first
+    # sample (BLE t=0) by the BLE supervision timeout plus the connection check
+    ble_drop_delay = 2.0           # seconds, offset used when it cannot be estimated
+    max_ble_offset = 10.0          # seconds, estimates outside [0, max_ble_offset] are rejected
+
     # environment variables
     water_temp = 0    # celcius
     air_pressure = 0  # HPA
@@ -49,22 +132,57 @@ class TruckSensor(QThread):
     fb_key="fb_key.json"
 
 
-    def __init__(self, calibration, settings, database_mutex, ble_mutex, parent=None):
+    def __init__(self, calibration, settings, database_mutex, ble_mutex, parent=None, ble_radio=None, sensors=None,
+                 data_folder="", upload=True):
+        '''
+        ble_radio: replacement for adafruit_ble's BLERadio (see ble_simulator.py)
+        sensors: replacement for the I2CReader, for running without I2C hardware
+        data_folder, upload: local storage and firebase upload of the results (see FirebaseWorker)
+        '''
         super().__init__(parent)
         # initialize mutexes
         self.ble_mutex = ble_mutex
+        self.ble_radio = ble_radio
+        # display updates, coalesced and delivered on the thread creating TruckSensor
+        self.display = DisplayChannel(self.display_hz)
+        self.display.updated.connect(self.update_data)
         # initialize firebase
-        self.firebase_worker = FirebaseWorker(database_mutex)
+        self.firebase_worker = FirebaseWorker(database_mutex, data_folder, upload)
         self.firebase_worker.start()
         self.calibration = calibration
         self.settings = settings
         # initialize I2C sensor bus
-        self.sensors = I2CReader(calibration)
+        if sensors is None:
+            from sensor import I2CReader # imports board, only available on the truck
+            sensors = I2CReader(calibration)
+        self.sensors = sensors
         self.sensors.start()
 
         #internally accessed variables
-        self.ysi_do_mgl_arr = []
+        #TODO: sample hz should be pulled from settings
+        self.sdata = Session(pid='unk25', prev_pid='unk25', do=0, do_mgl=0, ysi_do=0, ysi_do_mgl=0, sample_hz=1)
+        # sdata is written by the state machine thread and by the slots, which run on
+        # the thread TruckSensor was created in (the GUI thread)
+        self.sdata_mutex = QMutex()
+        self.ysi_samples = []     # (capture time, do mg/l) while underwater
+        self.dive_start = time.monotonic()  # time base of a dive, set at the underwater transition
+        self.reconnect_time = None          # last reconnect, the sensor has surfaced by then
+        self.dwell = DwellPredictor(RECORD_TIME, self.sdata['sample_hz'])
+        self.dwell_samples = []   # (dive time, do mg/l) not handed to the predictor yet
+        self.dwell_job = None
+        self.surfacing = None
+        self.state_time = time.time()
+        self._wakeup = threading.Event()
+        # fitting runs off the BLE thread, both fits of a dive in parallel
+        self.process_pool = concurrent.futures.ThreadPoolExecutor(max_workers=1)
+        self.fit_pool = concurrent.futures.ThreadPoolExecutor(max_workers=2)
+        # live dwell prediction, one refit at a time off the GUI thread
+        self.dwell_pool = concurrent.futures.ThreadPoolExecutor(max_workers=1)
+        self.fit_warm_start = {}  # curve parameters of the last dive, only used by the process pool
+        self.processing = None    # future of the dive being processed
         # initialzie PyQt Signals
+        self.fit_complete.connect(self.on_fit_complete)
+        # emitted from the state machine thread, handled on the thread TruckSensor was created in
         self.sensor_underwater.connect(self.underwater_status_change)
         self.sensors.gps_publisher.connect(self.on_gps_update)
         self.sensors.ysi_publisher.connect(self.on_ysi_update)
@@ -75,10 +193,10 @@ class TruckSensor(QThread):
         self.calibration_data.emit(data)
 
     # YSI COMMANDS
-    def on_ysi_update(self, do_mgl, raw_adc):
+    def on_ysi_update(self, do_mgl, raw_adc, capture_time):
         logger.debug(f"ysi update mode {self.mode} underwater {self.underwater} do_mgl {do_mgl}")
         if self.water_temp and self.air_pressure:
-            do_ps = convert_mgl_to_raw(do_mgl, self.water_temp, self.air_pressure)
+            do_ps = convert_mgl_to_raw(do_mgl, self.water_temp, self.air_pressure, cached=True)
         else:
             do_ps = -1
         # emit when in calibration mode
@@ -86,48 +204,94 @@ class TruckSensor(QThread):
             self.ysi_data.emit(raw_adc, raw_adc)
         # only emit data when underwater
         elif self.underwater:
-            self.ysi_do_mgl_arr.append(do_mgl)
+            self.ysi_samples.append((capture_time, do_mgl))
             self.ysi_data.emit(do_ps, do_mgl)
+            self.update_dwell(capture_time - self.dive_start, do_mgl)
+
+    def update_dwell(self, t, do_mgl):
+        '''
+        Queues a YSI sample for the dwell predictor. The refit runs in dwell_pool,
+        samples arriving while it runs are batched into the next refit.
+        '''
+        self.dwell_samples.append((t, do_mgl))
+        if self.dwell_job is not None and not self.dwell_job.done():
+            return
+        samples, self.dwell_samples = self.dwell_samples, []
+        dwell = self.dwell
+        self.dwell_job = self.dwell_pool.submit(dwell.extend, samples)
+        self.dwell_job.add_done_callback(lambda future: self.on_dwell_done(dwell, future))
+
+    def on_dwell_done(self, dwell, future):
+        # runs on the pool thread, only the ready flag leaves it
+        try:
+            ready = future.result()
+        except Exception as e:
+            logger.warning("dwell prediction failed %s", e)
+            return
+        # ignore a refit of the previous dive
+        if ready and dwell is self.dwell:
+            self.dwell_ready.emit(dwell.ready_time, dwell.prediction)
         
 
     def start_ysi_calibration(self, sample_hz):
         self.mode = Mode.ysi_cal
         self.sensors.set_ysi_sample_rate(sample_hz)
-        self.sensors.message_priority = sensor.Priority.high
+        self.sensors.message_priority = Priority.high
         
     def stop_ysi_calibration(self):
         self.mode = Mode.normal
         self.sensors.set_ysi_sample_rate(self.sdata['sample_hz'])
-        self.sensors.message_priority = sensor.Priority.low
+        self.sensors.message_priority = Priority.low
     
     def set_ysi_calibration(self, zero, full_scale):
         self.sensors.set_ysi_calibration(zero, full_scale)
 
     def underwater_status_change(self, value):
-        if value == "True":
+        if value:
             self.underwater = True
-            self.sensors.message_priority = sensor.Priority.high # only process high priority messages 
+            self.sensors.message_priority = Priority.high # only process high priority messages 
+            # new predictor per dive, a refit of the last dive may still be running.
+            # sample_hz is the rate the sensor reported on connect
+            with QMutexLocker(self.sdata_mutex):
+                sample_hz = self.sdata['sample_hz']
+            self.dwell_samples = []
+            self.dwell = DwellPredictor(RECORD_TIME, sample_hz)
         else:
             self.underwater = False
-            self.sensors.message_priority = sensor.Priority.low 
+            self.sensors.message_priority = Priority.low 
 
 
     def init_ble(self):
-        self.ble = BluetoothReader(self.ble_mutex)
+        if self.ble is None:
+            self.ble = BluetoothReader(self.ble_mutex, radio=self.ble_radio)
         if self.ble.connect():
             self.sync_ble_sdata()
             self.ble.set_lights('navigation')
             logger.debug('connected to sensor, activated lights')
+            return True
+        return False
 
     def init_sensor_status(self):
-        self.ble.set_calibration_pressure()
-        logger.info("pressure calibration complete")
-
-        self.ble.get_init_do()
-        self.ble.get_init_pressure()
-        self.ble.get_battery()
-        self.ble.get_sampling_rate()
-        self.ble.set_threshold(self.settings['depth_threshold'])
+        # defaults in case the sensor does not answer
+        self.ble.sdata['init_do'] = 0
+        self.ble.sdata['init_pressure'] = 0
+        self.ble.sdata['sample_hz'] = 1
+
+        threshold = self.settings['depth_threshold']
+        commands = self.ble.commands
+        # pressure calibration is sent first, the sensor answers in order
+        replies = self.ble.send_receive_commands({
+            'cal_ps': commands['cal_ps'],
+            'init_do': commands['init_do'],
+            'init_ps': commands['init_ps'],
+            'battery': commands['battery'],
+            's_rate': commands['s_rate'],
+            'threshold': self.ble.threshold_command(threshold),
+        })
+        if replies['cal_ps']:
+            logger.info("pressure calibration complete")
+        if not self.ble.check_threshold(replies['threshold'], threshold):
+            logger.debug(f"setting pressure threshold failed during init {threshold}")
 
         self.sync_ble_sdata()
 
@@ -138,26 +302,40 @@ class TruckSensor(QThread):
 
 
     def init_message_scheduler(self):
-        self.scheduled_msgs = {}
-        self.scheduled_msgs['s_size'] = {'callback':self.ble.get_sample_size, 'period':1.2, 'timer':0}
-        self.scheduled_msgs['batt']   = {'callback':self.ble.get_battery, 'period':10, 'timer':0}
-        self.scheduled_msgs['sync']   = {'callback':self.sync_ble_sdata, 'period':15, 'timer':0}
+        self.scheduler = DeadlineScheduler()
+        self.scheduler.add('s_size', self.poll_sample_size, self.surfacing.poll_period, Priority.high)
+        self.sample_size_polled = False
+        self.scheduler.add('batt', self.ble.get_battery, 10, Priority.low)
+        self.scheduler.add('sync', self.sync_ble_sdata, 15, Priority.medium)
+        self.scheduler.add('sched_stats', self.scheduler.log_stats, 600, Priority.low, delay=600)
+        self.scheduler.add('cache_stats', self.log_cache_stats, 600, Priority.low, delay=600)
+
+    def log_cache_stats(self):
+        info = saturation_cache_info()
+        logger.debug(f"saturation cache: hits {info.hits} misses {info.misses} size {info.currsize}/{info.maxsize}")
+        info = fit_cache_info()
+        logger.debug(f"fit cache: hits {info.hits} misses {info.misses} size {info.currsize}/{info.maxsize}")
+
+    def poll_sample_size(self):
+        self.ble.get_sample_size()
+        self.surfacing.sample_hz = self.sdata['sample_hz']
+        self.surfacing.on_sample_size(self.ble.prev_sample_size < self.ble.current_sample_size)
+        self.scheduler.set_period('s_size', self.surfacing.poll_period)
+        self.sample_size_polled = True
 
     def send_scheduled_messages(self):
         if self.mode == (Mode.normal or Mode.ysi_cal):
-            for message in self.scheduled_msgs.values():
-                if time.time() - message['timer'] > message['period']:
-                    message['timer'] = time.time()
-                    message['callback']()
+            self.scheduler.run_pending()
 
 
     def on_gps_update(self, data):
-        self.sdata['prev_pid'] = self.sdata['pid']
-        #update sdata with new gps data
-        for key, val in data.items():
-            self.sdata[key] = val
+        with QMutexLocker(self.sdata_mutex):
+            self.sdata['prev_pid'] = self.sdata['pid']
+            #update sdata with new gps data
+            for key, val in data.items():
+                self.sdata[key] = val
 
-        self.update_data.emit(data)
+        self.display.publish(data)
         if self.sdata["prev_pid"] != self.sdata["pid"]:
             logger.debug(f"moved to pid: {self.sdata['pid']}")
         
@@ -169,173 +347,245 @@ class TruckSensor(QThread):
             logger.warning("do calibration failed")
         return status
 
+    def set_state(self, state):
+        '''
+        Moves the acquisition state machine to state and emits the timestamped
+        transition. sensor_underwater is only emitted when the underwater
+        status actually changes. Going underwater or losing the link starts
+        the reconnect holdoff.
+        '''
+        if state == self.state:
+            return
+        now = time.time()
+        previous = self.state
+        logger.debug(f"state {previous.name} -> {state.name} after {now - self.state_time:.2f} s")
+        self.state = state
+        self.state_time = now
+        self.state_changed.emit(previous.name, state.name, now)
+
+        if state in (State.underwater, State.disconnected) and self.surfacing is not None:
+            self.surfacing.on_disconnect(dive=state == State.underwater)
+        underwater = state == State.underwater
+        if underwater:
+            self.dive_start = time.monotonic()
+        if underwater != (previous == State.underwater):
+            self.sensor_underwater.emit(underwater)
+
     def run(self):
+        '''
+        Timer driven state machine. Each step handles the current state and
+        returns the monotonic time of the next deadline, the thread sleeps
+        until then (or until abort).
+        '''
         self._abort = False
-        
-        # Wait for First Connection
-        while self.ble is None or not self.ble.check_connection_status():
-            self.init_ble()
-            self.init_sensor_status()
-            self.msleep(100)
-
-        self.init_message_scheduler()
-
-        connection_count = 0
-
-        # reset all buffer in system
-        self.ble.set_sample_reset()
+        self._wakeup.clear()
+        next_step = time.monotonic()
 
-        # create local connection variable
-        connected = self.ble.check_connection_status()
-
-        # Main Loop
         while not self._abort:
+            delay = next_step - time.monotonic()
+            if delay > 0:
+                self._wakeup.wait(delay)
+                self._wakeup.clear()
+                if self._abort:
+                    break
+            if self.state == State.disconnected:
+                next_step = self.step_disconnected()
+            elif self.state == State.transferring:
+                next_step = self.step_transferring()
+            elif self.state == State.processing:
+                next_step = self.step_processing()
+            elif self.state == State.underwater and not self.ble.uart_connection.connected:
+                next_step = self.step_submerged()
+            else:
+                next_step = self.step_connected()
 
-            self.msleep(100)
+    def step_disconnected(self):
+        # first connection
+        if self.surfacing is None:
+            if not self.init_ble():
+                return time.monotonic() + self.connect_retry
+            self.init_sensor_status()
+            self.surfacing = SurfacingPolicy(self.sdata['sample_hz'])
+            self.init_message_scheduler()
+            # reset all buffer in system
+            self.ble.set_sample_reset()
+            self.set_state(State.idle)
+            return time.monotonic()
+
+        # link lost outside a dive (e.g. during a transfer), reconnect right away
+        if not self.ble.reconnect():
+            return time.monotonic() + self.reconnect_retry
+        self.on_reconnected()
+        self.set_state(State.idle)
+        return time.monotonic()
+
+    def step_submerged(self):
+        # hold off reconnecting until the sensor could plausibly have surfaced
+        if not self.surfacing.can_reconnect():
+            holdoff_end = self.surfacing.disconnect_time + self.surfacing.reconnect_holdoff()
+            return max(holdoff_end, time.monotonic())
+        logger.debug(f"attempting reconnect after waiting {self.surfacing.reconnect_holdoff():.1f} s")
+        if not self.ble.reconnect():
+            return time.monotonic() + self.reconnect_retry
+        self.on_reconnected()
+        return time.monotonic()
+
+    def on_reconnected(self):
+        self.reconnect_time = time.monotonic()
+        # poll the sample size right away
+        self.surfacing.on_reconnect()
+        self.scheduler.set_period('s_size', self.surfacing.poll_period)
+        self.scheduler.reschedule('s_size')
+        self.sync_ble_sdata()
 
-            # check if still connected
-            if connected:
-                connected = self.ble.check_connection_status()
-                if not connected:
-                    connection_count = 0
-                    self.msleep(150)
-                    continue
-            # handle not connected case
-            else:
-                connected = self.ble.check_connection_status()
-                if not connected:
-                    # first disconnect event
-                    if connection_count == 0:
-                        logger.debug(f'sensor disconnected, connection count {connection_count}')
-                        self.sensor_underwater.emit("True")
-                        self.sync_ble_sdata()
-                        
-                    # do not try to reconnect for first 5000 ms
-                    elif connection_count > 25:
-                        logger.debug(f"attempting reconnect after waiting {connection_count * 200} ms")
-                        connected = self.ble.reconnect()
-                    # continue if still not connected
-                    if not connected:
-                        connection_count += 1
-                        self.msleep(100)
-                        continue
-                # first reconnect
-                else:
-                    connection_count = 0
-                    self.sync_ble_sdata()
-            
-            # RUNS WHEN SENSOR IS CONNECTED
-            # SEND SCHEDULED MESSAGES MUST BE RUN FIRST 
-            self.send_scheduled_messages()
-            # sensor is connected with no data
-            if self.ble.current_sample_size <= 0:
-                # sensor reconncected with no data available
-                if self.underwater:
-                    logger.warning('sensor reconnected with no data, try again')
-                    self.sensor_underwater.emit("False")
-                self.ysi_do_mgl_arr = []
-                continue # continue sampling
-            # sensor has data
-            elif self.ble.current_sample_size > 0:
-                # sensor is actively collecting data
-                if self.ble.prev_sample_size < self.ble.current_sample_size:
-                    # underwater, trigger any underwater events
-                    if not self.underwater:
-                        self.sensor_underwater.emit("True")
-                        logger.info('sensor is collecting data while connected')
-                    continue # continue sampling
-
-            # ignore sample sizes less than 10, reset ysi mgl array
-            if self.ble.current_sample_size < 10:
-                logger.warning(f"sensor reconnected with {self.ble.current_sample_size} data points, try again")
-                if self.underwater:
-                    self.sensor_underwater.emit("False")
-                self.ble.set_sample_reset()
-                self.ysi_do_mgl_arr = []
-                continue
-            
-            # RUNS WHEN DATA IS AVAILABLE
-
-            self.sensor_underwater.emit("False")
-
-            message_time = time.strftime('%Y%m%d_%H:%M:%S', time.gmtime()) #GMT time
+    def step_connected(self):
+        # once underwater, a link that is still up keeps being polled,
+        # the next answered message clears the timeout that flagged the disconnect
+        if not self.ble.check_connection_status() and self.state != State.underwater:
+            logger.debug('sensor disconnected')
+            self.sync_ble_sdata()
+            self.set_state(State.underwater)
+            return time.monotonic()
+
+        # SEND SCHEDULED MESSAGES MUST BE RUN FIRST 
+        self.sample_size_polled = False
+        self.send_scheduled_messages()
+        if self.sample_size_polled:
+            self.check_sample_size()
+        if self.state == State.transferring:
+            return time.monotonic()
+        next_step = time.monotonic() + self.connection_check_period
+        # scheduled messages are paused outside normal mode
+        if self.mode == Mode.normal:
+            next_step = min(next_step, self.scheduler.next_deadline())
+        return next_step
+
+    def check_sample_size(self):
+        '''
+        Decides the next state from a fresh sample size poll
+        '''
+        current_size = self.ble.current_sample_size
+        # sensor is connected with no data
+        if current_size <= 0:
+            # sensor reconncected with no data available
+            if self.state == State.underwater:
+                logger.warning('sensor reconnected with no data, try again')
+            self.ysi_samples = []
+            self.set_state(State.idle)
+        # sensor is actively collecting data
+        elif self.ble.prev_sample_size < current_size:
+            if self.state != State.underwater:
+                logger.info('sensor is collecting data while connected')
+            self.set_state(State.underwater)
+        # ignore sample sizes less than 10, reset ysi mgl array
+        elif current_size < 10:
+            logger.warning(f"sensor reconnected with {current_size} data points, try again")
+            self.ble.set_sample_reset()
+            self.ysi_samples = []
+            self.set_state(State.idle)
+        # data is available
+        else:
+            self.set_state(State.transferring)
+
+    def step_transferring(self):
+        message_time = time.strftime('%Y%m%d_%H:%M:%S', time.gmtime()) #GMT time
+        with QMutexLocker(self.sdata_mutex):
             self.sdata['message_time'] = message_time
 
-            self.ble.get_sample_data()  # retrieve data 
-            self.sync_ble_sdata()       # sync data to self.sdata
-            self.generate_pond_data()   # start firebase/display routine
-            self.ble.set_sample_reset() # reset sample buffer
-            self.ysi_do_mgl_arr = []    # clear ysi data buffer
-            # END MAIN LOOP
+        # retrieve data, resumes after reconnect if the link drops mid transfer
+        if not self.ble.get_sample_data_chunked() and not self.ble.uart_connection.connected:
+            self.set_state(State.disconnected)
+            return time.monotonic()
+
+        self.set_state(State.processing)
+        self.sync_ble_sdata()       # sync data to self.sdata
+        self.generate_pond_data()   # start firebase/display routine, runs off thread
+        self.ble.set_sample_reset() # reset sample buffer
+        self.ysi_samples = []       # clear ysi data buffer
+        return time.monotonic()
+
+    def step_processing(self):
+        # idle once the off thread fit is done, on_fit_done wakes the thread
+        if self.processing is None or self.processing.done():
+            self.processing = None
+            self.set_state(State.idle)
+            return time.monotonic()
+        return time.monotonic() + self.connection_check_period
 
     def sync_ble_sdata(self):
         '''
         transfer all ble data to truck's sdata dict
         '''
-        if not self.underwater:
-            for key in self.ble.sdata:
-                self.sdata[key] = self.ble.sdata[key]
-            
-            self.update_data.emit(self.sdata)
+        if self.state != State.underwater:
+            with QMutexLocker(self.sdata_mutex):
+                self.sdata.update(self.ble.sdata)
+                scalars = self.sdata.scalars()
+            self.display.publish(scalars)
         else:
             logger.debug("did not sync ble sdata while underwater")
 
     def abort(self):
         self._abort = True
+        self._wakeup.set()
 
     def generate_pond_data(self):
-
-        sample_duration = len(self.sdata['do_vals']) / self.sdata['sample_hz']
-        self.sdata['sample_duration'] = sample_duration
-
-        # IDEAL RECORD TIME FOR DATA
-        record_time = 30 #TODO: this should be in setting.setting
-
-        # water temperature
-        self.water_temp = sum(self.sdata['temp_vals'])/len(self.sdata['temp_vals'])
-        self.sdata['water_temp'] = self.water_temp
-        # Pressure
-        self.air_pressure = self.sdata['init_pressure']
-        self.sdata['sample_pressure'] = sum(self.sdata['pressure_vals'])/len(self.sdata['pressure_vals'])
-        self.sample_depth = pressure_to_depth(self.sdata['sample_pressure'], self.air_pressure)
-        
-        self.sdata['sample_depth'] = self.sample_depth
-
-        #  HBOI DO
-        do_arr = self.sdata['do_vals']
-        p, f = calculate_do_fit(do_arr, record_time, self.sdata['sample_hz'])
-        do_guess = generate_do(record_time, p, f)
-        # only accept values from curve fit if in reasonable range
-        do = do_guess if (5 * max(do_arr) > do_guess > 0) else do_arr[-1]
-        do_mgl_arr = convert_raw_to_mgl(do_arr, self.water_temp, self.air_pressure)
-        do_mgl = convert_raw_to_mgl(do, self.water_temp, self.air_pressure)
-        
-        # YSI DO
-        # ensure ysi_do_mgl_arr has size greater than 0 (occurred in field)
-        # reference branch "sensor_reconnect_bug"
-        if len(self.ysi_do_mgl_arr) == 0:
-            self.ysi_do_mgl_arr = [0]
-            logger.error("ysi_do_mgl_arr cleared prematurely, ysi data lost")
-            
-        p, f = calculate_do_fit(self.ysi_do_mgl_arr,record_time, self.sdata['sample_hz'])
-        do_guess = generate_do(record_time, p, f)
-        # only accept values from curve fit if in reasonable range
-        ysi_do_mgl = do_guess if (5 * max(self.ysi_do_mgl_arr) > do_guess > 0) else self.ysi_do_mgl_arr[-1]
-        ysi_do_arr = convert_mgl_to_raw(self.ysi_do_mgl_arr, self.water_temp, self.air_pressure)
-        ysi_do = convert_mgl_to_raw(ysi_do_mgl, self.water_temp, self.air_pressure)
-
-        #TODO: JUST RETURN SDATA
-        
-        self.sdata["ysi_do"] = ysi_do
-        self.sdata["ysi_do_mgl"] = ysi_do_mgl
-        self.sdata['do'] = do
-        self.sdata['do_mgl'] = do_mgl
-        self.sdata['do_mgl_arr'] = do_mgl_arr
-        self.sdata['ysi_do_mgl_arr'] = self.ysi_do_mgl_arr
-        self.sdata['ysi_do_arr'] = ysi_do_arr
-
-        self.update_pond_data.emit(self.sdata)
-        self.update_data.emit(self.sdata)
+        '''
+        Hands the dive to the processing pool and returns immediately.
+        Results come back through fit_complete (see on_fit_complete).
+        '''
+        with QMutexLocker(self.sdata_mutex):
+            sdata = self.sdata.copy()
+        # YSI capture on the BLE time base (sensor's first sample), aligned in process_pond_data
+        offset = self.ble_time_offset(len(sdata.get('do_vals', [])), sdata['sample_hz'])
+        sdata['ysi_time_offset'] = offset
+        ysi = np.array(self.ysi_samples, dtype=float).reshape(-1, 2)
+        sdata['ysi_time_arr'] = ysi[:, 0] - self.dive_start + offset
+        sdata['ysi_raw_mgl_arr'] = ysi[:, 1]
+        self.processing = self.process_pool.submit(process_pond_data, sdata, self.fit_pool, self.fit_warm_start)
+        self.processing.add_done_callback(lambda future: self.on_fit_done(sdata, future))
+
+    def ble_time_offset(self, sample_count, sample_hz):
+        '''
+        Seconds between the sensor's first sample and the underwater transition.
+        The sensor stops sampling when it surfaces, at the latest when it reconnects,
+        so its first sample was taken sample_count / sample_hz before the reconnect
+        or earlier. The estimate is a lower bound, tight when the reconnect follows
+        the surfacing closely. Falls back to ble_drop_delay without a usable reconnect.
+        '''
+        if self.reconnect_time is None or self.reconnect_time < self.dive_start or sample_hz <= 0:
+            return self.ble_drop_delay
+        offset = self.dive_start - (self.reconnect_time - sample_count / sample_hz)
+        if not 0 <= offset <= self.max_ble_offset:
+            logger.debug(f"ble time offset {offset:.2f} s out of range, using {self.ble_drop_delay} s")
+            return self.ble_drop_delay
+        logger.debug(f"ble time offset {offset:.2f} s")
+        return offset
+
+    def on_fit_done(self, sdata, future):
+        # runs on the pool thread. sdata is the copy made for this dive, owned by the
+        # pool until fit_complete is emitted (queued to the GUI thread, see on_fit_complete)
+        try:
+            result = future.result()
+        except Exception as e:
+            logger.error("pond data processing failed %s", e)
+            result = None
+        if result is not None:
+            sdata.update(result)
+            self.fit_complete.emit(sdata)
+        # let the state machine leave processing
+        self._wakeup.set()
+
+    def on_fit_complete(self, sdata):
+        # runs on the GUI thread, the results are merged into self.sdata under sdata_mutex
+        self.water_temp = sdata['water_temp']
+        self.air_pressure = sdata['init_pressure']
+        self.sample_depth = sdata['sample_depth']
+        with QMutexLocker(self.sdata_mutex):
+            for key in ('do', 'do_mgl', 'ysi_do', 'ysi_do_mgl'):
+                self.sdata[key] = sdata[key]
+
+        self.update_pond_data.emit(sdata)
+        self.display.publish(sdata.scalars())
 
     def toggle_unit(self, unit):
         self.unit = unit
@@ -345,25 +595,11 @@ class TruckSensor(QThread):
            data_dict['ysi_do'] = self.sdata['ysi_do']
            data_dict['ysi_do_mgl'] = self.sdata['ysi_do_mgl']
 
-        self.update_data.emit(data_dict)
+        self.display.publish(data_dict, force=True)
 
     def update_database(self, data_dict):
         '''
         Use argument data_dict instead of self.sdata because it may contain user-corrected variables
         '''
         time_str = datetime.now().strftime("%H:%M:%S")
-
-        row = {
-            "time": time_str,
-            "pond_id": data_dict['pid'],
-            "hboi_do": round(data_dict['do'],2),
-            "hboi_do_mgl":round(data_dict['do_mgl'],2),
-            "ysi_do": round(data_dict['ysi_do'],2),
-            "ysi_do_mgl": round(data_dict['ysi_do_mgl'],2),
-            "temperature": round(data_dict['water_temp'],2),
-            "depth": round(data_dict['sample_depth'],2),
-            "upload_status": False,
-            "message_time": data_dict['message_time'],
-        }
-        self.firebase_worker.add_sdata(data_dict, row)
-
+        self.firebase_worker.add_sdata(data_dict, database_row(data_dict, time_str))
@@ -0,0 +1,16 @@
+import os
+import sys
+
+import pytest
+
+# the application modules import each other as top level modules from code/
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'code'))
+
+
+@pytest.fixture(scope="session")
+def qapp():
+    '''
+    Qt core application for timers and queued signals, kept for the whole session
+    '''
+    from PyQt5.QtCore import QCoreApplication
+    return QCoreApplication.instance() or QCoreApplication([])
@@ -0,0 +1,88 @@
+import time
+
+import numpy as np
+
+from bt_sensor import decode_sample_block, missing_ranges
+
+
+def sample_dump(rows, corrupt=()):
+    rng = np.random.default_rng(0)
+    lines = [f"ts,{i},do,{rng.uniform(0, 200):.3f},t,{rng.uniform(20, 30):.2f},p,{rng.uniform(1000, 1100):.1f}"
+             for i in range(rows)]
+    for i in corrupt:
+        lines[i] = lines[i].replace("do,", "do,--")
+    return ("\n".join(lines) + "\n").encode()
+
+
+def decode_per_line(buf):
+    # the line by line parse decode_sample_block replaced
+    rows = []
+    for line in buf.decode().split("\n"):
+        value = line.split(",")
+        if value[0] != "ts":
+            continue
+        try:
+            rows.append((float(value[1]), float(value[3]), float(value[5]), float(value[7])))
+        except (ValueError, IndexError):
+            rows.append((np.nan,) * 4)
+    return np.array(rows)
+
+
+def best_time(function, *args, repeat=5):
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        function(*args)
+        times.append(time.perf_counter() - start)
+    return min(times)
+
+
+def test_decodes_every_ts_line():
+    index, do, temp, pressure, valid = decode_sample_block(b"ts,0,do,1.5,t,20.25,p,1013\r\nts,1,do,-0.5,t,21,p,1014\n")
+    np.testing.assert_array_equal(index, [0, 1])
+    np.testing.assert_array_equal(do, [1.5, -0.5])
+    np.testing.assert_array_equal(temp, [20.25, 21])
+    np.testing.assert_array_equal(pressure, [1013, 1014])
+    assert valid.all()
+
+
+def test_corrupted_rows_are_nan():
+    buf = (b"ts,0,do,1.5,t,20,p,1000\n"
+           b"ts,1,do,--0.8,t,20,p,1000\n"   # double sign
+           b"ts,2,do,2\n"                   # cut off
+           b"ts,3,do,3,t,nan,p,1000\n"      # parses, not a sensor value
+           b"ts,4,do,4,t,21.5,p,1001\n")
+    index, do, temp, pressure, valid = decode_sample_block(buf)
+    np.testing.assert_array_equal(valid, [True, False, False, False, True])
+    assert np.isnan(np.column_stack([index, do, temp, pressure])[~valid]).all()
+    np.testing.assert_array_equal(do[valid], [1.5, 4])
+
+
+def test_other_lines_are_skipped():
+    index, do, _, _, valid = decode_sample_block(b"ts,0,do,1,t,2,p,3\nsome noise\n\nts,1,do,4,t,5,p,6\n")
+    np.testing.assert_array_equal(index, [0, 1])
+    np.testing.assert_array_equal(do, [1, 4])
+    assert valid.all()
+
+
+def test_empty_dump():
+    index, _, _, _, valid = decode_sample_block(b"")
+    assert len(index) == 0 and len(valid) == 0
+
+
+def test_matches_per_line_parse():
+    buf = sample_dump(1000, corrupt=range(0, 1000, 97))
+    decoded = np.column_stack(decode_sample_block(buf)[:4])
+    np.testing.assert_array_equal(decoded, decode_per_line(buf))
+
+
+def test_faster_than_per_line_parse():
+    buf = sample_dump(20000)
+    assert best_time(decode_sample_block, buf) < best_time(decode_per_line, buf)
+
+
+def test_missing_ranges():
+    received = np.ones(10, dtype=bool)
+    received[[2, 3, 4, 8]] = False
+    assert missing_ranges(received, chunk_size=2) == [(2, 2), (4, 1), (8, 1)]
+    assert missing_ranges(np.ones(4, dtype=bool), chunk_size=2) == []
@@ -0,0 +1,78 @@
+import threading
+
+import numpy as np
+import pytest
+from PyQt5.QtCore import QCoreApplication
+
+from display_channel import DisplayChannel
+
+
+@pytest.fixture
+def channel(qapp):
+    channel = DisplayChannel(rate_hz=5)
+    channel.timer.stop()  # flushed by the tests
+    channel.received = []
+    channel.updated.connect(channel.received.append)
+    return channel
+
+
+def test_updates_between_ticks_are_coalesced(channel):
+    for do in (0.5, 0.6, 0.7):
+        channel.publish({'do': do, 'do_mgl': 10 * do})
+    channel.flush()
+    assert channel.received == [{'do': 0.7, 'do_mgl': 7.0}]
+
+
+def test_only_changed_fields_are_delivered(channel):
+    channel.publish({'water_temp': 28.0, 'name': 'sim01'})
+    channel.flush()
+    channel.publish({'water_temp': 28.0, 'name': 'sim02'})
+    channel.flush()
+    channel.publish({'water_temp': 28.0, 'name': 'sim02'})
+    channel.flush()
+    assert channel.received == [{'water_temp': 28.0, 'name': 'sim01'}, {'name': 'sim02'}]
+    assert channel.deliveries == 2
+
+
+def test_groups_are_delivered_together(channel):
+    channel.publish({'do': 0.5, 'do_mgl': 5.0})
+    channel.flush()
+    channel.publish({'do': 0.6, 'do_mgl': 5.0})
+    channel.flush()
+    assert channel.received[-1] == {'do': 0.6, 'do_mgl': 5.0}
+
+
+def test_forced_fields_are_delivered_unchanged(channel):
+    channel.publish({'do': 0.5})
+    channel.flush()
+    channel.publish({'do': 0.5}, force=True)
+    channel.flush()
+    assert channel.received == [{'do': 0.5}, {'do': 0.5}]
+
+
+def test_arrays_are_not_delivered(channel):
+    channel.publish({'do_vals': np.ones(10), 'do': 0.5})
+    channel.flush()
+    assert channel.received == [{'do': 0.5}]
+
+
+def test_publish_from_other_threads(channel):
+    threads = [threading.Thread(target=lambda i=i: [channel.publish({f'field{i}': n}) for n in range(100)])
+               for i in range(4)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    channel.flush()
+    assert channel.received == [{f'field{i}': 99 for i in range(4)}]
+
+
+def test_timer_delivers(channel):
+    channel.timer.start()
+    channel.publish({'do': 0.5})
+    for _ in range(100):
+        QCoreApplication.processEvents()
+        if channel.received:
+            break
+        threading.Event().wait(0.01)
+    assert channel.received == [{'do': 0.5}]
@@ -0,0 +1,58 @@
+from PyQt5.QtCore import QMutex
+
+from ble_simulator import SimulatedSensor, SimulatedBLERadio
+from bt_sensor import BluetoothReader
+
+
+def sensor_reader(surface_duration=3600):
+    sensor = SimulatedSensor(surface_duration=surface_duration, seed=1)
+    reader = BluetoothReader(QMutex(), radio=SimulatedBLERadio(sensor, connect_time=0))
+    reader.direct_timeout = 0.2
+    reader.scan_timeout = 0.3
+    reader.candidate_window = 0
+    return sensor, reader
+
+
+def drop_link(reader):
+    reader.uart_connection.disconnect()
+    reader.uart_reader.abort()
+
+
+def swap_sensor(sensor):
+    sensor.name = "HAUCS_DO_sim02"
+    sensor.address = "sim:00:00:00:00:02"
+
+
+def test_reconnects_to_known_sensor():
+    sensor, reader = sensor_reader()
+    assert reader.connect()
+    assert reader.known_name == sensor.name
+    drop_link(reader)
+    assert reader.connect()
+    assert reader.known_failures == 0
+    drop_link(reader)
+
+
+def test_keeps_known_sensor_for_a_while():
+    sensor, reader = sensor_reader()
+    assert reader.connect()
+    drop_link(reader)
+    swap_sensor(sensor)
+    # the known sensor may just be underwater, other sensors are not accepted yet
+    for attempt in range(reader.forget_after):
+        assert not reader.connect()
+    assert reader.known_name == "HAUCS_DO_sim01"
+
+
+def test_finds_renamed_sensor():
+    sensor, reader = sensor_reader()
+    reader.forget_after = 2
+    reader.forget_timeout = 0
+    assert reader.connect()
+    drop_link(reader)
+    swap_sensor(sensor)
+    assert not reader.connect()
+    assert reader.connect()
+    assert reader.known_name == "HAUCS_DO_sim02"
+    assert reader.known_address == "sim:00:00:00:00:02"
+    drop_link(reader)
@@ -0,0 +1,99 @@
+import os
+
+import numpy as np
+import pytest
+from PyQt5.QtCore import QMutex
+
+from firebase_worker import FirebaseWorker, upload_date
+from session import Session, database_row
+from session_store import SessionStore, local_time
+
+
+def session(message_time, do=0.8):
+    return Session(message_time=message_time, pid='p1', do=do, do_mgl=7.0, ysi_do=0.7, ysi_do_mgl=6.5,
+                   water_temp=28.0, sample_depth=1.2, sample_hz=1, do_vals=np.linspace(1, do, 20),
+                   sample_valid=np.ones(20, dtype=bool))
+
+
+@pytest.fixture
+def worker(tmp_path):
+    worker = FirebaseWorker(QMutex(), data_folder=str(tmp_path), upload=False)
+    yield worker
+    worker.store.close()
+    worker.database.close()
+
+
+def add(worker, sdata):
+    worker.add_sdata(sdata, database_row(sdata, local_time(sdata['message_time'])[1]))
+
+
+def restart(worker, tmp_path):
+    worker.store.close()
+    worker.database.close()
+    return FirebaseWorker(QMutex(), data_folder=str(tmp_path), upload=False)
+
+
+def test_store_round_trip(tmp_path):
+    store = SessionStore(str(tmp_path / "sessions.db"))
+    sdata = session("20260101_12:00:00")
+    store.add(sdata, "2026-01-01", "12:00:00")
+    loaded = store.load("20260101_12:00:00")
+    assert loaded['do'] == sdata['do']
+    np.testing.assert_array_equal(loaded['do_vals'], sdata['do_vals'])
+    np.testing.assert_array_equal(loaded['sample_valid'], sdata['sample_valid'])
+    assert [row['message_time'] for row in store.pending()] == ["20260101_12:00:00"]
+    store.mark_uploaded(["20260101_12:00:00"])
+    assert store.pending() == []
+    assert store.load("20260102_12:00:00") is None
+    store.close()
+
+
+def test_pending_sessions_are_queued_after_restart(worker, tmp_path):
+    add(worker, session("20260101_12:00:00"))
+    add(worker, session("20260101_12:05:00"))
+    worker.complete_uploads([worker.sdatas[0]])
+    worker = restart(worker, tmp_path)
+    worker.recover()
+    assert [sdata['message_time'] for sdata in worker.sdatas] == ["20260101_12:05:00"]
+    assert os.path.exists(os.path.join(worker.completed_folder, "20260101_12-00-00.pickle"))
+
+
+def test_pickles_without_store_are_imported(worker, tmp_path):
+    add(worker, session("20260101_12:00:00"))
+    worker.store.close()
+    os.remove(worker.store.path)
+    worker = restart(worker, tmp_path)
+    worker.recover()
+    assert [sdata['message_time'] for sdata in worker.sdatas] == ["20260101_12:00:00"]
+    assert worker.store.load("20260101_12:00:00")['do'] == 0.8
+
+
+def test_uploads_in_the_journal_are_not_sent_again(worker, tmp_path):
+    add(worker, session("20260101_12:00:00"))
+    add(worker, session("20260101_12:05:00"))
+    # uploaded, the store update was lost
+    worker.database.mark_uploaded(["20260101_12:00:00"], upload_date("20260101_12:00:00"))
+    worker = restart(worker, tmp_path)
+    worker.recover()
+    assert [sdata['message_time'] for sdata in worker.sdatas] == ["20260101_12:05:00"]
+    assert [sdata['message_time'] for sdata in worker.store.pending()] == ["20260101_12:05:00"]
+    assert os.path.exists(os.path.join(worker.completed_folder, "20260101_12-00-00.pickle"))
+
+
+def test_uploads_disabled(worker):
+    add(worker, session("20260101_12:00:00"))
+    assert worker.upload_pending() is None
+    assert len(worker.sdatas) == 1
+
+
+def test_corrupted_samples_keep_the_array_shape(worker):
+    sdata = session("20260101_12:00:00")
+    sdata['do_vals'][3] = np.nan
+    sdata.update(dict(temp_vals=np.full(20, 28.0), pressure_vals=np.full(20, 1100.0),
+                      ysi_raw_mgl_arr=np.full(5, 6.5), hdg=0, init_pressure=1013, lat=27.5, lng=-80.3,
+                      name='sim01', battv=3.9))
+    path, data = worker.firebase_payload(sdata)
+    assert path == "pond_p1/20260101_12:00:00"
+    assert len(data['do']) == 20
+    assert data['do'][3] == -1
+    assert all(isinstance(value, float) for value in data['do'])
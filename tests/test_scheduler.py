@@ -0,0 +1,100 @@
+import threading
+import time
+
+import pytest
+
+from priority import Priority
+from scheduler import DeadlineScheduler
+
+
+def test_due_tasks_run_by_priority():
+    scheduler = DeadlineScheduler()
+    ran = []
+    scheduler.add("low", lambda: ran.append("low"), 1, Priority.low)
+    scheduler.add("high", lambda: ran.append("high"), 1, Priority.high)
+    scheduler.add("medium", lambda: ran.append("medium"), 1, Priority.medium)
+    assert scheduler.run_pending() == 3
+    assert ran == ["high", "medium", "low"]
+
+
+def test_tasks_below_min_priority_are_skipped():
+    scheduler = DeadlineScheduler()
+    ran = []
+    scheduler.add("low", lambda: ran.append("low"), 1, Priority.low)
+    scheduler.add("high", lambda: ran.append("high"), 1, Priority.high)
+    assert scheduler.run_pending(Priority.high) == 1
+    assert ran == ["high"]
+    assert scheduler.stats()["low"]["skipped"] == 1
+
+
+def test_next_run_is_one_period_later():
+    scheduler = DeadlineScheduler()
+    scheduler.add("task", lambda: None, 10)
+    scheduler.run_pending()
+    task = scheduler.tasks["task"]
+    assert task.deadline == pytest.approx(task.last_run + 10, abs=0.01)
+    assert scheduler.run_pending() == 0
+
+
+def test_set_period_counts_from_the_last_run():
+    scheduler = DeadlineScheduler()
+    scheduler.add("task", lambda: None, 10)
+    scheduler.run_pending()
+    task = scheduler.tasks["task"]
+    # a reschedule moves the deadline away from last run + period
+    scheduler.reschedule("task", delay=5)
+    scheduler.set_period("task", 2)
+    assert task.deadline == pytest.approx(task.last_run + 2, abs=0.01)
+
+
+def test_set_period_before_the_first_run_keeps_the_deadline():
+    scheduler = DeadlineScheduler()
+    scheduler.add("task", lambda: None, 10, delay=3)
+    deadline = scheduler.tasks["task"].deadline
+    scheduler.set_period("task", 1)
+    assert scheduler.tasks["task"].deadline == deadline
+    assert scheduler.tasks["task"].period == 1
+
+
+def test_reschedule_and_remove():
+    scheduler = DeadlineScheduler()
+    ran = []
+    scheduler.add("task", lambda: ran.append(1), 10, delay=10)
+    assert scheduler.run_pending() == 0
+    scheduler.reschedule("task")
+    assert scheduler.run_pending() == 1
+    scheduler.reschedule("task")
+    scheduler.remove("task")
+    assert scheduler.run_pending() == 0
+    assert scheduler.next_deadline() is None
+    assert ran == [1]
+
+
+def test_jitter_stays_within_bounds():
+    scheduler = DeadlineScheduler()
+    start = time.monotonic()
+    for i in range(20):
+        scheduler.add(f"task{i}", lambda: None, 1, delay=1, jitter=0.5)
+    deadlines = [task.deadline - start for task in scheduler.tasks.values()]
+    assert all(1 <= deadline <= 1.5 + 0.01 for deadline in deadlines)
+    assert len(set(deadlines)) > 1
+
+
+def test_failing_callback_does_not_stop_the_others():
+    scheduler = DeadlineScheduler()
+    ran = []
+    scheduler.add("fails", lambda: 1 / 0, 1, Priority.high)
+    scheduler.add("task", lambda: ran.append(1), 1)
+    assert scheduler.run_pending() == 2
+    assert ran == [1]
+
+
+def test_wait_wakes_up_for_a_new_task():
+    scheduler = DeadlineScheduler()
+    scheduler.add("task", lambda: None, 10, delay=10)
+    timer = threading.Timer(0.05, lambda: scheduler.add("now", lambda: None, 1))
+    timer.start()
+    start = time.monotonic()
+    scheduler.wait(max_wait=5)
+    timer.join()
+    assert time.monotonic() - start < 1
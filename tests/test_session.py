@@ -0,0 +1,81 @@
+import io
+import os
+import pickle
+
+import numpy as np
+import pytest
+
+from session import Session, SESSION_VERSION
+
+LEGACY_PICKLE = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'code', 'test.pickle')
+
+
+def round_trip(session):
+    file = io.BytesIO()
+    session.save(file)
+    file.seek(0)
+    return Session.load(file)
+
+
+def test_mapping_access():
+    session = Session(pid='p1', do_vals=[1, 2, 3])
+    assert session['pid'] == 'p1'
+    assert 'do' not in session
+    assert session.get('do', 0) == 0
+    with pytest.raises(KeyError):
+        session['do']
+    with pytest.raises(KeyError):
+        session['not_a_field']
+    assert isinstance(session['do_vals'], np.ndarray)
+    assert session['do_vals'].dtype == np.float64
+
+
+def test_copy_is_independent():
+    session = Session(pid='p1', do_vals=[1, 2, 3])
+    copy = session.copy()
+    copy['do_vals'][0] = 10
+    copy['pid'] = 'p2'
+    assert session['do_vals'][0] == 1
+    assert session['pid'] == 'p1'
+
+
+def test_pickle_round_trip():
+    session = Session(pid='p1', message_time='20260101_12:00:00', sample_hz=2, do_vals=[1, 0.9],
+                      ysi_raw_mgl_arr=[7, 6.5], ysi_time_arr=[0.3, 1.3])
+    loaded = round_trip(session)
+    assert dict(loaded.scalars()) == dict(session.scalars())
+    np.testing.assert_array_equal(loaded['ysi_time_arr'], [0.3, 1.3])
+
+
+def test_version_1_upgrade():
+    # version 1 stored the YSI capture in ysi_do_mgl_arr, taken at sample_hz
+    data = {'version': 1, 'pid': 'p1', 'sample_hz': 2.0, 'ysi_do_mgl_arr': [7.0, 6.8, 6.6, 6.5]}
+    session = Session.from_dict(data)
+    np.testing.assert_array_equal(session['ysi_raw_mgl_arr'], [7.0, 6.8, 6.6, 6.5])
+    np.testing.assert_array_equal(session['ysi_time_arr'], [0, 0.5, 1.0, 1.5])
+    upgraded = round_trip(session)
+    np.testing.assert_array_equal(upgraded['ysi_time_arr'], [0, 0.5, 1.0, 1.5])
+
+
+def test_version_2_is_not_upgraded():
+    data = {'version': SESSION_VERSION, 'sample_hz': 2.0, 'ysi_do_mgl_arr': [7.0, 6.8],
+            'ysi_raw_mgl_arr': [7.1, 6.9, 6.7], 'ysi_time_arr': [0.2, 1.2, 2.2]}
+    session = Session.from_dict(data)
+    np.testing.assert_array_equal(session['ysi_raw_mgl_arr'], [7.1, 6.9, 6.7])
+    np.testing.assert_array_equal(session['ysi_time_arr'], [0.2, 1.2, 2.2])
+
+
+def test_unknown_fields_are_dropped():
+    session = Session.from_dict({'version': SESSION_VERSION, 'pid': 'p1', 'upload status': 'done'})
+    assert session.keys() == ['pid']
+
+
+def test_legacy_sdata_pickle():
+    with open(LEGACY_PICKLE, 'rb') as file:
+        session = Session.load(file)
+    assert session['pid'] == 'DHE'
+    assert session['message_time'] == '20250802_12:48:29'
+    assert len(session['do_vals']) == 19
+    ysi = session['ysi_do_mgl_arr']
+    np.testing.assert_array_equal(session['ysi_raw_mgl_arr'], ysi)
+    np.testing.assert_array_equal(session['ysi_time_arr'], np.arange(len(ysi)) / session['sample_hz'])
@@ -0,0 +1,76 @@
+import time
+
+import pytest
+from PyQt5.QtCore import QCoreApplication, QMutex
+
+from ble_simulator import SimulatedSensor, SimulatedBLERadio, SimulatedI2CReader
+from truck_sensor import SurfacingPolicy, TruckSensor, State
+
+
+@pytest.fixture
+def truck(qapp, tmp_path):
+    sensor = SimulatedSensor(seed=1)
+    truck = TruckSensor({}, {'depth_threshold': 6.0}, QMutex(), QMutex(), ble_radio=SimulatedBLERadio(sensor),
+                        sensors=SimulatedI2CReader(sensor), data_folder=str(tmp_path), upload=False)
+    truck.surfacing = SurfacingPolicy(sample_hz=1)
+    yield truck
+    truck.sensors.abort()
+    truck.firebase_worker.abort()
+    truck.sensors.wait()
+    truck.firebase_worker.wait()
+
+
+def test_holdoff_after_disconnect():
+    policy = SurfacingPolicy()
+    assert policy.can_reconnect()
+    policy.on_disconnect()
+    assert not policy.can_reconnect()
+    assert policy.reconnect_holdoff() == policy.default_holdoff
+
+
+def test_holdoff_follows_observed_dives():
+    policy = SurfacingPolicy()
+    policy.on_disconnect()
+    policy.disconnect_time -= 8
+    policy.on_reconnect()
+    assert policy.reconnect_holdoff() == pytest.approx(4, abs=0.1)
+    assert policy.can_reconnect()
+
+
+def test_link_lost_at_the_surface_is_not_a_dive():
+    policy = SurfacingPolicy()
+    policy.on_disconnect(dive=False)
+    policy.on_reconnect()
+    assert not policy.dive_durations
+
+
+def test_sample_size_poll_backoff():
+    policy = SurfacingPolicy(sample_hz=1)
+    fast = policy.poll_period
+    policy.on_sample_size(growing=True)
+    assert policy.poll_period == pytest.approx(fast * policy.poll_backoff)
+    for _ in range(20):
+        policy.on_sample_size(growing=True)
+    assert policy.poll_period == policy.max_poll
+    policy.on_sample_size(growing=False)
+    assert policy.poll_period == fast
+
+
+@pytest.mark.parametrize("state", [State.underwater, State.disconnected])
+def test_state_change_starts_holdoff(truck, state):
+    # e.g. underwater from a sample size poll while the link is still up
+    truck.set_state(State.idle)
+    truck.set_state(state)
+    assert truck.surfacing.disconnect_time == pytest.approx(time.monotonic(), abs=0.5)
+    assert not truck.surfacing.can_reconnect()
+
+
+def test_underwater_status_is_delivered_by_signal(truck):
+    truck.set_state(State.idle)
+    truck.set_state(State.underwater)
+    # queued when set_state runs on the state machine thread
+    QCoreApplication.processEvents()
+    assert truck.underwater
+    truck.set_state(State.transferring)
+    QCoreApplication.processEvents()
+    assert not truck.underwater
@@ -0,0 +1,103 @@
+import random
+
+import numpy as np
+import pytest
+from PyQt5.QtCore import QMutex
+
+from ble_simulator import SimulatedSensor, SimulatedBLERadio, SimulatedFirmware, SimulatedUARTService
+from bt_sensor import BluetoothReader
+
+SAMPLES = 150
+
+
+@pytest.fixture
+def sensor():
+    sensor = SimulatedSensor(surface_duration=3600, seed=1)
+    rng = np.random.default_rng(1)
+    sensor.firmware.samples = [(rng.uniform(0.5, 1.0), rng.uniform(25, 30), rng.uniform(1000, 1100))
+                               for _ in range(SAMPLES)]
+    return sensor
+
+
+def connected_reader(sensor, corruption=0.0):
+    reader = BluetoothReader(QMutex(), radio=SimulatedBLERadio(sensor, corruption=corruption, connect_time=0))
+    assert reader.connect()
+    reader.get_sample_size()
+    assert reader.current_sample_size == SAMPLES
+    return reader
+
+
+def expected(sensor):
+    # values as formatted by the firmware
+    return np.array([[float(value) for value in sensor.firmware.format_sample(i).split(",")[3::2]]
+                     for i in range(SAMPLES)])
+
+
+def received(reader):
+    return np.column_stack([reader.sdata['do_vals'], reader.sdata['temp_vals'], reader.sdata['pressure_vals']])
+
+
+def test_chunked_transfer(sensor):
+    reader = connected_reader(sensor)
+    assert reader.get_sample_data_chunked(chunk_size=64)
+    np.testing.assert_array_equal(received(reader), expected(sensor))
+    assert reader.sdata['sample_valid'].all()
+
+
+def test_transfer_resumes_after_disconnect(sensor):
+    reader = connected_reader(sensor)
+    requests = []
+    drops = [2]  # the link drops at the second request
+    get_sample_range = reader.get_sample_range
+
+    def drop_after_first_chunk(start, count, timeout=1):
+        requests.append((start, count))
+        if len(requests) in drops:
+            drops.clear()
+            reader.uart_connection.disconnect()
+            return None
+        return get_sample_range(start, count, timeout)
+
+    reader.get_sample_range = drop_after_first_chunk
+    assert not reader.get_sample_data_chunked(chunk_size=64)
+    assert np.count_nonzero(reader.transfer['received']) == 64
+
+    assert reader.reconnect()
+    requests.clear()
+    assert reader.get_sample_data_chunked(chunk_size=64)
+    # only the samples that had not arrived are requested again
+    assert requests == [(64, 64), (128, 22)]
+    np.testing.assert_array_equal(received(reader), expected(sensor))
+
+
+def test_corrupted_samples_are_requested_again(sensor, monkeypatch):
+    # substituted bytes only, a line cut off inside its last field still parses
+    # (the protocol has no checksum)
+    def substitute(service, line):
+        if not line or random.random() >= service.corruption:
+            return line
+        pos = random.randrange(len(line))
+        return line[:pos] + b"#" + line[pos + 1:]
+
+    monkeypatch.setattr(SimulatedUARTService, "corrupt", substitute)
+    random.seed(2)
+    reader = connected_reader(sensor, corruption=0.05)
+    reader.get_sample_data_chunked(chunk_size=32, max_rounds=10)
+    valid = reader.sdata['sample_valid']
+    assert valid.all()
+    np.testing.assert_array_equal(received(reader), expected(sensor))
+
+
+def test_firmware_ignoring_ranges_falls_back_to_full_print(sensor, monkeypatch):
+    handle = SimulatedFirmware.handle
+
+    def ignore_range(firmware, line):
+        if line.strip().lower().startswith("sample print"):
+            line = "sample print"
+        return handle(firmware, line)
+
+    monkeypatch.setattr(SimulatedFirmware, "handle", ignore_range)
+    reader = connected_reader(sensor)
+    assert reader.get_sample_data_chunked(chunk_size=64)
+    assert reader.transfer is None
+    np.testing.assert_array_equal(received(reader), expected(sensor))
@@ -0,0 +1,109 @@
+import threading
+import time
+
+import numpy as np
+import pytest
+from PyQt5.QtCore import QMutex
+
+from firebase_worker import FirebaseWorker
+from session import Session, database_row
+from session_store import local_time
+
+
+def session(message_time, samples=20):
+    return Session(message_time=message_time, pid='p1', do=0.8, do_mgl=7.0, ysi_do=0.7, ysi_do_mgl=6.5,
+                   water_temp=28.0, sample_depth=1.2, sample_hz=1, hdg=0, init_pressure=1013, lat=27.5, lng=-80.3, name='sim01', battv=3.9,
+                   do_vals=np.linspace(1, 0.8, samples), temp_vals=np.full(samples, 28.0),
+                   pressure_vals=np.full(samples, 1100.0), ysi_raw_mgl_arr=np.full(samples, 6.5),
+                   sample_valid=np.ones(samples, dtype=bool))
+
+
+@pytest.fixture
+def worker(tmp_path, monkeypatch):
+    worker = FirebaseWorker(QMutex(), data_folder=str(tmp_path))
+    worker.uploads = []
+    monkeypatch.setattr(worker, "reachable", lambda: True)
+    monkeypatch.setattr(worker, "update_firebase", lambda payload: worker.uploads.append(payload) or True)
+    yield worker
+    worker.store.close()
+    worker.database.close()
+
+
+def add(worker, sdata):
+    worker.add_sdata(sdata, database_row(sdata, local_time(sdata['message_time'])[1]))
+
+
+def test_backoff_grows_and_is_capped(worker):
+    delays = [worker.backoff() for _ in range(12)]
+    for failures, delay in enumerate(delays, 1):
+        limit = min(worker.retry_max, worker.retry_min * 2 ** (failures - 1))
+        assert limit / 2 <= delay <= limit
+    assert max(delays) <= worker.retry_max
+
+
+def test_unreachable_host_backs_off(worker, monkeypatch):
+    monkeypatch.setattr(worker, "reachable", lambda: False)
+    add(worker, session("20260101_12:00:00"))
+    first = worker.upload_pending()
+    second = worker.upload_pending()
+    assert worker.retry_min / 2 <= first <= worker.retry_min
+    assert worker.retry_min <= second <= 2 * worker.retry_min
+    assert worker.failures == 2
+    assert worker.uploads == []
+
+
+def test_failed_upload_backs_off_and_keeps_the_queue(worker, monkeypatch):
+    monkeypatch.setattr(worker, "update_firebase", lambda payload: False)
+    add(worker, session("20260101_12:00:00"))
+    assert worker.upload_pending() is not None
+    assert len(worker.sdatas) == 1
+    assert len(worker.store.pending()) == 1
+
+
+def test_success_resets_the_backoff(worker):
+    add(worker, session("20260101_12:00:00"))
+    worker.failures = 5
+    assert worker.upload_pending() is None
+    assert worker.failures == 0
+    assert worker.last_success is not None
+    assert worker.sdatas == []
+    assert worker.store.pending() == []
+    assert list(worker.uploads[0]) == ["pond_p1/20260101_12:00:00"]
+
+
+def test_nothing_queued_waits_for_work(worker):
+    assert worker.upload_pending() is None
+    assert worker.failures == 0
+
+
+def test_sessions_are_batched(worker):
+    worker.max_batch_sessions = 3
+    for minute in range(7):
+        add(worker, session(f"20260101_12:{minute:02d}:00"))
+    assert worker.upload_pending() is None
+    assert [len(payload) for payload in worker.uploads] == [3, 3, 1]
+    # newest first
+    assert list(worker.uploads[0])[0] == "pond_p1/20260101_12:06:00"
+
+
+def test_batches_respect_the_size_limit(worker):
+    worker.max_batch_bytes = 1
+    for minute in range(3):
+        add(worker, session(f"20260101_12:{minute:02d}:00"))
+    worker.upload_pending()
+    assert [len(payload) for payload in worker.uploads] == [1, 1, 1]
+
+
+def test_wakeup_ends_the_backoff_wait(worker):
+    threading.Timer(0.05, worker.wakeup).start()
+    start = time.monotonic()
+    worker.wait_for_work(30)
+    assert time.monotonic() - start < 5
+    assert worker.next_attempt is None
+
+
+def test_pending_wakeup_is_not_lost(worker):
+    worker.wakeup()
+    start = time.monotonic()
+    worker.wait_for_work(30)
+    assert time.monotonic() - start < 1
@@ -0,0 +1,203 @@
+'''
+Batch re-analysis of recorded sessions.
+
+Refits every session in completed/ and unsaved/ (or the given folders) with the
+current DO extrapolation (pond_data.process_pond_data, calculate_do_fit and
+generate_do) and writes one row per session to a results table tagged with
+pond_data.ANALYSIS_VERSION and the record time. Sessions already refit ok for
+the same version and record time are skipped, so an interrupted run picks up
+where it stopped. Sessions that failed are retried, their new row replaces the
+old one.
+
+usage:
+    python tools/refit.py                                   # code/completed and code/unsaved
+    python tools/refit.py archive/2025 --record-time 40 --workers 4
+'''
+import argparse
+import concurrent.futures
+import csv
+import logging
+import os
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'code'))
+from session import Session
+from pond_data import process_pond_data, ANALYSIS_VERSION, RECORD_TIME
+from replay import find_sessions
+
+#init logger
+logger = logging.getLogger("refit")
+
+CODE_FOLDER = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'code')
+DEFAULT_FOLDERS = [os.path.join(CODE_FOLDER, 'completed'), os.path.join(CODE_FOLDER, 'unsaved')]
+
+RESULTS = ('do', 'do_mgl', 'ysi_do', 'ysi_do_mgl')
+COLUMNS = (['session', 'analysis_version', 'record_time', 'status', 'pond_id', 'message_time']
+           + list(RESULTS) + [f'recorded_{key}' for key in RESULTS] + ['worker', 'elapsed'])
+
+
+def session_key(path):
+    # sessions are named by their measurement time, unique across folders
+    return os.path.basename(path)
+
+
+def refit_batch(paths, record_time):
+    '''
+    Refits a batch of sessions. Runs in a worker process.
+    return: list of table rows
+    '''
+    rows = []
+    for path in paths:
+        row = dict.fromkeys(COLUMNS, '')
+        row.update(session=session_key(path), analysis_version=ANALYSIS_VERSION, record_time=record_time,
+                   worker=os.getpid(), status='ok')
+        start = time.perf_counter()
+        try:
+            with open(path, 'rb') as file:
+                recorded = Session.load(file)
+            row['pond_id'] = recorded.get('pid', '')
+            row['message_time'] = recorded.get('message_time', '')
+            for key in RESULTS:
+                row[f'recorded_{key}'] = recorded.get(key, '')
+            result = process_pond_data(recorded, record_time=record_time)
+            if result is None:
+                row['status'] = 'no valid samples'
+            else:
+                for key in RESULTS:
+                    row[key] = float(result[key])
+        except Exception as e:
+            row['status'] = f'failed: {e}'
+        row['elapsed'] = time.perf_counter() - start
+        rows.append(row)
+    return rows
+
+
+def row_key(row):
+    '''
+    return: (session, analysis version, record time) of a table row, None for a row cut off by an interrupted run
+    '''
+    try:
+        return row['session'], row['analysis_version'], float(row['record_time'])
+    except (TypeError, ValueError):
+        return None
+
+
+def load_done(table, record_time):
+    '''
+    return: sessions refit ok in table for this analysis version and record time,
+            sessions with only failed rows for them
+    '''
+    done = set()
+    failed = set()
+    if not os.path.exists(table):
+        return done, failed
+    with open(table, newline='') as file:
+        for row in csv.DictReader(file):
+            key = row_key(row)
+            if key is None or key[1:] != (str(ANALYSIS_VERSION), record_time):
+                continue
+            if row['status'] == 'ok':
+                done.add(row['session'])
+            else:
+                failed.add(row['session'])
+    return done, failed - done
+
+
+def supersede(table):
+    '''
+    Rewrites table with the last row of each session, version and record time,
+    drops the rows of failed runs that were retried and rows cut off by an interrupted run
+    '''
+    with open(table, newline='') as file:
+        reader = csv.DictReader(file)
+        fieldnames = reader.fieldnames
+        rows = [row for row in reader if row_key(row) is not None]
+    latest = {row_key(row): index for index, row in enumerate(rows)}
+    keep = [row for index, row in enumerate(rows) if latest[row_key(row)] == index]
+    folder = os.path.dirname(os.path.abspath(table))
+    with tempfile.NamedTemporaryFile('w', newline='', dir=folder, suffix='.csv', delete=False) as file:
+        writer = csv.DictWriter(file, fieldnames=fieldnames)
+        writer.writeheader()
+        writer.writerows(keep)
+    os.replace(file.name, table)
+    logger.info(f"replaced {len(rows) - len(keep)} superseded rows in {table}")
+
+
+def init_worker(level):
+    logging.basicConfig(level=level, format="%(asctime)s %(processName)s %(name)s %(levelname)s: %(message)s", force=True)
+
+
+def main():
+    parser = argparse.ArgumentParser(prog="refit", description="refit recorded sessions with the current DO extrapolation")
+    parser.add_argument("paths", nargs="*", default=DEFAULT_FOLDERS, help="session pickles or folders of pickles")
+    parser.add_argument("--record-time", type=float, default=RECORD_TIME, help="seconds to extrapolate the DO to")
+    parser.add_argument("--table", default="refit_results.csv", help="results table, appended to")
+    parser.add_argument("--workers", type=int, default=os.cpu_count())
+    parser.add_argument("--batch", type=int, default=16, help="sessions per task")
+    parser.add_argument("--verbose", action="store_true", help="show the processing logs of the workers")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s %(name)s %(levelname)s: %(message)s")
+    files = find_sessions(args.paths)
+    done, retry = load_done(args.table, args.record_time)
+    todo = [path for path in files if session_key(path) not in done]
+    retry &= {session_key(path) for path in todo}
+    logger.info(f"{len(files)} sessions, {len(files) - len(todo)} already refit with analysis version "
+                f"{ANALYSIS_VERSION} at {args.record_time:g} s, {len(todo)} to go ({len(retry)} retries)")
+    if not todo:
+        return 0
+
+    new_table = not os.path.exists(args.table)
+    worker_level = logging.INFO if args.verbose else logging.CRITICAL
+    workers = {}
+    failed = 0
+    start = last_report = time.perf_counter()
+    with open(args.table, 'a', newline='') as file, \
+            concurrent.futures.ProcessPoolExecutor(args.workers, initializer=init_worker, initargs=(worker_level,)) as pool:
+        writer = csv.DictWriter(file, fieldnames=COLUMNS)
+        if new_table:
+            writer.writeheader()
+        elif file.tell() > 0:
+            # start on a new line after a row cut off by an interrupted run
+            with open(args.table, 'rb') as table:
+                table.seek(-1, os.SEEK_END)
+                if table.read(1) != b'\n':
+                    file.write('\n')
+        batches = [todo[i:i + args.batch] for i in range(0, len(todo), args.batch)]
+        jobs = [pool.submit(refit_batch, batch, args.record_time) for batch in batches]
+        finished = 0
+        for job in concurrent.futures.as_completed(jobs):
+            rows = job.result()
+            # rows are on disk as soon as their batch is done, an interrupted run resumes from here
+            writer.writerows(rows)
+            file.flush()
+            for row in rows:
+                stats = workers.setdefault(row['worker'], [0, 0.0])
+                stats[0] += 1
+                stats[1] += row['elapsed']
+                if row['status'] != 'ok':
+                    failed += 1
+                    logger.warning(f"{row['session']}: {row['status']}")
+            finished += len(rows)
+            now = time.perf_counter()
+            if now - last_report > 2 or finished == len(todo):
+                rate = finished / (now - start)
+                logger.info(f"{finished}/{len(todo)} sessions, {rate:.1f}/s, "
+                            f"eta {(len(todo) - finished) / rate:.0f} s")
+                last_report = now
+
+    if retry:
+        supersede(args.table)
+
+    wall = time.perf_counter() - start
+    logger.info(f"{len(todo) - failed} of {len(todo)} sessions refit in {wall:.1f} s, "
+                f"{len(todo) / wall:.1f} sessions/s, results in {args.table}")
+    for pid, (count, busy) in sorted(workers.items()):
+        logger.info(f"worker {pid}: {count} sessions, {count / busy if busy else 0:.1f} sessions/s busy")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,167 @@
+'''
+Headless replay of recorded sessions.
+
+Streams session pickles (unsaved/, completed/ or any folder of pickles) through
+the processing TruckSensor uses after a dive (process_pond_data) and compares
+the new results with the recorded ones. Runs across processes, no GUI, BLE or
+firebase needed.
+
+usage:
+    python tools/replay.py code/unsaved code/completed --workers 4
+    python tools/replay.py old_pickles --output replay_out   # also writes sessions and database csv
+'''
+import argparse
+import concurrent.futures
+import logging
+import os
+import sys
+import time
+from datetime import datetime
+
+import numpy as np
+import pandas as pd
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'code'))
+from session import Session, database_row
+from pond_data import process_pond_data
+
+#init logger
+logger = logging.getLogger("replay")
+
+# recorded results compared against the replay
+SCALAR_RESULTS = ('do', 'do_mgl', 'ysi_do', 'ysi_do_mgl', 'water_temp', 'sample_pressure', 'sample_depth', 'sample_duration')
+ARRAY_RESULTS = ('do_mgl_arr', 'ysi_do_mgl_arr', 'ysi_do_arr')
+
+
+def find_sessions(paths):
+    '''
+    return: sorted pickle files in paths (files or folders)
+    '''
+    files = []
+    for path in paths:
+        if os.path.isdir(path):
+            files += [os.path.join(path, f) for f in os.listdir(path) if f.endswith('.pickle')]
+        elif os.path.isfile(path):
+            files.append(path)
+        else:
+            logger.warning(f"{path} not found")
+    return sorted(files)
+
+
+def compare(recorded, replayed, atol, rtol):
+    '''
+    return: {field: (recorded, replayed)} for scalars and
+            {field: max abs difference} for arrays outside the tolerance
+    '''
+    diffs = {}
+    for key in SCALAR_RESULTS:
+        if key in recorded and key in replayed:
+            old, new = float(recorded[key]), float(replayed[key])
+            if not np.isclose(old, new, rtol=rtol, atol=atol, equal_nan=True):
+                diffs[key] = (old, new)
+    for key in ARRAY_RESULTS:
+        if key in recorded and key in replayed:
+            old = np.asarray(recorded[key], dtype=float)
+            new = np.asarray(replayed[key], dtype=float)
+            if old.shape != new.shape:
+                diffs[key] = f"shape {old.shape} -> {new.shape}"
+            elif not np.allclose(old, new, rtol=rtol, atol=atol, equal_nan=True):
+                diffs[key] = float(np.nanmax(np.abs(old - new)))
+    return diffs
+
+
+def replay_file(path, atol=1e-6, rtol=1e-6, output=None):
+    '''
+    Replays one session. Runs in a worker process.
+    return: dict with path, status, processing time, differences and the database row
+    '''
+    report = {'path': path, 'pid': os.getpid(), 'status': 'ok', 'elapsed': 0, 'diffs': {}, 'row': None}
+    try:
+        with open(path, 'rb') as file:
+            recorded = Session.load(file)
+    except Exception as e:
+        report['status'] = f'unreadable: {e}'
+        return report
+
+    start = time.perf_counter()
+    try:
+        result = process_pond_data(recorded)
+    except Exception as e:
+        report['status'] = f'failed: {e}'
+        return report
+    report['elapsed'] = time.perf_counter() - start
+    if result is None:
+        report['status'] = 'no valid samples'
+        return report
+
+    report['diffs'] = compare(recorded, result, atol, rtol)
+    if output is not None:
+        replayed = recorded.copy()
+        replayed.update(result)
+        with open(os.path.join(output, 'unsaved', os.path.basename(path)), 'wb') as file:
+            replayed.save(file)
+        # the recorded local time is not kept in the session, use the message time (GMT)
+        report['row'] = database_row(replayed, replayed.get('message_time', '')[-8:])
+    return report
+
+
+def init_worker(level):
+    logging.basicConfig(level=level, format="%(asctime)s %(processName)s %(name)s %(levelname)s: %(message)s", force=True)
+
+
+def main():
+    parser = argparse.ArgumentParser(prog="replay", description="replay recorded sessions through the dive processing")
+    parser.add_argument("paths", nargs="+", help="session pickles or folders of pickles")
+    parser.add_argument("--workers", type=int, default=os.cpu_count())
+    parser.add_argument("--atol", type=float, default=1e-6, help="absolute tolerance for reporting a difference")
+    parser.add_argument("--rtol", type=float, default=1e-6, help="relative tolerance for reporting a difference")
+    parser.add_argument("--output", default=None, help="write replayed sessions and a database csv here")
+    parser.add_argument("--verbose", action="store_true", help="show the processing logs of the workers")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s %(name)s %(levelname)s: %(message)s")
+    files = find_sessions(args.paths)
+    if not files:
+        logger.error("no sessions found")
+        return 1
+    if args.output is not None:
+        os.makedirs(os.path.join(args.output, 'unsaved'), exist_ok=True)
+
+    logger.info(f"replaying {len(files)} sessions on {args.workers} workers")
+    worker_level = logging.INFO if args.verbose else logging.CRITICAL
+    start = time.perf_counter()
+    reports = []
+    with concurrent.futures.ProcessPoolExecutor(args.workers, initializer=init_worker, initargs=(worker_level,)) as pool:
+        jobs = [pool.submit(replay_file, path, args.atol, args.rtol, args.output) for path in files]
+        for job in concurrent.futures.as_completed(jobs):
+            report = job.result()
+            reports.append(report)
+            if report['status'] != 'ok':
+                logger.warning(f"{report['path']}: {report['status']}")
+            elif report['diffs']:
+                logger.info(f"{report['path']}: {report['diffs']}")
+    wall = time.perf_counter() - start
+
+    if args.output is not None:
+        rows = [r['row'] for r in sorted(reports, key=lambda r: r['path']) if r['row'] is not None]
+        today_str = datetime.now().strftime("%Y-%m-%d")
+        pd.DataFrame(rows).to_csv(os.path.join(args.output, f"replay_{today_str}.csv"), index=False)
+
+    processed = [r for r in reports if r['status'] == 'ok']
+    changed = [r for r in processed if r['diffs']]
+    fit_time = sum(r['elapsed'] for r in processed)
+    logger.info(f"{len(processed)} of {len(files)} sessions replayed, {len(changed)} changed")
+    logger.info(f"wall {wall:.2f} s, {len(files) / wall:.1f} sessions/s, "
+                f"processing {1000 * fit_time / max(len(processed), 1):.1f} ms per session on "
+                f"{len({r['pid'] for r in reports})} processes")
+    fields = {}
+    for r in changed:
+        for key in r['diffs']:
+            fields[key] = fields.get(key, 0) + 1
+    if fields:
+        logger.info(f"changed fields (sessions): {fields}")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())